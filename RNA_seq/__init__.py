@@ -1,2 +1,9 @@
-from setuptools_scm import get_version
-version = get_version(root='..', relative_to=__file__)
\ No newline at end of file
+def __getattr__(name):
+    # the version is looked up from git on first use rather than on every
+    # import, which every worker and command pays for
+    if name == "version":
+        from setuptools_scm import get_version
+
+        globals()["version"] = get_version(root="..", relative_to=__file__)
+        return globals()["version"]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
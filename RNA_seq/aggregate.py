@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+
+class GeneAggregator:
+    """
+    Transcript to gene summing operator, built once from the annotation
+
+    Genes are stored as integer codes in sorted gene name order, so
+    collapsing a table is an index lookup plus one sorted segment sum over
+    all of its columns, with the same result as merging with the annotation
+    and summing by gene name.
+
+    Example::
+
+        aggregator = GeneAggregator.from_annotation(anno)
+        genes, (tpm, counts) = aggregator.collapse(transcripts, tpm, counts)
+    """
+
+    def __init__(self, transcripts, codes, genes):
+        """
+        :param transcripts: transcript names
+        :param codes: integer gene code of each transcript, -1 for none
+        :param genes: sorted gene names the codes point into
+        """
+        self.transcripts = pd.Index(transcripts)
+        if not self.transcripts.is_unique:
+            raise ValueError("Annotation lists some transcripts more than once")
+        self.codes = np.asarray(codes)
+        self.genes = pd.Index(genes, name="gene_name")
+
+    @classmethod
+    def from_names(cls, transcripts, genes):
+        """
+        Build the operator from the gene name of each transcript
+        :param transcripts: transcript names
+        :param genes: gene name of each transcript
+        :return: GeneAggregator
+        """
+        codes, names = pd.factorize(np.asarray(genes), sort=True)
+        return cls(transcripts, codes, names)
+
+    @classmethod
+    def from_annotation(cls, anno):
+        """
+        Build the operator from an annotation table
+        :param anno: pandas dataframe containing transcript_ID and gene_name
+        :return: GeneAggregator
+        """
+        return cls.from_names(anno["transcript_ID"], anno["gene_name"])
+
+    def collapse(self, transcripts, *matrices):
+        """
+        Sum transcript rows by gene, for any number of matrices at once
+        Transcripts missing from the annotation, or without a gene name in
+        it, are dropped, and only genes with at least one transcript in the
+        table are returned
+        :param transcripts: transcript names, one per matrix row
+        :param matrices: 2-d numpy arrays sharing the same rows
+        :return: tuple of gene name index and list of gene x sample arrays
+        """
+        positions = self.transcripts.get_indexer(transcripts)
+        rows = np.flatnonzero(positions >= 0)
+        codes = self.codes[positions[rows]]
+        # unnamed genes have code -1, which would index the last gene
+        named = codes >= 0
+        rows, codes = rows[named], codes[named]
+        order = np.argsort(codes, kind="stable")
+        rows, codes = rows[order], codes[order]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+
+        widths = [m.shape[1] for m in matrices]
+        stacked = np.hstack(matrices)
+        if len(rows):
+            summed = np.add.reduceat(stacked[rows], starts, axis=0)
+        else:
+            summed = np.empty((0, stacked.shape[1]), dtype=stacked.dtype)
+            starts = starts[:0]
+        parts = np.split(summed, np.cumsum(widths)[:-1], axis=1)
+        return (
+            self.genes[codes[starts]],
+            [part.astype(m.dtype, copy=False) for part, m in zip(parts, matrices)],
+        )
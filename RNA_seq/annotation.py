@@ -0,0 +1,148 @@
+import glob
+import logging
+import os
+import numpy as np
+import pandas as pd
+from .aggregate import GeneAggregator
+from .luigi.target import SuffixPreservingLocalTarget
+from .manifest import cached_file_digest
+
+logger = logging.getLogger("luigi-interface")
+
+# string columns kept as integer codes into sorted categories
+CATEGORICAL = ["gene_name", "gene_ID", "transcript_type"]
+CACHE_SUFFIX = ".idx-{}.npz"
+# bumped when the index layout changes, so older caches are rebuilt
+INDEX_VERSION = 2
+
+
+class AnnotationIndex:
+    """
+    Parsed transcript annotation held as numpy arrays
+
+    The transcript IDs and lengths are kept as they are, gene names,
+    gene IDs and transcript types as integer codes into sorted categories,
+    -1 where the annotation has no value.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    @classmethod
+    def from_table(cls, path):
+        """
+        Parse the annotation tsv, reading only the columns the index keeps
+        :param path: path of the annotation file
+        :return: AnnotationIndex
+        """
+        header = pd.read_table(path, nrows=0).columns
+        wanted = ["transcript_ID", "transcript_length"] + CATEGORICAL
+        usecols = [c for c in wanted if c in header]
+        df = pd.read_table(
+            path,
+            usecols=usecols,
+            dtype={c: "category" for c in CATEGORICAL if c in usecols},
+        )
+        arrays = {"transcript_ID": df["transcript_ID"].to_numpy(dtype=str)}
+        for column in CATEGORICAL:
+            if column in usecols:
+                codes, names = pd.factorize(df[column], sort=True)
+                arrays[column + "_codes"] = codes.astype(np.int32)
+                arrays[column + "_categories"] = np.asarray(names, dtype=str)
+        if "transcript_length" in usecols:
+            arrays["transcript_length"] = df["transcript_length"].to_numpy(np.int64)
+        return cls(arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a saved index
+        :param path: path of the npz file
+        :return: AnnotationIndex
+        """
+        with np.load(path, allow_pickle=False) as data:
+            return cls({k: data[k] for k in data.files})
+
+    def save(self, path):
+        """
+        Atomically save the index as an uncompressed npz file
+        :param path: path of the npz file
+        """
+        with SuffixPreservingLocalTarget(path).temporary_path() as tmp:
+            np.savez(tmp, **self.arrays)
+
+    @property
+    def transcripts(self):
+        return self.arrays["transcript_ID"]
+
+    @property
+    def transcript_length(self):
+        return self.arrays.get("transcript_length")
+
+    def codes(self, column):
+        """
+        :param column: str, one of CATEGORICAL
+        :return: numpy array of integer codes, one per transcript
+        """
+        return self.arrays[column + "_codes"]
+
+    def categories(self, column):
+        """
+        :param column: str, one of CATEGORICAL
+        :return: numpy array of sorted category names
+        """
+        return self.arrays[column + "_categories"]
+
+    def column(self, column):
+        """
+        Decode a categorical column
+        :param column: str, one of CATEGORICAL
+        :return: numpy object array of names, one per transcript, None where
+            the annotation has no value
+        """
+        codes = self.codes(column)
+        names = self.categories(column).astype(object)[codes]
+        names[codes < 0] = None
+        return names
+
+    def aggregator(self):
+        """
+        Transcript to gene name summing operator
+        :return: GeneAggregator
+        """
+        return GeneAggregator(
+            self.transcripts, self.codes("gene_name"), self.categories("gene_name")
+        )
+
+
+def annotation_digest(path):
+    """
+    Content digest of an annotation file, rehashed only when it changes
+    :param path: path of the annotation file
+    :return: str
+    """
+    return cached_file_digest(path)[:16]
+
+
+def load_annotation(path):
+    """
+    Load the annotation index cached next to the annotation file,
+    building it if the annotation content changed since it was cached
+    :param path: path of the annotation file
+    :return: AnnotationIndex
+    """
+    cache = path + CACHE_SUFFIX.format(
+        "{}v{}".format(annotation_digest(path), INDEX_VERSION)
+    )
+    if os.path.exists(cache):
+        return AnnotationIndex.load(cache)
+    index = AnnotationIndex.from_table(path)
+    try:
+        index.save(cache)
+    except OSError as e:
+        logger.warning("Could not cache annotation index %s: %s", cache, e)
+        return index
+    for stale in glob.glob(glob.escape(path) + CACHE_SUFFIX.format("*")):
+        if stale != cache:
+            os.remove(stale)
+    return index
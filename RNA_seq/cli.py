@@ -1,51 +1,356 @@
 from luigi import build
+from luigi.configuration import get_config
 import os
 import argparse
+import logging
+import threading
 from RNA_seq.wrapup import AllReports
+from RNA_seq.profile import TaskProfiler
+from RNA_seq.quant import FastqInput, SalmonQuant, SalmonQuantBatch
+from RNA_seq.cost import find_tasks, longest_first, makespan
+from RNA_seq.monitor import QuantMonitor, watch
+from RNA_seq.luigi.scan import directory_index
 
+PROVENANCE_DB = os.path.join("data", "provenance.sqlite")
+# seconds between progress reports of --metrics
+MONITOR_INTERVAL = 30
+
+logger = logging.getLogger("luigi-interface")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="python -m RNA_seq")
+    parser.add_argument("--id", required=True, help="file with one sample id per line")
 
-def main():
     # system level parameters
-    # trascriptome fasta file
-    transcriptome = os.path.join(
-        "data", "human", "gencode.v27.transcripts.formated.fa"
+    system = parser.add_argument_group("system")
+    system.add_argument(
+        "--transcriptome",
+        default=os.path.join("data", "human", "gencode.v27.transcripts.formated.fa"),
+        help="formatted transcriptome fasta file",
+    )
+    system.add_argument(
+        "--salmon",
+        default=os.path.join("data", "salmon", "bin", "salmon"),
+        help="salmon program executable",
+    )
+    system.add_argument(
+        "--index",
+        default=os.path.join("data", "index"),
+        help="folder to store salmon transcriptome index",
+    )
+    system.add_argument(
+        "--index-cache",
+        default="",
+        help="shared folder of salmon indexes keyed by transcriptome, salmon "
+        "version and options; replaces --index when given",
     )
-    # salmon program executable
-    salmon_path = os.path.join("data", "salmon", "bin", "salmon")
-    # folder to store salmon transcriptome index
-    index_path = os.path.join("data", "index")
-    # transcript annotation file
-    annotation_path = os.path.join(
-        "data", "human", "GRCh38.gencode.v27.transcripts.annot"
+    system.add_argument(
+        "--cache-budget-gb",
+        type=float,
+        default=0,
+        help="disk budget of the index cache, least recently used indexes "
+        "are removed beyond it (default: no limit)",
+    )
+    system.add_argument(
+        "--annotation",
+        default=os.path.join("data", "human", "GRCh38.gencode.v27.transcripts.annot"),
+        help="transcript annotation file",
+    )
+    system.add_argument(
+        "--gencode",
+        default=os.path.join("data", "human", "gencode.v27.transcripts.fa.gz"),
+        help="gencode release to format the transcriptome and annotation from, "
+        "if they do not exist",
     )
 
     # project level parameters
     # fastq file patterns, eg sample01_1.fastq.gz, sample01_2.fastq.gz
-    fastq_r1 = "_1"
-    fastq_r2 = "_2"
-    fastq_suffix = ".fastq.gz"
-    # number of threads for salmon to parallel compute
-    n_threads = 15
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--id")
-    args = parser.parse_args()
-    ID_path = args.id
-
-    build(
-        [
-            AllReports(
-                ID_path=ID_path,
-                annotation_path=annotation_path,
-                transcriptome=transcriptome,
-                salmon_path=salmon_path,
-                index_path=index_path,
-                fastq_r1=fastq_r1,
-                fastq_r2=fastq_r2,
-                fastq_suffix=fastq_suffix,
-                n_threads=n_threads,
-            )
-        ],
-        local_scheduler=True,
-        log_level="INFO",
+    project = parser.add_argument_group("project")
+    project.add_argument("--fastq-r1", default="_1")
+    project.add_argument("--fastq-r2", default="_2")
+    project.add_argument("--fastq-suffix", default=".fastq.gz")
+
+    # scheduling
+    schedule = parser.add_argument_group("scheduling")
+    schedule.add_argument(
+        "--cores",
+        type=int,
+        default=os.cpu_count(),
+        help="total number of cores the pipeline may use (default: all)",
+    )
+    schedule.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of salmon quantifications to run at once",
+    )
+    schedule.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="threads per salmon quantification (default: cores / workers)",
+    )
+    schedule.add_argument(
+        "--batch-size",
+        type=int,
+        default=0,
+        help="quantify samples in batches of this size, keeping the index hot "
+        "in the page cache between samples (default: one task per sample)",
+    )
+    schedule.add_argument(
+        "--tree-merge",
+        action="store_true",
+        help="sum each sample by gene as soon as it is quantified and merge "
+        "the samples as a tree, instead of all at once at the end",
+    )
+    schedule.add_argument(
+        "--block-size",
+        type=int,
+        default=0,
+        help="clean and normalize the count matrices this many samples at a "
+        "time, to bound memory on large cohorts (default: all samples at once)",
+    )
+    schedule.add_argument(
+        "--float32",
+        action="store_true",
+        help="parse, store, clean and normalize the count matrices in single "
+        "precision, halving their memory and size",
+    )
+    schedule.add_argument(
+        "--scratch",
+        default="",
+        help="local scratch folder to copy each sample's fastq files to ahead "
+        "of its quantification, removed once quantified",
+    )
+    schedule.add_argument(
+        "--scratch-budget-gb",
+        type=float,
+        default=0,
+        help="disk budget of the staged fastq files in --scratch, samples that "
+        "do not fit are read from shared storage (default: no limit)",
+    )
+    schedule.add_argument(
+        "--stage-ahead",
+        type=int,
+        default=2,
+        help="samples copied to --scratch at once, alongside the --workers "
+        "quantifications",
+    )
+    schedule.add_argument(
+        "--provenance",
+        action="store_true",
+        help="rerun the summary steps whose parameters, input file contents "
+        "or code changed since their outputs were made, recorded in "
+        "data/provenance.sqlite",
+    )
+    schedule.add_argument(
+        "--incremental",
+        action="store_true",
+        help="name the summaries after the sample IDs and only parse new or "
+        "changed samples when the ID file changes",
+    )
+    schedule.add_argument(
+        "--bulk-complete",
+        action="store_true",
+        help="check which samples are done by listing the fastq and output "
+        "folders once, instead of one file check per task; for network "
+        "filesystems",
     )
+    schedule.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="print the predicted wall time of the quantifications left for "
+        "--cores and --workers, from the runtimes of past runs, and exit",
+    )
+    schedule.add_argument(
+        "--metrics",
+        default="",
+        help="follow the running quantifications, write their progress and "
+        "fragments per second to this Prometheus textfile and log a status "
+        "table, every 30 seconds; see also python -m RNA_seq.monitor",
+    )
+    schedule.add_argument(
+        "--trace",
+        default="",
+        help="profile every task and write a chrome trace to this json file, "
+        "with a per-task summary table next to it",
+    )
+
+    # where salmon runs
+    cluster = parser.add_argument_group("cluster")
+    cluster.add_argument(
+        "--executor",
+        choices=["local", "slurm"],
+        default="local",
+        help="run salmon as local subprocesses or submit each index build and "
+        "quantification as a SLURM batch job; --workers jobs run at once",
+    )
+    cluster.add_argument(
+        "--partition", default="", help="SLURM partition to submit jobs to"
+    )
+    cluster.add_argument(
+        "--quant-mem-gb",
+        type=float,
+        default=0,
+        help="memory requested per quantification job (default: partition " "default)",
+    )
+    cluster.add_argument(
+        "--index-mem-gb",
+        type=float,
+        default=0,
+        help="memory requested for the index build job (default: partition " "default)",
+    )
+    return parser
+
+
+def configure_executor(args):
+    """
+    Set the [executor] config section from the command line
+    :param args: parsed arguments
+    """
+    config = get_config()
+    if not config.has_section("executor"):
+        config.add_section("executor")
+    config.set("executor", "backend", args.executor)
+    if args.partition:
+        config.set("executor", "partition", args.partition)
+    for family, mem_gb in [
+        ("SalmonQuant", args.quant_mem_gb),
+        ("SalmonIndex", args.index_mem_gb),
+    ]:
+        if mem_gb:
+            config.set("executor", family + ".mem_gb", str(mem_gb))
+
+
+def plan_cores(cores, workers, threads=0):
+    """
+    Split a core budget between concurrent salmon runs
+    :param cores: int, total core budget
+    :param workers: int, number of luigi workers
+    :param threads: int, threads per sample, 0 to fill the budget
+    :return: int, threads per sample
+    """
+    if cores < 1 or workers < 1:
+        raise ValueError("cores and workers must be at least 1")
+    if not threads:
+        threads = cores // workers
+    return max(1, min(threads, cores))
+
+
+def format_seconds(seconds):
+    """
+    :param seconds: float
+    :return: str, eg 1h02m
+    """
+    minutes = int(round(seconds / 60))
+    return "{}h{:02d}m".format(minutes // 60, minutes % 60)
+
+
+def print_plan(tasks, slots, show=10):
+    """
+    Print the predicted runtimes of the quantifications left to run
+    :param tasks: list of root tasks
+    :param slots: int, quantifications running at once
+    :param show: int, longest quantifications listed
+    :return: float, predicted wall time, longest first
+    """
+    quants = find_tasks(tasks, (SalmonQuant, SalmonQuantBatch))
+    predicted = [(task.predicted_seconds(), task) for task in quants]
+    durations = [seconds for seconds, _ in predicted]
+    threads = quants[0].n_threads if quants else 0
+    print("{} quantifications left, {} at once".format(len(quants), slots))
+    for seconds, task in sorted(predicted, key=lambda x: -x[0])[:show]:
+        if isinstance(task, SalmonQuant):
+            name = task.file_id
+        else:
+            name = "batch of " + ", ".join(task.file_ids)
+        print("  {:>8}  {}".format(format_seconds(seconds), name))
+    wall = longest_first(durations, slots)
+    print("predicted wall time, longest first: {}".format(format_seconds(wall)))
+    print(
+        "predicted wall time, in ID order: {}".format(
+            format_seconds(makespan(durations, slots))
+        )
+    )
+    print("core hours: {:.1f}".format(sum(durations) * threads / 3600))
+    return wall
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.scratch and args.executor != "local":
+        parser.error("--scratch stages to this host, use it with --executor local")
+    n_threads = plan_cores(args.cores, args.workers, args.threads)
+
+    # luigi only starts a task when its cores fit in what is left of the budget
+    config = get_config()
+    if not config.has_section("resources"):
+        config.add_section("resources")
+    config.set("resources", "cores", str(args.cores))
+    if args.bulk_complete:
+        if not config.has_section("scan"):
+            config.add_section("scan")
+        config.set("scan", "bulk_complete", "true")
+        for root in [FastqInput.fastq_root, SalmonQuant.output_root]:
+            directory_index().scan_tree(root)
+    if args.provenance:
+        if not config.has_section("provenance"):
+            config.add_section("provenance")
+        config.set("provenance", "db", PROVENANCE_DB)
+    configure_executor(args)
+    # staging copies run in workers of their own, beside the quantifications
+    workers = args.workers
+    if args.scratch:
+        config.set("resources", "staging", str(args.stage_ahead))
+        workers += args.stage_ahead
+
+    tasks = [
+        AllReports(
+            ID_path=args.id,
+            annotation_path=args.annotation,
+            gencode_path=args.gencode,
+            transcriptome=args.transcriptome,
+            salmon_path=args.salmon,
+            index_path=args.index,
+            index_cache=args.index_cache,
+            cache_budget_gb=args.cache_budget_gb,
+            fastq_r1=args.fastq_r1,
+            fastq_r2=args.fastq_r2,
+            fastq_suffix=args.fastq_suffix,
+            n_threads=n_threads,
+            # the index is built before any sample, using every core
+            index_threads=args.cores,
+            n_workers=args.cores,
+            batch_size=args.batch_size,
+            tree_merge=args.tree_merge,
+            block_size=args.block_size,
+            float32=args.float32,
+            scratch_dir=args.scratch,
+            scratch_budget_gb=args.scratch_budget_gb,
+            incremental=args.incremental,
+        )
+    ]
+    if args.dry_run:
+        print_plan(tasks, max(1, min(args.workers, args.cores // n_threads)))
+        return True
+    stop = threading.Event()
+    if args.metrics:
+        threading.Thread(
+            target=watch,
+            args=(QuantMonitor(), args.metrics, MONITOR_INTERVAL, stop),
+            kwargs={"report": lambda x: logger.info("Quantification progress:\n%s", x)},
+            daemon=True,
+        ).start()
+    try:
+        if not args.trace:
+            return build(tasks, workers=workers, local_scheduler=True, log_level="INFO")
+        with TaskProfiler() as profiler:
+            result = build(
+                tasks, workers=workers, local_scheduler=True, log_level="INFO"
+            )
+        profiler.write(args.trace)
+        return result
+    finally:
+        stop.set()
@@ -0,0 +1,181 @@
+import csv
+import heapq
+import os
+import time
+from luigi.configuration import get_config
+from luigi.task import flatten
+from .manifest import file_stat
+
+HISTORY = os.path.join("data", "quant_history.tsv")
+HISTORY_COLUMNS = ["file_id", "fastq_bytes", "threads", "seconds", "finished"]
+# salmon throughput and startup time assumed until runs are recorded
+DEFAULT_BYTES_PER_CORE_SECOND = 5e5
+DEFAULT_OVERHEAD = 30.0
+# runs recorded before a fit replaces the defaults
+MIN_RUNS = 3
+
+# fitted models, keyed by history path, mtime and size
+_models = {}
+
+
+def history_path():
+    """
+    File of past quantification runtimes
+    Set by the ``history`` entry of the ``[cost]`` config section
+    :return: path
+    """
+    return get_config().get("cost", "history", HISTORY)
+
+
+def record_runtime(file_id, fastq_bytes, threads, seconds, path=None):
+    """
+    Append one quantification run to the history
+    Lines are appended in one write, so concurrent workers do not mix them
+    :param file_id: str, sample ID
+    :param fastq_bytes: int, size of the sample's fastq files
+    :param threads: int, salmon threads
+    :param seconds: float, wall time
+    :param path: history file, default history_path()
+    """
+    path = path or history_path()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    line = "\t".join(
+        str(x) for x in [file_id, fastq_bytes, threads, seconds, time.time()]
+    )
+    header = "" if os.path.exists(path) else "\t".join(HISTORY_COLUMNS) + "\n"
+    with open(path, "a") as file:
+        file.write(header + line + "\n")
+
+
+class CostModel:
+    """
+    Predict a quantification's wall time from the size of its fastq files
+
+    Salmon's time is a fixed startup (mostly loading the index) plus work
+    proportional to the reads, shared by its threads::
+
+        seconds = overhead + per_byte * fastq_bytes / threads
+
+    Both terms are fitted to past runs by least squares, with defaults
+    until MIN_RUNS runs are recorded.
+
+    Example::
+
+        model = CostModel.load("data/quant_history.tsv")
+        model.predict(12 * 1024**3, threads=16)
+    """
+
+    def __init__(
+        self,
+        overhead=DEFAULT_OVERHEAD,
+        per_byte=1 / DEFAULT_BYTES_PER_CORE_SECOND,
+    ):
+        self.overhead = overhead
+        self.per_byte = per_byte
+
+    @classmethod
+    def fit(cls, runs):
+        """
+        Fit the model to past runs
+        :param runs: list of dicts with fastq_bytes, threads and seconds
+        :return: CostModel, the default one with too few usable runs
+        """
+        # imported here, quant tasks import this module and need no numpy
+        import numpy as np
+
+        runs = [
+            (float(x["fastq_bytes"]) / float(x["threads"]), float(x["seconds"]))
+            for x in runs
+            if float(x["fastq_bytes"]) > 0 and float(x["threads"]) > 0
+        ]
+        if len(runs) < MIN_RUNS:
+            return cls()
+        work, seconds = np.array(runs).T
+        if np.ptp(work) > 0:
+            design = np.column_stack([np.ones_like(work), work])
+            (overhead, per_byte), *_ = np.linalg.lstsq(design, seconds, rcond=None)
+            if overhead >= 0 and per_byte > 0:
+                return cls(float(overhead), float(per_byte))
+        # samples of one size, or a fit without meaning: keep the overhead
+        per_byte = float(np.median(np.maximum(seconds - DEFAULT_OVERHEAD, 0) / work))
+        return cls(per_byte=per_byte) if per_byte > 0 else cls()
+
+    @classmethod
+    def load(cls, path):
+        """
+        Fit the model to a history file, refitted only when the file changes
+        :param path: history file, need not exist
+        :return: CostModel
+        """
+        if not os.path.exists(path):
+            return cls()
+        stat = file_stat(path)
+        key = (os.path.abspath(path), stat["mtime"], stat["size"])
+        if key not in _models:
+            with open(path, newline="") as file:
+                runs = list(csv.DictReader(file, delimiter="\t"))
+            _models.clear()
+            _models[key] = cls.fit(runs)
+        return _models[key]
+
+    def predict(self, fastq_bytes, threads):
+        """
+        :param fastq_bytes: int, size of the sample's fastq files
+        :param threads: int, salmon threads
+        :return: float, seconds
+        """
+        return self.overhead + self.per_byte * fastq_bytes / max(int(threads), 1)
+
+
+def cost_model():
+    """
+    The model fitted to this host's history
+    :return: CostModel
+    """
+    return CostModel.load(history_path())
+
+
+def makespan(durations, slots):
+    """
+    Wall time of running jobs in the given order, each starting as soon as
+    one of the slots is free
+    :param durations: iterable of job durations, in start order
+    :param slots: int, jobs running at once
+    :return: float
+    """
+    finish = [0.0] * max(int(slots), 1)
+    for duration in durations:
+        heapq.heapreplace(finish, finish[0] + duration)
+    return max(finish)
+
+
+def longest_first(durations, slots):
+    """
+    Wall time when the longest jobs start first
+    :param durations: iterable of job durations
+    :param slots: int, jobs running at once
+    :return: float
+    """
+    return makespan(sorted(durations, reverse=True), slots)
+
+
+def find_tasks(roots, cls):
+    """
+    Tasks of a class required, directly or not, by the root tasks
+    Complete tasks are not walked into, as luigi would not run below them
+    :param roots: list of tasks
+    :param cls: task class to collect
+    :return: list of incomplete tasks of cls, in the order first required
+    """
+    found, seen, stack = [], set(), list(reversed(roots))
+    while stack:
+        task = stack.pop()
+        if task.task_id in seen:
+            continue
+        seen.add(task.task_id)
+        if task.complete():
+            continue
+        if isinstance(task, cls):
+            found.append(task)
+        stack.extend(reversed(flatten(task.requires())))
+    return found
@@ -0,0 +1,184 @@
+import os
+import numpy as np
+from luigi import IntParameter, ListParameter, Parameter, Task
+from luigi.util import inherits
+from .annotation import load_annotation
+from .luigi.task import CachedParams, TargetOutput
+from .manifest import cached_file_digest
+from .matrix import read_quant
+from .store import MatrixTarget, create_matrix
+from .summary import SummarizeCounts, get_file_ids, ids_digest, quant_flags
+from .summary import require_sample_quant
+from .transcriptome import AnnotationFile
+from .provenance import Provenance
+
+# merge groups of at most this many samples or sub-merges
+FAN_IN = 16
+
+
+def annotation_tag(path):
+    """
+    Short digest of an annotation file's content, of its path until it is made
+    :param path: path of the annotation file
+    :return: str
+    """
+    if not os.path.exists(path):
+        return ids_digest([path])
+    return cached_file_digest(path)[:10]
+
+
+@inherits(SummarizeCounts, AnnotationFile)
+class SampleGeneCounts(Provenance, CachedParams, Task):
+    """
+    Sum one sample's transcript counts and tpms by gene
+    Runs as soon as the sample is quantified, while others still are
+    Output a gene x (count, tpm) matrix store in a folder named after the
+    annotation's content, so a new annotation sums the samples again
+    """
+
+    # constant
+    output_root = os.path.join("data", "genes")
+    # parameters
+    file_id = Parameter()
+
+    @property
+    def annotation_tag(self):
+        return annotation_tag(str(self.annotation_path))
+
+    def requires(self):
+        return {
+            "quant": require_sample_quant(self, self.file_id),
+            "annotation": self.clone(AnnotationFile),
+        }
+
+    def output(self):
+        return MatrixTarget(
+            os.path.join(
+                self.output_root, self.annotation_tag, str(self.file_id) + ".cmat"
+            )
+        )
+
+    def run(self):
+        flag = quant_flags({self.file_id: self.input()["quant"]})[self.file_id]
+        dtype = np.float32 if self.float32 else np.float64
+        quant = read_quant(os.path.join(os.path.dirname(flag.path), "quant.sf"), dtype)
+        aggregator = load_annotation(self.input()["annotation"].path).aggregator()
+        genes, (summed,) = aggregator.collapse(
+            quant.index, quant[["NumReads", "TPM"]].to_numpy()
+        )
+        self.output().write(summed, genes, ["count", "tpm"], "gene_name")
+
+
+@inherits(SummarizeCounts, AnnotationFile)
+class MergeGeneCounts(Provenance, CachedParams, Task):
+    """
+    Merge per-sample gene counts and tpms as a tree
+    Each merge combines at most fan_in sample stores or smaller merges, so
+    groups merge as soon as their samples are done and the final merge only
+    copies fan_in blocks of columns
+    Without file_ids the samples are read from ID_path
+    Output two gene x sample matrix stores, counts and tpms, in a folder
+    named after the annotation's content like the per-sample stores
+    """
+
+    # constant
+    output_root = os.path.join(SummarizeCounts.output_root, "MergeGeneCounts")
+    # parameters
+    file_ids = ListParameter(default=())
+    fan_in = IntParameter(default=FAN_IN)
+
+    # outputs
+    count_matrix_out = TargetOutput(
+        file_pattern="{task.annotation_tag}/{task.group_tag}",
+        root_dir=output_root,
+        ext="_count.cmat",
+        target_class=MatrixTarget,
+    )
+    tpm_matrix_out = TargetOutput(
+        file_pattern="{task.annotation_tag}/{task.group_tag}",
+        root_dir=output_root,
+        ext="_tpm.cmat",
+        target_class=MatrixTarget,
+    )
+
+    @property
+    def samples(self):
+        return tuple(self.file_ids) or get_file_ids(str(self.ID_path))
+
+    @property
+    def annotation_tag(self):
+        return annotation_tag(str(self.annotation_path))
+
+    @property
+    def group_tag(self):
+        return "{}_{}".format(len(self.samples), ids_digest(self.samples))
+
+    def requires(self):
+        groups = merge_groups(self.samples, self.fan_in)
+        if groups is None:
+            return [self.clone(SampleGeneCounts, file_id=x) for x in self.samples]
+        return [self.clone(MergeGeneCounts, file_ids=group) for group in groups]
+
+    def output(self):
+        return {
+            "count_matrix": self.count_matrix_out(),
+            "tpm_matrix": self.tpm_matrix_out(),
+        }
+
+    def _blocks(self):
+        """
+        Count and tpm columns of each input, in sample order
+        :return: list of (gene names, counts, tpms)
+        """
+        blocks = []
+        for target in self.input():
+            if isinstance(target, dict):
+                count = target["count_matrix"].load()
+                tpm = target["tpm_matrix"].load()
+                blocks.append((count.rows, count.values, tpm.values))
+            else:
+                store = target.load()
+                blocks.append((store.rows, store.values[:, :1], store.values[:, 1:]))
+        return blocks
+
+    def run(self):
+        blocks = self._blocks()
+        genes = blocks[0][0]
+        if any(not rows.equals(genes) for rows, _, _ in blocks[1:]):
+            raise ValueError("Samples were collapsed to different genes")
+        dtype = blocks[0][1].dtype
+        samples = list(self.samples)
+        # copy each block into its columns of the memory mapped outputs
+        with self.output()["count_matrix"].temporary_path() as count_path:
+            with self.output()["tpm_matrix"].temporary_path() as tpm_path:
+                count = create_matrix(count_path, genes, samples, dtype, "gene_name")
+                tpm = create_matrix(tpm_path, genes, samples, dtype, "gene_name")
+                start = 0
+                for _, counts, tpms in blocks:
+                    stop = start + counts.shape[1]
+                    count[:, start:stop] = counts
+                    tpm[:, start:stop] = tpms
+                    start = stop
+                for matrix in [count, tpm]:
+                    if isinstance(matrix, np.memmap):
+                        matrix.flush()
+                del count, tpm
+
+
+def merge_groups(ids, fan_in):
+    """
+    Split samples into at most fan_in groups for merging
+    Groups are whole powers of fan_in from the start, so appending samples
+    only changes the last group and the other merges are reused
+    :param ids: sequence of sample IDs
+    :param fan_in: int, at least 2
+    :return: list of groups, None if the samples can be merged directly
+    """
+    if fan_in < 2:
+        raise ValueError("fan_in must be at least 2")
+    if len(ids) <= fan_in:
+        return None
+    size = fan_in
+    while size * fan_in < len(ids):
+        size *= fan_in
+    return [tuple(ids[i : i + size]) for i in range(0, len(ids), size)]
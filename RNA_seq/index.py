@@ -1,24 +1,27 @@
-from luigi import ExternalTask, Parameter, IntParameter
+from luigi import ExternalTask, Parameter, IntParameter, FloatParameter
 import os
 from luigi.local_target import LocalTarget
 from luigi.util import inherits
 from luigi.contrib.external_program import ExternalProgramTask
 from pathlib import Path
-from .luigi.task import Requires, Requirement
+from .luigi.task import Requires, Requirement, CachedParams, core_resources
+from .luigi.executor import Submittable
+from .luigi.target import AtomicDirectoryTarget, ScannedLocalTarget
+from .transcriptome import FormattedInput
+from .index_cache import index_digest, locked, lock_path, mark_used, evict
 
 
-class TranscriptomeFASTA(ExternalTask):
+class TranscriptomeFASTA(FormattedInput):
     """
     Make sure transcriptome file exists
+    Format it from the GENCODE release in gencode_path if given
     """
 
-    transcriptome = Parameter()
-
     def output(self):
         return LocalTarget(str(self.transcriptome))
 
 
-class Salmon(ExternalTask):
+class Salmon(CachedParams, ExternalTask):
     """
     Make sure Salmon executable exists
     """
@@ -30,9 +33,14 @@ class Salmon(ExternalTask):
 
 
 @inherits(Salmon, TranscriptomeFASTA)
-class SalmonIndex(ExternalProgramTask):
+class SalmonIndex(CachedParams, Submittable, ExternalProgramTask):
     """
     Build salmon index from transcriptome annotation
+    Use index_threads cores if given, as the index is built alone
+    Locally or as a batch job, depending on the executor backend
+    With index_cache, the index goes to a shared cache folder named by a
+    digest of the transcriptome, salmon version and index options, so it is
+    built once per host and reused by every project
     Use Require descriptors for composition
     """
 
@@ -40,32 +48,99 @@ class SalmonIndex(ExternalProgramTask):
     # parameters
     index_path = Parameter()
     n_threads = IntParameter()
+    index_threads = IntParameter(default=0, significant=False)
+    kmer = IntParameter(default=31)
+    index_cache = Parameter(default="")
+    cache_budget_gb = FloatParameter(default=0, significant=False)
     # requirements
     requires = Requires()
     human_rna = Requirement(TranscriptomeFASTA)
     salmon = Requirement(Salmon)
 
+    @property
+    def threads(self):
+        return self.index_threads or self.n_threads
+
+    @property
+    def resources(self):
+        return core_resources(self.threads)
+
+    def job_cores(self):
+        return self.threads
+
+    @property
+    def index_dir(self):
+        """
+        The index_path folder, or the cache entry for this index
+        Before the transcriptome is formatted there is nothing to key the
+        cache entry on yet, so it points to a pending folder until then
+        """
+        if not self.index_cache:
+            return str(self.index_path)
+        try:
+            key = index_digest(
+                str(self.transcriptome), str(self.salmon_path), self.index_options()
+            )
+        except FileNotFoundError:
+            key = "pending"
+        return os.path.join(str(self.index_cache), key)
+
+    def index_options(self):
+        """
+        Options that change the index built, threads do not
+        :return: list
+        """
+        return ["-k", self.kmer]
+
     def output(self):
         """
-        The index output is a folder (specified by user).
+        The index output is a folder (specified by user or in the cache).
         Use flag file to mark complete
         :return: success flag file
         """
-        return LocalTarget(os.path.join(str(self.index_path), self.flag))
+        return ScannedLocalTarget(os.path.join(self.index_dir, self.flag))
+
+    # folder salmon writes to while running, renamed to the index folder
+    _write_dir = None
 
     def program_args(self):
         return [
             self.input()["salmon"].path,
             "index",
             "-p",
-            self.n_threads,
+            self.threads,
             "-t",
             self.input()["human_rna"].path,
             "-i",
-            self.index_path,
-        ]
+            self._write_dir or os.path.dirname(self.output().path),
+        ] + self.index_options()
+
+    def _build(self):
+        """
+        Build the index in a temporary folder, which becomes the index
+        folder once complete, so a killed build leaves no partial index
+        """
+        index_dir = AtomicDirectoryTarget(os.path.dirname(self.output().path))
+        with index_dir.temporary_path() as self._write_dir:
+            try:
+                super().run()
+                # mark complete
+                Path(self._write_dir, self.flag).touch()
+            finally:
+                self._write_dir = None
 
     def run(self):
-        super().run()
-        # mark complete
-        Path(self.output().path).touch()
+        if not self.index_cache:
+            self._build()
+            return
+        index_dir = os.path.dirname(self.output().path)
+        # one build per index, concurrent projects wait for it and reuse it
+        with locked(lock_path(index_dir)):
+            if not os.path.exists(self.output().path):
+                self._build()
+            mark_used(index_dir)
+        evict(
+            str(self.index_cache),
+            int(self.cache_budget_gb * 1024**3),
+            keep=[os.path.basename(index_dir)],
+        )
@@ -0,0 +1,142 @@
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+from contextlib import contextmanager
+from pathlib import Path
+from .manifest import cached_file_digest, file_stat
+
+logger = logging.getLogger("luigi-interface")
+
+LAST_USED = ".last_used"
+
+# salmon versions, keyed by executable path, mtime and size
+_versions = {}
+
+
+def salmon_version(salmon_path):
+    """
+    Version string reported by a salmon executable
+    :param salmon_path: path of the salmon executable
+    :return: str
+    """
+    stat = file_stat(salmon_path)
+    key = (os.path.abspath(salmon_path), stat["mtime"], stat["size"])
+    if key not in _versions:
+        result = subprocess.run(
+            [str(salmon_path), "--version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            check=True,
+        )
+        _versions[key] = result.stdout.decode("utf-8").strip()
+    return _versions[key]
+
+
+def index_digest(transcriptome, salmon_path, options):
+    """
+    Key of a salmon index: what it was built from and how
+    :param transcriptome: path of the transcriptome fasta
+    :param salmon_path: path of the salmon executable
+    :param options: list of index options that change the index
+    :return: str
+    """
+    digest = hashlib.sha1()
+    for part in [
+        cached_file_digest(transcriptome),
+        salmon_version(salmon_path),
+    ] + [str(x) for x in options]:
+        digest.update(part.encode("utf-8") + b"\0")
+    return digest.hexdigest()[:20]
+
+
+@contextmanager
+def locked(path, shared=False, blocking=True):
+    """
+    Hold an advisory lock on a lock file, shared by processes on the host
+    :param path: path of the lock file, created if needed
+    :param shared: bool, take a shared (reader) instead of exclusive lock
+    :param blocking: bool, wait for the lock instead of failing
+    :return: context manager, yields True if the lock was taken
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as file:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(file, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def lock_path(index_dir):
+    """
+    Lock file guarding a cached index
+    :param index_dir: path of the index folder
+    :return: path
+    """
+    return index_dir.rstrip(os.sep) + ".lock"
+
+
+def mark_used(index_dir):
+    """
+    Record that a cached index was just used, for LRU eviction
+    :param index_dir: path of the index folder
+    """
+    Path(os.path.join(index_dir, LAST_USED)).touch()
+
+
+def _last_used(index_dir):
+    path = os.path.join(index_dir, LAST_USED)
+    return os.path.getmtime(path) if os.path.exists(path) else 0
+
+
+def _folder_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def evict(cache_dir, budget_bytes, keep=()):
+    """
+    Remove least recently used indexes until the cache fits its budget
+    Indexes being built or used (locked) are never removed
+    :param cache_dir: path of the index cache
+    :param budget_bytes: int, disk budget of the cache, 0 for no limit
+    :param keep: index folder names never to remove
+    :return: list of removed index folders
+    """
+    if not budget_bytes:
+        return []
+    # hidden folders are indexes still being built
+    entries = [
+        os.path.join(cache_dir, name)
+        for name in os.listdir(cache_dir)
+        if os.path.isdir(os.path.join(cache_dir, name)) and not name.startswith(".")
+    ]
+    sizes = {path: _folder_size(path) for path in entries}
+    total = sum(sizes.values())
+    removed = []
+    for path in sorted(entries, key=_last_used):
+        if total <= budget_bytes:
+            break
+        if os.path.basename(path) in keep:
+            continue
+        with locked(lock_path(path), blocking=False) as free:
+            if not free:
+                continue
+            shutil.rmtree(path)
+        total -= sizes[path]
+        removed.append(path)
+        logger.info("Evicted salmon index %s from the cache", path)
+    return removed
@@ -0,0 +1,340 @@
+import logging
+import os
+import shlex
+import subprocess
+import time
+from luigi.configuration import get_config
+from luigi.contrib.external_program import (
+    ExternalProgramRunContext,
+    ExternalProgramRunError,
+)
+
+logger = logging.getLogger("luigi-interface")
+
+BACKENDS = ("local", "slurm")
+JOB_DIR = os.path.join("data", "jobs")
+# lines of a program log shown once it is done
+LOG_TAIL = 100
+
+
+def executor_backend():
+    """Where external programs run
+
+    Set by the ``backend`` entry of the ``[executor]`` config section:
+    ``local`` runs them as subprocesses of the worker, ``slurm`` submits
+    each as a batch job.
+
+    :rtype: str
+    """
+    backend = get_config().get("executor", "backend", "local")
+    if backend not in BACKENDS:
+        raise ValueError(
+            "Unknown executor backend {}, expected one of {}".format(backend, BACKENDS)
+        )
+    return backend
+
+
+class SlurmExecutor:
+    """Run commands as SLURM batch jobs and wait for them
+
+    Each command is wrapped in a job script that records its exit code in
+    a file, so success is known without job accounting. The job is polled
+    with ``squeue`` until it leaves the queue and cancelled if the wait is
+    interrupted. Job scripts, logs and exit codes are kept in ``job_dir``,
+    which must be on a filesystem shared with the compute nodes.
+
+    Example::
+
+        executor = SlurmExecutor(partition="short")
+        executor.run(["salmon", "--version"], "salmon_version", cores=1, mem_gb=1)
+    """
+
+    def __init__(
+        self,
+        job_dir=JOB_DIR,
+        partition="",
+        poll_interval=30.0,
+        sbatch="sbatch",
+        squeue="squeue",
+        scancel="scancel",
+    ):
+        self.job_dir = job_dir
+        self.partition = partition
+        self.poll_interval = poll_interval
+        self.sbatch = sbatch
+        self.squeue = squeue
+        self.scancel = scancel
+
+    @classmethod
+    def from_config(cls):
+        """Executor set up from the ``[executor]`` config section
+
+        :rtype: SlurmExecutor
+        """
+        config = get_config()
+        return cls(
+            job_dir=config.get("executor", "job_dir", JOB_DIR),
+            partition=config.get("executor", "partition", ""),
+            poll_interval=config.getfloat("executor", "poll_interval", 30.0),
+            sbatch=config.get("executor", "sbatch", "sbatch"),
+            squeue=config.get("executor", "squeue", "squeue"),
+            scancel=config.get("executor", "scancel", "scancel"),
+        )
+
+    def job_paths(self, key, log=None):
+        """Job script, log and exit code files of a job
+
+        :param key: str, unique name of the job, eg a task id
+        :param log: path of the job log, default in job_dir
+        :rtype: dict
+        """
+        root = os.path.join(self.job_dir, key)
+        return {
+            "script": root + ".sh",
+            "log": log or root + ".log",
+            "exit": root + ".exit",
+        }
+
+    def submit(self, args, key, name, cores=1, mem_gb=0, log=None):
+        """Submit a command as a batch job
+
+        :param args: list of str, the command
+        :param key: str, unique name of the job files
+        :param name: str, job name shown by squeue
+        :param cores: int, cores requested
+        :param mem_gb: float, memory requested, 0 for the partition default
+        :param log: path of the job log, default in job_dir
+        :return: str, job id
+        """
+        paths = self.job_paths(key, log)
+        os.makedirs(self.job_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(paths["log"]) or ".", exist_ok=True)
+        if os.path.exists(paths["exit"]):
+            os.remove(paths["exit"])
+        with open(paths["script"], "w") as file:
+            file.write(
+                "#!/bin/sh\n"
+                "cd {cwd}\n"
+                "{command}\n"
+                "echo $? > {exit}.tmp && mv {exit}.tmp {exit}\n".format(
+                    cwd=shlex.quote(os.getcwd()),
+                    command=" ".join(shlex.quote(a) for a in args),
+                    exit=shlex.quote(os.path.abspath(paths["exit"])),
+                )
+            )
+        command = [
+            self.sbatch,
+            "--parsable",
+            "--job-name=" + name,
+            "--cpus-per-task={}".format(max(1, int(cores))),
+            "--output=" + os.path.abspath(paths["log"]),
+        ]
+        if mem_gb:
+            command.append("--mem={}M".format(int(mem_gb * 1024)))
+        if self.partition:
+            command.append("--partition=" + self.partition)
+        result = subprocess.run(
+            command + [paths["script"]],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        if result.returncode:
+            raise ExternalProgramRunError(
+                "Job submission failed with return code={}:".format(result.returncode),
+                command + [paths["script"]],
+                stdout=result.stdout,
+                stderr=result.stderr,
+            )
+        # --parsable prints "job_id" or "job_id;cluster"
+        return result.stdout.strip().split(";")[0]
+
+    def queued(self, job_id):
+        """Whether a job is still pending or running
+
+        A job the scheduler no longer knows has finished; other squeue
+        errors, eg a busy controller, count as still queued.
+
+        :param job_id: str
+        :rtype: bool
+        """
+        result = subprocess.run(
+            [self.squeue, "-h", "-j", job_id, "-o", "%T"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        if result.returncode == 0:
+            return bool(result.stdout.strip())
+        if "invalid job id" in result.stderr.lower():
+            return False
+        logger.warning("squeue failed for job %s: %s", job_id, result.stderr.strip())
+        return True
+
+    def wait(self, job_id):
+        """Poll a job until it leaves the queue, cancel it if interrupted
+
+        :param job_id: str
+        """
+        try:
+            while self.queued(job_id):
+                time.sleep(self.poll_interval)
+        except BaseException:
+            subprocess.run([self.scancel, job_id])
+            raise
+
+    def run(self, args, key, name, cores=1, mem_gb=0, log=None):
+        """Submit a command, wait for it and raise if it failed
+
+        The end of the job log is logged once the job is done.
+
+        :param args: list of str, the command
+        :param key: str, unique name of the job files
+        :param name: str, job name shown by squeue
+        :param cores: int, cores requested
+        :param mem_gb: float, memory requested, 0 for the partition default
+        :param log: path of the job log, default in job_dir
+        """
+        paths = self.job_paths(key, log)
+        job_id = self.submit(args, key, name, cores, mem_gb, log)
+        logger.info("Submitted job %s: %s", job_id, " ".join(args))
+        self.wait(job_id)
+        # the exit code may reach a network filesystem after the job ends
+        if not os.path.exists(paths["exit"]):
+            time.sleep(self.poll_interval)
+        log = tail(paths["log"])
+        if log:
+            logger.info("Job %s log:\n%s", job_id, log)
+        if not os.path.exists(paths["exit"]):
+            raise ExternalProgramRunError(
+                "Job {} ended without an exit code, it was cancelled or "
+                "killed:".format(job_id),
+                args,
+                stdout=log,
+            )
+        with open(paths["exit"]) as file:
+            code = int(file.read().strip() or -1)
+        if code:
+            raise ExternalProgramRunError(
+                "Job {} failed with return code={}:".format(job_id, code),
+                args,
+                stdout=log,
+            )
+
+
+def tail(path, lines=LOG_TAIL, chunk=1 << 16):
+    """Last lines of a text file, read backwards from its end so a long
+    log is never loaded whole
+
+    :param path: path of the file
+    :param lines: int, lines to keep
+    :param chunk: int, bytes read at a time
+    :return: str, empty if the file does not exist
+    """
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        return ""
+    with file:
+        end = file.seek(0, os.SEEK_END)
+        data = b""
+        # salmon ends its progress lines with carriage returns
+        while end and data.count(b"\n") + data.count(b"\r") <= lines:
+            start = max(0, end - chunk)
+            file.seek(start)
+            data = file.read(end - start) + data
+            end = start
+    text = data.decode("utf-8", errors="replace")
+    return "\n".join(text.splitlines()[-lines:])
+
+
+def run_logged(args, log, env=None):
+    """Run a command locally with its output and errors written to a log
+    file as they come, so it can be followed while it runs
+
+    :param args: list of str, the command
+    :param log: path of the log file
+    :param env: dict of environment variables, default this process's
+    """
+    logger.info("Running command: %s", " ".join(args))
+    os.makedirs(os.path.dirname(log) or ".", exist_ok=True)
+    with open(log, "wb") as file:
+        proc = subprocess.Popen(args, env=env, stdout=file, stderr=subprocess.STDOUT)
+        with ExternalProgramRunContext(proc):
+            proc.wait()
+    output = tail(log)
+    if output:
+        logger.info("Program output:\n%s", output)
+    if proc.returncode:
+        raise ExternalProgramRunError(
+            "Program failed with return code={}:".format(proc.returncode),
+            args,
+            env=env,
+            stdout=output,
+        )
+
+
+class Submittable:
+    """Mixin running an :class:`~luigi.contrib.external_program.ExternalProgramTask`
+    on the configured executor backend
+
+    Locally the program runs as today. With the ``slurm`` backend it is
+    submitted as a batch job asking for :meth:`job_cores` cores and
+    :meth:`job_memory_gb` of memory, and the worker waits for it, so luigi
+    keeps tracking the graph while the jobs spread across nodes.
+
+    Example::
+
+        class Align(Submittable, ExternalProgramTask):
+            def job_cores(self):
+                return 8
+
+    with, in ``luigi.cfg``::
+
+        [executor]
+        backend = slurm
+        partition = short
+        Align.mem_gb = 16
+    """
+
+    def job_cores(self):
+        """Cores to request for the job
+
+        :rtype: int
+        """
+        return 1
+
+    def program_log(self):
+        """File the program's output and errors are written to while it
+        runs, on either backend; None keeps luigi's capture locally and the
+        job log in the job folder
+
+        :rtype: str or None
+        """
+        return None
+
+    def job_memory_gb(self):
+        """Memory to request for the job, from the ``<task family>.mem_gb``
+        entry of the ``[executor]`` config section, else its ``mem_gb``
+
+        :rtype: float, 0 for the partition default
+        """
+        config = get_config()
+        default = config.getfloat("executor", "mem_gb", 0.0)
+        return config.getfloat("executor", self.task_family + ".mem_gb", default)
+
+    def run(self):
+        args = [str(a) for a in self.program_args()]
+        if executor_backend() != "local":
+            SlurmExecutor.from_config().run(
+                args,
+                self.task_id,
+                self.task_family,
+                self.job_cores(),
+                self.job_memory_gb(),
+                self.program_log(),
+            )
+        elif self.program_log():
+            run_logged(args, self.program_log(), self.program_environment())
+        else:
+            super().run()
@@ -0,0 +1,164 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from luigi import Event, Task
+from luigi.configuration import get_config
+from luigi.task import flatten
+
+# directory indexes, keyed by process id so forked workers start fresh
+_indexes = {}
+
+
+class DirectoryIndex:
+    """In-memory index of the files in a set of directories
+
+    Each directory is listed once with :func:`os.scandir` and existence
+    checks are answered from the listing. A directory missing from an
+    already listed parent is known not to exist without touching the disk.
+    File sizes are read from a listing of their folder too, taken with the
+    sizes on first use.
+
+    Example::
+
+        index = DirectoryIndex()
+        index.scan_tree("data/output")   # data/output and every sample folder
+        index.exists("data/output/sample01/__SUCCESS")
+    """
+
+    def __init__(self):
+        self._entries = {}
+        # file sizes by folder, keyed by absolute path
+        self._sizes = {}
+
+    def listing(self, folder):
+        """Names in a directory, listed on first use
+
+        :param folder: path of the directory
+        :rtype: frozenset, empty if the directory does not exist
+        """
+        folder = os.path.normpath(folder)
+        if folder not in self._entries:
+            parent, name = os.path.split(folder)
+            if parent and parent != folder and parent in self._entries:
+                if name not in self._entries[parent]:
+                    return frozenset()
+            self._entries[folder] = _scan(folder)
+        return self._entries[folder]
+
+    def exists(self, path):
+        """Whether a file or directory exists, according to the index
+
+        :param path: path to check
+        :rtype: bool
+        """
+        folder, name = os.path.split(os.path.normpath(path))
+        return name in self.listing(folder or os.curdir)
+
+    def size(self, path):
+        """Size of a file, according to the index
+
+        :param path: path of the file
+        :rtype: int, bytes, 0 if the file does not exist
+        """
+        folder, name = os.path.split(os.path.abspath(path))
+        if folder not in self._sizes:
+            self._sizes[folder] = _scan_sizes(folder)
+        return self._sizes[folder].get(name, 0)
+
+    def scan_tree(self, root, n_threads=16):
+        """List a directory and all its sub-directories, the sub-directories
+        in parallel since listing them is bound by filesystem latency
+
+        :param root: path of the directory
+        :param n_threads: number of directories listed at once
+        """
+        root = os.path.normpath(root)
+        try:
+            with os.scandir(root) as entries:
+                entries = list(entries)
+        except (FileNotFoundError, NotADirectoryError):
+            entries = []
+        self._entries[root] = frozenset(entry.name for entry in entries)
+        folders = [os.path.join(root, e.name) for e in entries if e.is_dir()]
+        with ThreadPoolExecutor(n_threads) as pool:
+            for folder, names in zip(folders, pool.map(_scan, folders)):
+                self._entries[folder] = names
+
+    def refresh(self, path):
+        """Update the index after a file or directory was written
+
+        Its folder is listed again on next use, and listed ancestors
+        learn about folders created for it.
+
+        :param path: path of the file or directory
+        """
+        path = os.path.normpath(path)
+        self._entries.pop(path, None)
+        self._sizes.pop(os.path.dirname(os.path.abspath(path)), None)
+        child = os.path.dirname(path) or os.curdir
+        self._entries.pop(child, None)
+        while True:
+            parent = os.path.dirname(child)
+            if not parent or parent == child or parent not in self._entries:
+                return
+            name = os.path.basename(child)
+            if name not in self._entries[parent] and os.path.isdir(child):
+                self._entries[parent] = self._entries[parent] | {name}
+            child = parent
+
+
+def _scan(folder):
+    try:
+        with os.scandir(folder) as entries:
+            return frozenset(entry.name for entry in entries)
+    except (FileNotFoundError, NotADirectoryError):
+        return frozenset()
+
+
+def _scan_sizes(folder):
+    sizes = {}
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        sizes[entry.name] = entry.stat().st_size
+                except FileNotFoundError:
+                    continue
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return sizes
+
+
+def bulk_complete():
+    """Whether completeness is answered from directory scans
+
+    Set by the ``bulk_complete`` entry of the ``[scan]`` config section.
+
+    :rtype: bool
+    """
+    return get_config().getboolean("scan", "bulk_complete", False)
+
+
+def directory_index():
+    """The directory index of this process
+
+    :rtype: DirectoryIndex
+    """
+    pid = os.getpid()
+    if pid not in _indexes:
+        _indexes.clear()
+        _indexes[pid] = DirectoryIndex()
+    return _indexes[pid]
+
+
+@Task.event_handler(Event.SUCCESS)
+@Task.event_handler(Event.FAILURE)
+def _refresh(task, *args):
+    # outputs just written (or partly written) change their folders
+    if not _indexes:
+        return
+    index = directory_index()
+    for target in flatten(task.output()):
+        path = getattr(target, "path", None)
+        if path:
+            index.refresh(path)
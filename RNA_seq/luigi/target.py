@@ -1,6 +1,9 @@
 from luigi.local_target import LocalTarget, atomic_file
 import os
+import shutil
+import socket
 from contextlib import contextmanager
+from .scan import bulk_complete, directory_index
 
 
 class suffix_preserving_atomic_file(atomic_file):
@@ -52,3 +55,93 @@ class SuffixPreservingLocalTarget(BaseAtomicProviderLocalTarget):
     """
 
     atomic_provider = suffix_preserving_atomic_file
+
+
+class ScannedLocalTarget(LocalTarget):
+    """
+    Local target whose existence is answered from the directory index of
+    the process in bulk completeness mode, instead of one stat per target
+    """
+
+    def exists(self):
+        if bulk_complete():
+            return directory_index().exists(self.path)
+        return super().exists()
+
+
+class AtomicDirectoryTarget(ScannedLocalTarget):
+    """
+    Local directory written atomically: the writer fills a temporary sibling
+    directory, which replaces the target in one rename when it is done, so
+    a crashed or killed writer never leaves a partial directory behind
+
+    Temporary directories are hidden and named by host and process, and
+    those of processes no longer running on this host are removed before
+    the next write.
+
+    Example::
+
+        target = AtomicDirectoryTarget("data/output/sample01")
+        with target.temporary_path() as tmp:
+            run(["salmon", "quant", "-o", tmp, ...])
+    """
+
+    def _temporary_prefix(self):
+        folder, name = os.path.split(os.path.normpath(self.path))
+        return os.path.join(folder, ".{}.tmp-{}-".format(name, socket.gethostname()))
+
+    def remove_stale(self):
+        """
+        Remove temporary directories left by dead writers on this host
+        :return: list of removed paths
+        """
+        folder, start = os.path.split(self._temporary_prefix())
+        folder = folder or os.curdir
+        if not os.path.isdir(folder):
+            return []
+        removed = []
+        for name in os.listdir(folder):
+            pid = name[len(start) :]
+            if not name.startswith(start) or not pid.isdigit():
+                continue
+            if pid_alive(int(pid)):
+                continue
+            shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+            removed.append(os.path.join(folder, name))
+        return removed
+
+    @contextmanager
+    def temporary_path(self):
+        """
+        Provide an empty temporary directory, renamed onto the target when
+        the block succeeds and removed when it fails
+        A partial target left by an earlier writer is replaced
+        :return: path of the temporary directory
+        """
+        self.remove_stale()
+        tmp = self._temporary_prefix() + str(os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        try:
+            yield tmp
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        if os.path.lexists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(tmp, self.path)
+
+
+def pid_alive(pid):
+    """
+    Whether a process is running on this host
+    :param pid: int
+    :return: bool
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
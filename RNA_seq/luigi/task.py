@@ -1,5 +1,8 @@
+from luigi.event import Event
 from luigi.local_target import LocalTarget
+from luigi.configuration import get_config
 import os
+import time
 
 
 class Requires:
@@ -38,12 +41,33 @@ class Requires:
         :returns: requirements compatible with `task.requires()`
         :rtype: dict
         """
-        # Search task.__class__ for Requirement instances
-        # return
-        task_keys = [
-            k for k, v in task.__class__.__dict__.items() if isinstance(v, Requirement)
-        ]
-        return {k: getattr(task, k) for k in task_keys}
+        return {k: getattr(task, k) for k in requirement_names(task.__class__)}
+
+
+# Requirement attribute names, keyed by task class
+_requirement_names = {}
+
+
+def requirement_names(cls):
+    """Names of the :class:`.Requirement` descriptors of a task class
+
+    Collected once per class along the MRO, so requirements declared on a
+    base class are inherited, and an attribute redefined as something else
+    in a subclass is no longer a requirement.
+
+    :param cls: task class
+    :rtype: tuple
+    """
+    if cls not in _requirement_names:
+        names = {}
+        for klass in reversed(cls.__mro__):
+            for k, v in vars(klass).items():
+                if isinstance(v, Requirement):
+                    names[k] = None
+                else:
+                    names.pop(k, None)
+        _requirement_names[cls] = tuple(names)
+    return _requirement_names[cls]
 
 
 class Requirement:
@@ -55,7 +79,36 @@ class Requirement:
         if task is None:
             return self
 
-        return task.clone(self.task_class, **self.params)
+        # Task parameters never change, so each requirement is cloned once
+        clones = task.__dict__.setdefault("_requirement_clones", {})
+        if self not in clones:
+            clones[self] = task.clone(self.task_class, **self.params)
+        return clones[self]
+
+
+# Parameters, keyed by task class
+_params = {}
+
+
+class CachedParams:
+    """Mixin caching :meth:`luigi.task.Task.get_params` per class
+
+    Luigi lists a task's parameters with ``dir()`` on every instantiation
+    and clone, which dominates building graphs with a task per sample.
+    The list is built on first use, after ``@inherits`` has added the
+    inherited parameters, and reused from then on.
+
+    Example::
+
+        class PerSample(CachedParams, Task):
+            file_id = Parameter()
+    """
+
+    @classmethod
+    def get_params(cls):
+        if cls not in _params:
+            _params[cls] = super().get_params()
+        return list(_params[cls])
 
 
 class TargetOutput:
@@ -83,3 +136,42 @@ class TargetOutput:
         filename = os.path.join(self.root_dir, self.file_pattern + self.ext)
 
         return self.target_class(filename.format(task=task), **self.target_kwargs)
+
+
+def core_resources(cores):
+    """Resources claiming cores from the scheduler's core budget
+
+    The budget is the ``cores`` entry of the ``[resources]`` config section.
+    Without a budget no resources are claimed; with one, a task never asks
+    for more than the whole budget so it can always be scheduled.
+
+    :param cores: number of cores the task uses
+    :rtype: dict
+    """
+    budget = get_config().getint("resources", "cores", 0)
+    if not budget:
+        return {}
+    return {"cores": max(1, min(int(cores), budget))}
+
+
+def run_nested(task):
+    """Run a task inside another task's run, firing the events a worker
+    fires for the tasks it runs
+
+    Handlers of START, SUCCESS, FAILURE and PROCESSING_TIME then see the
+    task as if the scheduler had run it, eg to profile it or record its
+    provenance as soon as it is done.
+
+    :param task: task whose requirements are complete
+    :raises: whatever the task's run raises, after its FAILURE event
+    """
+    task.trigger_event(Event.START, task)
+    start = time.time()
+    try:
+        task.run()
+    except Exception as ex:
+        task.trigger_event(Event.FAILURE, task, ex)
+        raise
+    finally:
+        task.trigger_event(Event.PROCESSING_TIME, task, time.time() - start)
+    task.trigger_event(Event.SUCCESS, task)
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+from .luigi.target import SuffixPreservingLocalTarget
+
+# content digests of files, keyed by path, mtime and size
+_digests = {}
+
+
+def file_digest(path, algorithm="sha1", block_size=1 << 20):
+    """
+    Hash the content of a file
+    :param path: path of the file
+    :param algorithm: str, hashlib algorithm name
+    :param block_size: int, bytes read at a time
+    :return: str, hex digest
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_stat(path):
+    """
+    Cheap fingerprint of a file
+    :param path: path of the file
+    :return: dict with mtime (ns) and size (bytes)
+    """
+    stat = os.stat(path)
+    return {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def cached_file_digest(path):
+    """
+    Content digest of a file, rehashed only when its mtime or size changes
+    :param path: path of the file
+    :return: str, hex digest
+    """
+    stat = file_stat(path)
+    key = (os.path.abspath(path), stat["mtime"], stat["size"])
+    if key not in _digests:
+        _digests[key] = file_digest(path)
+    return _digests[key]
+
+
+class SampleManifest:
+    """
+    Persistent record of the file each sample was last read from
+
+    Each entry keeps the path, mtime, size and content hash. A sample is
+    unchanged when its path, mtime and size match, or when they do not but
+    the content hash still does (eg the file was copied or touched).
+    """
+
+    def __init__(self, path, samples=None):
+        self.path = path
+        self.samples = samples or {}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a manifest, or start an empty one if it does not exist yet
+        :param path: path of the manifest json
+        :return: SampleManifest
+        """
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path, "r") as file:
+            return cls(path, json.load(file)["samples"])
+
+    def changed(self, sample, path):
+        """
+        Check whether a sample's file differs from the recorded one
+        :param sample: str, sample id
+        :param path: path of the sample's file
+        :return: bool
+        """
+        entry = self.samples.get(sample)
+        if entry is None or entry["path"] != path:
+            return True
+        stat = file_stat(path)
+        if stat["mtime"] == entry["mtime"] and stat["size"] == entry["size"]:
+            return False
+        if stat["size"] != entry["size"] or file_digest(path) != entry["hash"]:
+            return True
+        # same content, only the timestamp moved
+        entry.update(stat)
+        return False
+
+    def record(self, sample, path):
+        """
+        Record the current state of a sample's file
+        :param sample: str, sample id
+        :param path: path of the sample's file
+        """
+        self.samples[sample] = dict(
+            path=path, hash=file_digest(path), **file_stat(path)
+        )
+
+    def retain(self, samples):
+        """
+        Drop every sample not in the list
+        :param samples: list of sample ids to keep
+        """
+        keep = set(samples)
+        self.samples = {k: v for k, v in self.samples.items() if k in keep}
+
+    def save(self):
+        """
+        Atomically write the manifest
+        """
+        target = SuffixPreservingLocalTarget(self.path)
+        with target.open("w") as file:
+            json.dump({"samples": self.samples}, file, indent=1, sort_keys=True)
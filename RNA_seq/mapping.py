@@ -0,0 +1,180 @@
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+# the first four columns match the old get_salmon_summary.pl table
+SUMMARY_COLUMNS = [
+    "Sample",
+    "Total_Reads",
+    "Mapped_Reads",
+    "Mapped_Rate",
+    "Library_Type",
+    "Compatible_Fragment_Ratio",
+    "Decoy_Fragments",
+    "Salmon_Version",
+    "Source",
+]
+
+# salmon_quant.log lines holding the mapping stats
+LOG_PATTERNS = {
+    "Total_Reads": re.compile(r"^Observed\s(\d+)\stotal\sfragments"),
+    "Mapped_Reads": re.compile(r"Counted\s(\d+)\stotal\sreads"),
+    "Mapped_Rate": re.compile(r"Mapping\srate\s=\s(\d+\.\d+)%"),
+}
+LOG_TYPES = {"Total_Reads": int, "Mapped_Reads": int, "Mapped_Rate": float}
+
+
+class MappingSummaryError(Exception):
+    """
+    Raised when the mapping stats of one or more samples can not be read
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(
+            "Could not summarize {} sample(s):\n{}".format(
+                len(errors), "\n".join(errors)
+            )
+        )
+
+    def __reduce__(self):
+        # rebuild from the error list when sent between processes
+        return self.__class__, (self.errors,)
+
+
+def _read_json(path):
+    """
+    Read a json file if it exists
+    :param path: path of the json file
+    :return: dict, empty if the file does not exist
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as file:
+        try:
+            return json.load(file)
+        except ValueError:
+            raise ValueError("{} is not valid json".format(path))
+
+
+def parse_quant_log(path, keys=tuple(LOG_PATTERNS)):
+    """
+    Find the mapping stats in a salmon quant log, one line at a time
+    :param path: path of logs/salmon_quant.log
+    :param keys: stats to find, default all of LOG_PATTERNS
+    :return: dict of Total_Reads, Mapped_Reads and Mapped_Rate
+    """
+    stats = {}
+    with open(path, "r") as file:
+        for line in file:
+            for key in keys:
+                match = LOG_PATTERNS[key].search(line)
+                if match:
+                    stats[key] = LOG_TYPES[key](match.group(1))
+    missing = [key for key in keys if key not in stats]
+    if missing:
+        raise ValueError(
+            "{} is incomplete, no {} found".format(path, ", ".join(missing))
+        )
+    return stats
+
+
+def summarize_sample(sample, sample_dir):
+    """
+    Read the mapping stats of one salmon quant output folder
+    Use aux_info/meta_info.json and lib_format_counts.json,
+    fall back to logs/salmon_quant.log for older salmon versions
+    Mapped_Reads is the log's "Counted N total reads" whenever the log has
+    it, as in the old get_salmon_summary.pl table; meta_info's num_mapped,
+    which can differ, is only used without it
+    :param sample: str, sample name
+    :param sample_dir: path of the salmon quant output folder
+    :return: dict with the SUMMARY_COLUMNS
+    """
+    meta = _read_json(os.path.join(sample_dir, "aux_info", "meta_info.json"))
+    lib = _read_json(os.path.join(sample_dir, "lib_format_counts.json"))
+    row = dict.fromkeys(SUMMARY_COLUMNS)
+    row["Sample"] = sample
+    log = os.path.join(sample_dir, "logs", "salmon_quant.log")
+    if all(k in meta for k in ["num_processed", "num_mapped", "percent_mapped"]):
+        row.update(
+            Total_Reads=meta["num_processed"],
+            Mapped_Reads=meta["num_mapped"],
+            Mapped_Rate=meta["percent_mapped"],
+            Source="meta_info",
+        )
+        if os.path.exists(log):
+            try:
+                row.update(parse_quant_log(log, ["Mapped_Reads"]))
+            except ValueError:
+                pass
+    else:
+        if not os.path.exists(log):
+            raise ValueError(
+                "no aux_info/meta_info.json or logs/salmon_quant.log in {}".format(
+                    sample_dir
+                )
+            )
+        row.update(parse_quant_log(log), Source="log")
+    library_types = meta.get("library_types")
+    row.update(
+        Library_Type=(
+            ",".join(library_types) if library_types else lib.get("expected_format")
+        ),
+        Compatible_Fragment_Ratio=lib.get("compatible_fragment_ratio"),
+        Decoy_Fragments=meta.get("num_decoy_fragments"),
+        Salmon_Version=meta.get("salmon_version"),
+    )
+    return row
+
+
+def sample_source(sample_dir):
+    """
+    The file a salmon quant output folder's stats are tracked by, its quant
+    log or, for outputs without one, meta_info.json
+    Both are written again, with new timestamps, whenever salmon reruns
+    :param sample_dir: path of the salmon quant output folder
+    :return: path
+    """
+    log = os.path.join(sample_dir, "logs", "salmon_quant.log")
+    if os.path.exists(log):
+        return log
+    return os.path.join(sample_dir, "aux_info", "meta_info.json")
+
+
+def summarize_rows(sample_dirs, n_workers=1):
+    """
+    Read the mapping stats of all samples in parallel
+    :param sample_dirs: dict of sample name to salmon quant output folder
+    :param n_workers: int, number of samples read at once
+    :return: list of dicts with the SUMMARY_COLUMNS, one per sample
+    :raises MappingSummaryError: listing every sample that could not be read
+    """
+
+    def read(item):
+        sample, sample_dir = item
+        try:
+            return summarize_sample(sample, sample_dir), None
+        except (OSError, ValueError) as e:
+            return None, "{}: {}".format(sample, e)
+
+    with ThreadPoolExecutor(max(1, n_workers)) as pool:
+        results = list(pool.map(read, sample_dirs.items()))
+    errors = [error for _, error in results if error]
+    if errors:
+        raise MappingSummaryError(errors)
+    return [row for row, _ in results]
+
+
+def summarize_mapping(sample_dirs, n_workers=1):
+    """
+    Read the mapping stats of all samples in parallel into one table
+    :param sample_dirs: dict of sample name to salmon quant output folder
+    :param n_workers: int, number of samples read at once
+    :return: pandas dataframe with one row per sample
+    :raises MappingSummaryError: listing every sample that could not be read
+    """
+    rows = summarize_rows(sample_dirs, n_workers=n_workers)
+    return pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
@@ -0,0 +1,139 @@
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("luigi-interface")
+
+# the only quant.sf columns the summary tables need
+QUANT_COLUMNS = ["Name", "NumReads", "TPM"]
+
+# transcript index shared by every worker process, set once per process
+_reference = None
+
+
+def _set_reference(reference):
+    """
+    Set the transcript index samples are aligned to
+    :param reference: pandas index of transcript names
+    """
+    global _reference
+    _reference = reference
+
+
+def read_quant(path, dtype=np.float64):
+    """
+    Read the transcript names, counts and tpms from a salmon quant.sf table
+    :param path: path of the quant.sf file
+    :param dtype: numpy dtype for the counts and tpms
+    :return: pandas dataframe indexed by transcript name
+    """
+    return pd.read_csv(
+        path,
+        sep="\t",
+        usecols=QUANT_COLUMNS,
+        index_col="Name",
+        dtype={"NumReads": dtype, "TPM": dtype},
+    )
+
+
+def align_quant(df, reference, path):
+    """
+    Put a sample's transcripts in the order of the reference index
+    :param df: pandas dataframe from read_quant
+    :param reference: pandas index of transcript names
+    :param path: path the table was read from, for error messages
+    :return: pandas dataframe in reference order
+    """
+    if df.index.equals(reference):
+        return df
+    if len(df.index) != len(reference):
+        raise ValueError(
+            "{} has {} transcripts, expected {}".format(
+                path, len(df.index), len(reference)
+            )
+        )
+    aligned = df.reindex(reference)
+    if aligned.isna().to_numpy().any():
+        raise ValueError("{} does not match the reference transcripts".format(path))
+    return aligned
+
+
+def _read_aligned(path, dtype):
+    """
+    Read one sample aligned to the shared reference index
+    :param path: path of the quant.sf file
+    :param dtype: numpy dtype for the counts and tpms
+    :return: tuple of counts and tpm numpy arrays
+    """
+    df = align_quant(read_quant(path, dtype), _reference, path)
+    return df["NumReads"].to_numpy(), df["TPM"].to_numpy()
+
+
+def build_quant_matrix(paths, n_workers=1, dtype=np.float64):
+    """
+    Read salmon quant tables into preallocated transcript x sample arrays
+    The first table sets the transcript order, the rest are checked against it
+    and realigned if their order differs
+    :param paths: list of quant.sf paths, one per sample column
+    :param n_workers: int, number of processes used to parse the tables
+    :param dtype: numpy dtype of the arrays, eg np.float32 to halve memory
+    :return: tuple of transcript index, counts array and tpm array
+    """
+    start = time.time()
+    first = read_quant(paths[0], dtype)
+    reference = first.index
+    # column-major so that each sample is a contiguous write
+    counts = np.empty((len(reference), len(paths)), dtype=dtype, order="F")
+    tpm = np.empty_like(counts)
+    counts[:, 0] = first["NumReads"].to_numpy()
+    tpm[:, 0] = first["TPM"].to_numpy()
+
+    rest = paths[1:]
+    if n_workers > 1 and rest:
+        chunksize = max(1, len(rest) // (n_workers * 4))
+        with ProcessPoolExecutor(
+            n_workers, initializer=_set_reference, initargs=(reference,)
+        ) as pool:
+            columns = pool.map(_read_aligned, rest, repeat(dtype), chunksize=chunksize)
+            _fill(counts, tpm, columns)
+    else:
+        _set_reference(reference)
+        _fill(counts, tpm, map(_read_aligned, rest, repeat(dtype)))
+
+    elapsed = time.time() - start
+    logger.info(
+        "Read %d quant tables in %.1fs (%.1f samples/s)",
+        len(paths),
+        elapsed,
+        len(paths) / max(elapsed, 1e-9),
+    )
+    return reference, counts, tpm
+
+
+def _fill(counts, tpm, columns):
+    """
+    Write sample columns into the preallocated arrays, after the first sample
+    :param counts: numpy array for the counts
+    :param tpm: numpy array for the tpms
+    :param columns: iterable of (counts, tpm) tuples in sample order
+    """
+    for i, (count_col, tpm_col) in enumerate(columns, 1):
+        counts[:, i] = count_col
+        tpm[:, i] = tpm_col
+
+
+def matrix_frame(index, values, samples, index_name="transcript_ID"):
+    """
+    Wrap a feature x sample array as a table with a leading name column
+    :param index: feature names, one per row
+    :param values: numpy array of values
+    :param samples: list of sample names, one per column
+    :param index_name: str, name of the leading column
+    :return: pandas dataframe
+    """
+    df = pd.DataFrame(values, columns=samples)
+    df.insert(0, index_name, np.asarray(index))
+    return df
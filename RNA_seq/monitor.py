@@ -0,0 +1,374 @@
+import argparse
+import os
+import re
+import socket
+import threading
+import time
+from .luigi.target import pid_alive
+from .mapping import LOG_PATTERNS, LOG_TYPES
+from .quant import PROGRAM_LOG, SalmonQuant
+
+# salmon colours its progress with terminal escapes
+ANSI = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+PROGRESS_PATTERNS = {
+    "fragments": re.compile(r"processed\s+([\d,]+)\s+fragments"),
+    "started": re.compile(r"^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)"),
+}
+# temporary sample folders of AtomicDirectoryTarget: .<sample>.tmp-<host>-<pid>
+RUNNING = re.compile(r"^\.(?P<sample>.+)\.tmp-(?P<host>.+)-(?P<pid>\d+)$")
+# seconds without new fragments after which a sample counts as stalled
+STALL_SECONDS = 300
+METRIC_PREFIX = "rnaseq_quant_"
+# longest line kept, a longer one is not a log line worth parsing
+MAX_LINE = 1 << 16
+
+
+class LogTail:
+    """
+    Follow a log file as it is written, returning the lines added since the
+    last read
+    Only the unread part is read, a chunk at a time, and only an unfinished
+    last line is kept between reads, so a long log is never held in memory.
+    Carriage returns end lines too, as in progress output redrawn in place.
+
+    Example::
+
+        log = LogTail("data/output/.sample01.tmp-host-123/logs/salmon_quant.log")
+        for line in log.read():
+            ...
+    """
+
+    def __init__(self, path, chunk=1 << 16):
+        self.path = path
+        self.chunk = chunk
+        self.offset = 0
+        self.partial = b""
+
+    def read(self):
+        """
+        :return: list of new complete lines, empty if the file does not exist
+        """
+        try:
+            file = open(self.path, "rb")
+        except FileNotFoundError:
+            return []
+        lines = []
+        with file:
+            if os.fstat(file.fileno()).st_size < self.offset:
+                # the file was replaced or truncated, start over
+                self.offset, self.partial = 0, b""
+            file.seek(self.offset)
+            while True:
+                data = file.read(self.chunk)
+                if not data:
+                    break
+                self.offset += len(data)
+                *complete, self.partial = re.split(rb"[\r\n]", self.partial + data)
+                lines.extend(x.decode("utf-8", errors="replace") for x in complete if x)
+                if len(self.partial) > MAX_LINE:
+                    self.partial = b""
+        return lines
+
+
+class SampleProgress:
+    """
+    Progress of one running quantification, from salmon's log and output
+    """
+
+    def __init__(self, sample, folder, now=None):
+        self.sample = sample
+        self.folder = folder
+        now = now or time.time()
+        # moved back to salmon's first log timestamp once it is read
+        self.started = now
+        self.updated = now
+        self.fragments = 0
+        self.mapping_rate = None
+        self.logs = [
+            LogTail(os.path.join(folder, "logs", "salmon_quant.log")),
+            LogTail(os.path.join(folder, "logs", PROGRAM_LOG)),
+        ]
+
+    def parse(self, line, now):
+        """
+        Update the progress from one log line
+        :param line: str
+        :param now: float, time the line was read
+        """
+        line = ANSI.sub("", line)
+        match = PROGRESS_PATTERNS["fragments"].search(line)
+        if match:
+            fragments = int(match.group(1).replace(",", ""))
+            if fragments > self.fragments:
+                self.fragments, self.updated = fragments, now
+        match = PROGRESS_PATTERNS["started"].search(line)
+        if match:
+            started = time.mktime(time.strptime(match.group(1), "%Y-%m-%d %H:%M:%S"))
+            self.started = min(self.started, started)
+        for key in ["Total_Reads", "Mapped_Rate"]:
+            match = LOG_PATTERNS[key].search(line)
+            if not match:
+                continue
+            value = LOG_TYPES[key](match.group(1))
+            if key == "Mapped_Rate":
+                self.mapping_rate = value / 100
+            elif value > self.fragments:
+                self.fragments, self.updated = value, now
+
+    def poll(self, now=None):
+        """
+        Read what the logs gained since the last poll
+        :param now: float, time of the poll
+        """
+        now = now or time.time()
+        for log in self.logs:
+            for line in log.read():
+                self.parse(line, now)
+
+    def elapsed(self, now=None):
+        return max((now or time.time()) - self.started, 0.0)
+
+    def rate(self, now=None):
+        """
+        :return: float, fragments (read pairs) per second so far
+        """
+        elapsed = self.elapsed(now)
+        return self.fragments / elapsed if elapsed else 0.0
+
+    def stalled(self, now=None, stall_seconds=STALL_SECONDS):
+        """
+        Whether no fragments were processed for stall_seconds
+        :return: bool
+        """
+        return (now or time.time()) - self.updated > stall_seconds
+
+
+def running_samples(output_root=SalmonQuant.output_root):
+    """
+    Samples being quantified on this host, found from the temporary folders
+    salmon writes to until the sample is done
+    :param output_root: folder of the sample outputs
+    :return: dict of sample ID to temporary folder
+    """
+    host = socket.gethostname()
+    running = {}
+    try:
+        names = os.listdir(output_root)
+    except FileNotFoundError:
+        return running
+    for name in names:
+        match = RUNNING.match(name)
+        if match and match["host"] == host and pid_alive(int(match["pid"])):
+            running[match["sample"]] = os.path.join(output_root, name)
+    return running
+
+
+class QuantMonitor:
+    """
+    Follow the running quantifications and report their progress as a
+    Prometheus textfile and a status table
+
+    Each poll finds the running samples from their temporary output
+    folders and reads what their salmon_quant.log and salmon output logs
+    gained since the last poll. A sample counts as stalled when no
+    fragments were processed for stall_seconds, which tells it apart from
+    a sample that is only slow.
+
+    Example::
+
+        monitor = QuantMonitor()
+        while True:
+            monitor.poll()
+            monitor.write_textfile("/var/lib/node_exporter/rnaseq.prom")
+            print(monitor.table())
+            time.sleep(10)
+    """
+
+    def __init__(
+        self, output_root=SalmonQuant.output_root, stall_seconds=STALL_SECONDS
+    ):
+        self.output_root = output_root
+        self.stall_seconds = stall_seconds
+        self.samples = {}
+        self.finished = 0
+
+    def poll(self, now=None):
+        """
+        Update the progress of the running samples
+        :param now: float, time of the poll
+        :return: list of SampleProgress, by sample ID
+        """
+        now = now or time.time()
+        running = running_samples(self.output_root)
+        for sample in list(self.samples):
+            if self.samples[sample].folder != running.get(sample):
+                del self.samples[sample]
+                self.finished += 1
+        for sample, folder in running.items():
+            if sample not in self.samples:
+                self.samples[sample] = SampleProgress(sample, folder, now)
+            self.samples[sample].poll(now)
+        return [self.samples[x] for x in sorted(self.samples)]
+
+    def metrics(self, now=None):
+        """
+        Progress in the Prometheus text exposition format
+        :param now: float, time of the report
+        :return: str
+        """
+        now = now or time.time()
+        samples = [self.samples[x] for x in sorted(self.samples)]
+        lines = []
+
+        def metric(name, text, values):
+            lines.append("# HELP {}{} {}".format(METRIC_PREFIX, name, text))
+            lines.append("# TYPE {}{} gauge".format(METRIC_PREFIX, name))
+            for labels, value in values:
+                lines.append("{}{}{} {}".format(METRIC_PREFIX, name, labels, value))
+
+        def per_sample(get):
+            return [('{{sample="{}"}}'.format(x.sample), get(x)) for x in samples]
+
+        metric(
+            "fragments",
+            "Fragments processed by a running quantification.",
+            per_sample(lambda x: x.fragments),
+        )
+        metric(
+            "fragments_per_second",
+            "Fragments processed per second by a running quantification.",
+            per_sample(lambda x: round(x.rate(now), 3)),
+        )
+        metric(
+            "elapsed_seconds",
+            "Seconds since a running quantification started.",
+            per_sample(lambda x: round(x.elapsed(now), 3)),
+        )
+        metric(
+            "stalled",
+            "1 when a running quantification processed no fragments lately.",
+            per_sample(lambda x: int(x.stalled(now, self.stall_seconds))),
+        )
+        metric(
+            "mapping_rate",
+            "Fraction of fragments mapped, once a quantification reports it.",
+            [
+                ('{{sample="{}"}}'.format(x.sample), x.mapping_rate)
+                for x in samples
+                if x.mapping_rate is not None
+            ],
+        )
+        metric("running", "Quantifications running.", [("", len(samples))])
+        metric(
+            "finished",
+            "Quantifications that ended, done or failed, since the monitor started.",
+            [("", self.finished)],
+        )
+        metric(
+            "fragments_per_second_total",
+            "Fragments processed per second by all running quantifications.",
+            [("", round(sum(x.rate(now) for x in samples), 3))],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path, now=None):
+        """
+        Write the metrics for the node exporter textfile collector, replaced
+        in one rename so it is never read half written
+        :param path: path of the .prom file
+        :param now: float, time of the report
+        """
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "w") as file:
+            file.write(self.metrics(now))
+        os.replace(tmp, path)
+
+    def table(self, now=None):
+        """
+        One line of progress per running sample, and a total
+        :param now: float, time of the report
+        :return: str
+        """
+        now = now or time.time()
+        row = "{:<20} {:>9} {:>10} {:>9} {:>7}  {}"
+        lines = [row.format("sample", "elapsed", "fragments", "frag/s", "mapped", "")]
+        total = 0.0
+        for sample in sorted(self.samples):
+            progress = self.samples[sample]
+            total += progress.rate(now)
+            rate = progress.mapping_rate
+            lines.append(
+                row.format(
+                    sample,
+                    "{:.0f}s".format(progress.elapsed(now)),
+                    "{:.1f}M".format(progress.fragments / 1e6),
+                    "{:.0f}".format(progress.rate(now)),
+                    "-" if rate is None else "{:.1%}".format(rate),
+                    "stalled" if progress.stalled(now, self.stall_seconds) else "",
+                )
+            )
+        lines.append(
+            "{} running, {} finished, {:.0f} fragments/s".format(
+                len(self.samples), self.finished, total
+            )
+        )
+        return "\n".join(lines)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="python -m RNA_seq.monitor")
+    parser.add_argument(
+        "--output-root",
+        default=SalmonQuant.output_root,
+        help="folder of the sample outputs (default: data/output)",
+    )
+    parser.add_argument(
+        "--textfile",
+        default="",
+        help="Prometheus textfile to write the metrics to, eg in the node "
+        "exporter's textfile collector folder",
+    )
+    parser.add_argument(
+        "--interval", type=float, default=10, help="seconds between polls"
+    )
+    parser.add_argument(
+        "--stall-seconds",
+        type=float,
+        default=STALL_SECONDS,
+        help="seconds without progress before a sample counts as stalled",
+    )
+    parser.add_argument("--once", action="store_true", help="poll once and exit")
+    return parser
+
+
+def watch(monitor, textfile="", interval=10, stop=None, report=print):
+    """
+    Poll and report until stopped
+    :param monitor: QuantMonitor
+    :param textfile: Prometheus textfile to write, none if empty
+    :param interval: float, seconds between polls
+    :param stop: threading.Event ending the watch, none to run forever
+    :param report: function called with the status table of each poll
+    """
+    stop = stop or threading.Event()
+    while True:
+        monitor.poll()
+        if textfile:
+            monitor.write_textfile(textfile)
+        report(monitor.table())
+        if stop.wait(interval):
+            return
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    monitor = QuantMonitor(args.output_root, args.stall_seconds)
+    stop = threading.Event()
+    if args.once:
+        stop.set()
+    watch(monitor, args.textfile, args.interval, stop, lambda x: print(x, flush=True))
+    return monitor
+
+
+if __name__ == "__main__":
+    main()
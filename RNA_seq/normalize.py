@@ -0,0 +1,262 @@
+from contextlib import ExitStack
+import numpy as np
+import pandas as pd
+from luigi import FloatParameter, Task
+from luigi.util import inherits
+from .luigi.target import SuffixPreservingLocalTarget
+from .luigi.task import Requirement, Requires, TargetOutput
+from .preprocess import CleanCounts, sample_blocks
+from .provenance import Provenance
+from .store import MatrixTarget, create_matrix
+from .summary import Incremental, COHORT_PATTERN
+
+# matrices written, each as a store and, with write_csv, a csv file
+MATRICES = ["cpm", "tmm", "vst"]
+# fractions of genes trimmed from each end, by log ratio and by abundance,
+# before averaging, as in edgeR's TMM
+LOG_RATIO_TRIM = 0.3
+SUM_TRIM = 0.05
+
+
+def library_sizes(counts):
+    """
+    Total counts of each sample
+    :param counts: 2-d numpy array, gene x sample
+    :return: 1-d float64 numpy array
+    """
+    return counts.sum(axis=0, dtype=np.float64)
+
+
+def upper_quartiles(counts, lib):
+    """
+    Upper quartile of each sample's counts over its library size, used to
+    pick the TMM reference sample
+    :param counts: 2-d numpy array, gene x sample
+    :param lib: 1-d numpy array, library sizes
+    :return: 1-d numpy array
+    """
+    if not len(counts):
+        return np.zeros(counts.shape[1])
+    return np.quantile(counts / np.where(lib > 0, lib, 1), 0.75, axis=0)
+
+
+def tmm_factors(counts, lib, ref, ref_lib):
+    """
+    TMM scaling factors of samples against a reference sample, all samples
+    at once: the weighted mean log ratio to the reference over the genes
+    left once the extreme log ratios and abundances are trimmed
+    Genes are ranked in order of appearance among ties, where edgeR
+    averages tied ranks
+    :param counts: 2-d numpy array, gene x sample
+    :param lib: 1-d numpy array, library sizes of the samples
+    :param ref: 1-d numpy array, counts of the reference sample
+    :param ref_lib: float, library size of the reference sample
+    :return: 1-d float64 numpy array, before scaling to a geometric mean of 1
+    """
+    # single precision counts stay single precision
+    lib, ref_lib = lib.astype(counts.dtype), counts.dtype.type(ref_lib)
+    ref = ref[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        obs_rate, ref_rate = counts / lib, ref / ref_lib
+        log_ratio = np.log2(obs_rate / ref_rate)
+        abundance = (np.log2(obs_rate) + np.log2(ref_rate)) / 2
+        variance = (lib - counts) / lib / counts + (ref_lib - ref) / ref_lib / ref
+    # genes counted in both samples
+    finite = np.isfinite(log_ratio) & np.isfinite(abundance)
+    n = finite.sum(axis=0)
+    keep = finite
+    for values, trim in [(log_ratio, LOG_RATIO_TRIM), (abundance, SUM_TRIM)]:
+        # rank within each sample, genes not counted in both rank last
+        order = np.where(finite, values, np.inf).argsort(axis=0, kind="stable")
+        rank = np.empty_like(order)
+        np.put_along_axis(rank, order, np.arange(1, len(values) + 1)[:, None], axis=0)
+        low = np.floor(n * trim) + 1
+        keep = keep & (rank >= low) & (rank <= n + 1 - low)
+    weights = np.where(keep, 1 / np.where(keep, variance, 1), 0)
+    total = weights.sum(axis=0, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (np.where(keep, log_ratio, 0) * weights).sum(
+            axis=0, dtype=np.float64
+        ) / total
+    # samples with nothing left to compare keep their library size
+    return np.where(total > 0, 2**mean, 1.0)
+
+
+def cpm(counts, lib):
+    """
+    Counts per million of the library size
+    :param counts: 2-d numpy array, gene x sample
+    :param lib: 1-d numpy array, library sizes, or effective library sizes
+    :return: 2-d numpy array of the dtype of counts, zero for empty samples
+    """
+    scale = np.where(lib > 0, 1e6 / np.where(lib > 0, lib, 1), 0)
+    return counts * scale.astype(counts.dtype)
+
+
+def log_cpm(counts, lib, mean_lib, prior_count=2.0):
+    """
+    Variance stabilizing log2 counts per million, as edgeR's cpm(log=TRUE):
+    a prior count proportional to the library size is added, which keeps
+    the variance of low counts from blowing up on the log scale
+    :param counts: 2-d numpy array, gene x sample
+    :param lib: 1-d numpy array, effective library sizes
+    :param mean_lib: float, mean effective library size of the whole cohort
+    :param prior_count: float, prior count of a sample of mean library size
+    :return: 2-d numpy array of the dtype of counts, NaN for empty samples
+    """
+    prior = prior_count * lib / (mean_lib or 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values = (counts + prior.astype(counts.dtype)) / (lib + 2 * prior).astype(
+            counts.dtype
+        )
+        return np.log2(values * counts.dtype.type(1e6))
+
+
+@inherits(CleanCounts)
+class NormalizeCounts(Provenance, Incremental, Task):
+    """
+    Normalize the cleaned gene counts for analysis
+    Library size counts per million (cpm), counts per million of the TMM
+    scaled library sizes (tmm) and variance stabilized log2 tmm counts per
+    million (vst), computed a matrix at a time
+    With block_size, block_size samples are loaded at a time
+    With float32, the matrices are computed and stored in single precision,
+    halving their memory and size, like the counts they are made from
+    Output three matrix stores, unless write_csv is off three csv files, and
+    a table of each sample's library size and TMM factor
+    Use Require and targetoutput descriptor for composition
+    """
+
+    # constant
+    output_root = CleanCounts.output_root
+    # parameters
+    prior_count = FloatParameter(default=2.0)
+
+    # requirements
+    requires = Requires()
+    clean = Requirement(CleanCounts)
+    # output
+    factors_out = TargetOutput(
+        file_pattern=COHORT_PATTERN,
+        target_class=SuffixPreservingLocalTarget,
+        ext="_factors.tsv",
+        root_dir=output_root,
+    )
+    cpm_out = TargetOutput(
+        file_pattern=COHORT_PATTERN,
+        target_class=SuffixPreservingLocalTarget,
+        ext="_cpm.csv",
+        root_dir=output_root,
+    )
+    cpm_matrix_out = TargetOutput(
+        file_pattern=COHORT_PATTERN,
+        target_class=MatrixTarget,
+        ext="_cpm.cmat",
+        root_dir=output_root,
+    )
+    tmm_out = TargetOutput(
+        file_pattern=COHORT_PATTERN,
+        target_class=SuffixPreservingLocalTarget,
+        ext="_tmm.csv",
+        root_dir=output_root,
+    )
+    tmm_matrix_out = TargetOutput(
+        file_pattern=COHORT_PATTERN,
+        target_class=MatrixTarget,
+        ext="_tmm.cmat",
+        root_dir=output_root,
+    )
+    vst_out = TargetOutput(
+        file_pattern=COHORT_PATTERN,
+        target_class=SuffixPreservingLocalTarget,
+        ext="_vst.csv",
+        root_dir=output_root,
+    )
+    vst_matrix_out = TargetOutput(
+        file_pattern=COHORT_PATTERN,
+        target_class=MatrixTarget,
+        ext="_vst.cmat",
+        root_dir=output_root,
+    )
+
+    def output(self):
+        outputs = {
+            "factors": self.factors_out(),
+            "cpm_matrix": self.cpm_matrix_out(),
+            "tmm_matrix": self.tmm_matrix_out(),
+            "vst_matrix": self.vst_matrix_out(),
+        }
+        if self.write_csv:
+            outputs.update(
+                {"cpm": self.cpm_out(), "tmm": self.tmm_out(), "vst": self.vst_out()}
+            )
+        return outputs
+
+    def run(self):
+        counts = self.input()["clean"]["count_matrix"].load()
+        samples = list(counts.columns)
+        dtype = np.dtype(np.float32 if self.float32 else np.float64)
+        blocks = sample_blocks(len(samples), self.block_size or len(samples) or 1)
+        # a cohort in one block is loaded once for all passes
+        whole = np.asarray(counts.values, dtype=dtype) if len(blocks) == 1 else None
+
+        def load(block):
+            if whole is not None:
+                return whole
+            return np.asarray(counts.values[:, block], dtype=dtype)
+
+        # the reference sample's upper quartile is closest to the mean
+        lib, upper = np.zeros(len(samples)), np.zeros(len(samples))
+        for block in blocks:
+            values = load(block)
+            lib[block] = library_sizes(values)
+            upper[block] = upper_quartiles(values, lib[block])
+        factors = np.ones(len(samples))
+        if samples:
+            ref = int(np.argmin(np.abs(upper - upper.mean())))
+            ref_counts = np.asarray(counts.values[:, ref], dtype=dtype)
+            for block in blocks:
+                factors[block] = tmm_factors(
+                    load(block), lib[block], ref_counts, lib[ref]
+                )
+            factors /= np.exp(np.mean(np.log(factors)))
+        effective = lib * factors
+
+        # write matrix stores, one block of samples at a time
+        with ExitStack() as stack:
+            stores = {}
+            for name in MATRICES:
+                path = stack.enter_context(
+                    self.output()[name + "_matrix"].temporary_path()
+                )
+                stores[name] = create_matrix(
+                    path, counts.rows, samples, dtype, "gene_name"
+                )
+            for block in blocks:
+                values = load(block)
+                stores["cpm"][:, block] = cpm(values, lib[block])
+                stores["tmm"][:, block] = cpm(values, effective[block])
+                stores["vst"][:, block] = log_cpm(
+                    values,
+                    effective[block],
+                    effective.mean() if samples else 0,
+                    self.prior_count,
+                )
+            for matrix in stores.values():
+                if isinstance(matrix, np.memmap):
+                    matrix.flush()
+            del stores
+        with self.output()["factors"].temporary_path() as out:
+            pd.DataFrame(
+                {"Sample": samples, "lib_size": lib, "norm_factor": factors}
+            ).to_csv(out, sep="\t", index=False)
+        if not self.write_csv:
+            return
+        # write csvs
+        block_rows = len(counts.rows)
+        if self.block_size:
+            block_rows = len(counts.rows) * self.block_size // max(len(samples), 1)
+        for name in MATRICES:
+            store = self.output()[name + "_matrix"].load()
+            with self.output()[name].temporary_path() as out:
+                store.to_csv(out, max(block_rows, 1))
@@ -1,35 +1,56 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import repeat
+import numpy as np
 import pandas as pd
-import seaborn as sns
-from luigi import Parameter, Task, format, ExternalTask, LocalTarget
+from luigi import Task, IntParameter, BoolParameter, format
 from luigi.util import inherits
 from .summary import SummarizeCounts, SummarizeMapping
+from .summary import Incremental, COHORT_PATTERN
 from .luigi.target import SuffixPreservingLocalTarget
 from .luigi.task import Requirement, Requires, TargetOutput
+from .store import MatrixTarget, create_matrix
+from .matrix import matrix_frame
+from .aggregate import GeneAggregator
+from .annotation import load_annotation
+from .transcriptome import AnnotationFile
+from .genes import MergeGeneCounts
+from .provenance import Provenance
+
+# samples per page of the QC figures
+SAMPLES_PER_PAGE = 50
+FIGURE_SIZE = (12, 8)
 
 
 @inherits(SummarizeMapping)
-class MapFigure(Task):
+class MapFigure(Provenance, Incremental, Task):
     """
     Visualize mapping stats from mapping summary table
     Require all sample quantification
-    Output two png files containing mapping stats
+    Output two pdf files containing mapping stats, one page per
+    samples_per_page samples, rendered in parallel with n_workers > 1
     Use Require and targetoutput descriptor for composition
     """
 
     # constant
     output_root = SummarizeMapping.output_root
 
+    # parameters
+    samples_per_page = IntParameter(default=SAMPLES_PER_PAGE, significant=False)
+
     # requirements
     requires = Requires()
     sum_map = Requirement(SummarizeMapping)
     # output
     rate_out = TargetOutput(
+        file_pattern=COHORT_PATTERN,
         target_class=SuffixPreservingLocalTarget,
         root_dir=output_root,
         ext="_rate.pdf",
         format=format.Nop,
     )
     reads_out = TargetOutput(
+        file_pattern=COHORT_PATTERN,
         target_class=SuffixPreservingLocalTarget,
         root_dir=output_root,
         ext="_reads.pdf",
@@ -43,38 +64,135 @@ class MapFigure(Task):
         # Read summary
         with self.input()["sum_map"].open("r") as file:
             df = pd.read_table(file)
-        # Create plots
-        sns.set(rc={"figure.figsize": (12, 8)})
-        rate_plot = make_plots("Mapped_Rate", df)
-        reads_plot = make_plots("Mapped_Reads", df)
-        #  write pdf files
-        with self.output()["rate"].temporary_path() as rate_out:
-            rate_plot.figure.savefig(rate_out, dpi=600)
-        with self.output()["reads"].temporary_path() as reads_out:
-            reads_plot.figure.savefig(reads_out, dpi=600)
+        # Render both figures, in parallel processes when allowed
+        jobs = [
+            (self.output()["rate"], "Mapped_Rate"),
+            (self.output()["reads"], "Mapped_Reads"),
+        ]
+        with ExitStack() as stack:
+            paths = [stack.enter_context(target.temporary_path()) for target, _ in jobs]
+            y_labs = [y_lab for _, y_lab in jobs]
+            per_page = repeat(self.samples_per_page)
+            if self.n_workers > 1:
+                with ProcessPoolExecutor(min(self.n_workers, len(jobs))) as pool:
+                    list(pool.map(render_figure, paths, y_labs, repeat(df), per_page))
+            else:
+                list(map(render_figure, paths, y_labs, repeat(df), per_page))
 
 
-def make_plots(y_lab, df):
+def make_plots(y_lab, df, ax):
     """
     Use seaborn to create summary QC plots
     :param y_lab: str, Y label to plot
     :param df: pandas dataframe containing the data to plot
+    :param ax: matplotlib axes to draw on
     :return: seaborn plot
     """
-    plot = sns.barplot(x="Sample", y=y_lab, data=df)
+    import seaborn as sns
+
+    plot = sns.barplot(x="Sample", y=y_lab, data=df, ax=ax)
+    plot.set_xticks(range(len(df)))
     plot.set_xticklabels(df.Sample, rotation=45, ha="right")
     return plot
 
 
-class AnnotationFile(ExternalTask):
+def render_figure(path, y_lab, df, per_page=SAMPLES_PER_PAGE, dpi=600):
     """
-    Make sure annotation file containing transcript ID mapping to gene name exists
+    Render one QC figure to a pdf, one page per per_page samples so the
+    labels stay readable and the time grows linearly with the cohort
+    Cohorts spanning several pages get an overview page of all samples first
+    Every page is its own figure, drawn without pyplot or a display
+    :param path: path of the pdf file
+    :param y_lab: str, Y label to plot
+    :param df: pandas dataframe containing the data to plot
+    :param per_page: int, samples per page
+    :param dpi: int, resolution of rasterized elements
     """
+    # the plotting stack takes longer to import than the rest of the
+    # pipeline, so only the processes drawing figures load it
+    from matplotlib.backends.backend_pdf import PdfPages
 
-    annotation_path = Parameter()
+    pages = [df.iloc[start : start + per_page] for start in range(0, len(df), per_page)]
+    # an empty table still gets one, empty, page
+    pages = pages or [df]
+    layout, fitted = page_layout(y_lab, pages)
+    with PdfPages(path) as pdf:
+        if len(df) > per_page:
+            pdf.savefig(overview_figure(y_lab, df), dpi=dpi)
+        for i, page in enumerate(pages):
+            figure = fitted.get(i) or page_figure(y_lab, page)
+            figure.subplots_adjust(**layout)
+            pdf.savefig(figure, dpi=dpi)
 
-    def output(self):
-        return LocalTarget(str(self.annotation_path))
+
+def page_figure(y_lab, df):
+    """
+    Draw one page of a QC figure
+    :param y_lab: str, Y label to plot
+    :param df: pandas dataframe containing the samples of the page
+    :return: matplotlib figure
+    """
+    import seaborn as sns
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=FIGURE_SIZE)
+    with sns.axes_style("darkgrid"):
+        ax = figure.subplots()
+    make_plots(y_lab, df, ax)
+    return figure
+
+
+def page_layout(y_lab, pages):
+    """
+    Find subplot margins fitting every page of a QC figure
+    Fitting the layout costs as much as drawing, so only the pages with the
+    longest sample label and with the widest values are fitted, and the
+    widest of their margins kept
+    :param y_lab: str, Y label to plot
+    :param pages: list of pandas dataframes, one per page
+    :return: tuple of the margins dict and a dict of page index to the
+        figures drawn to fit them
+    """
+    label = pd.Series([page.Sample.astype(str).str.len().max() for page in pages])
+    value = pd.Series([page[y_lab].abs().max() for page in pages])
+    fitted = {}
+    # empty pages give NaN
+    for i in {label.fillna(0).idxmax(), value.fillna(0).idxmax()}:
+        fitted[i] = page_figure(y_lab, pages[i])
+        fitted[i].tight_layout()
+    pars = [figure.subplotpars for figure in fitted.values()]
+    layout = dict(
+        left=max(x.left for x in pars),
+        right=min(x.right for x in pars),
+        bottom=max(x.bottom for x in pars),
+        top=min(x.top for x in pars),
+    )
+    return layout, fitted
+
+
+def overview_figure(y_lab, df):
+    """
+    All samples of a large cohort in one unlabeled panel, sorted by value,
+    to spot outliers before reading the per-sample pages
+    :param y_lab: str, Y label to plot
+    :param df: pandas dataframe containing the data to plot
+    :return: matplotlib figure
+    """
+    import seaborn as sns
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=FIGURE_SIZE)
+    with sns.axes_style("darkgrid"):
+        ax = figure.subplots()
+    values = df[y_lab].sort_values(ignore_index=True)
+    ax.plot(values.index, values.to_numpy(), marker=".", linestyle="none")
+    ax.set(
+        xlabel="{} samples, sorted".format(len(df)),
+        ylabel=y_lab,
+        xticks=[],
+    )
+    figure.tight_layout()
+    return figure
 
 
 def merge_annotation(anno, table):
@@ -84,63 +202,197 @@ def merge_annotation(anno, table):
     :param table: pandas dataframe containing either tpm or count table
     :return: pandas dataframe
     """
-    return (
-        pd.merge(anno, table, on="transcript_ID")
-            .groupby("gene_name")
-            .sum()
-            .drop("transcript_length", axis=1)
-            .reset_index()
+    values = table.drop("transcript_ID", axis=1)
+    genes, (summed,) = GeneAggregator.from_annotation(anno).collapse(
+        table["transcript_ID"], values.to_numpy()
     )
+    return matrix_frame(genes, summed, list(values.columns), "gene_name")
 
 
 @inherits(SummarizeCounts, AnnotationFile)
-class CleanCounts(Task):
+class CleanCounts(Provenance, Incremental, Task):
     """
     Clean up counts and tpm table
-    Map transcript IDs to gene names
+    Map transcript IDs to gene names using the cached annotation index
     Sum up counts and tpms by gene
     Remove non-expressiong genes
     Require all sample quantification
-    Output two csv files containing gene counts and tpms
+    With tree_merge, samples are summed by gene as soon as each is
+    quantified and merged as a tree, instead of all at once here
+    With block_size, block_size samples are loaded at a time, so memory
+    stays bounded however large the cohort
+    Output two matrix stores and, unless write_csv is off, two csv files
+    containing gene counts and tpms
     Use Require and targetoutput descriptor for composition
     """
 
     # constant
     output_root = SummarizeMapping.output_root
+    # parameters
+    tree_merge = BoolParameter(default=False, significant=False)
+    block_size = IntParameter(default=0, significant=False)
 
     # requirements
-    requires = Requires()
     annotation = Requirement(AnnotationFile)
     raw_counts = Requirement(SummarizeCounts)
+    static_requires = Requires()
     # output
     tpm_out = TargetOutput(
-        target_class=SuffixPreservingLocalTarget, ext="_tpm.csv", root_dir=output_root
+        file_pattern=COHORT_PATTERN,
+        target_class=SuffixPreservingLocalTarget,
+        ext="_tpm.csv",
+        root_dir=output_root,
     )
     count_out = TargetOutput(
-        target_class=SuffixPreservingLocalTarget, ext="_count.csv", root_dir=output_root
+        file_pattern=COHORT_PATTERN,
+        target_class=SuffixPreservingLocalTarget,
+        ext="_count.csv",
+        root_dir=output_root,
+    )
+    tpm_matrix_out = TargetOutput(
+        file_pattern=COHORT_PATTERN,
+        target_class=MatrixTarget,
+        ext="_tpm.cmat",
+        root_dir=output_root,
     )
+    count_matrix_out = TargetOutput(
+        file_pattern=COHORT_PATTERN,
+        target_class=MatrixTarget,
+        ext="_count.cmat",
+        root_dir=output_root,
+    )
+
+    def requires(self):
+        requirements = self.static_requires()
+        if self.tree_merge:
+            requirements["raw_counts"] = self.clone(MergeGeneCounts)
+        return requirements
 
     def output(self):
-        return {"tpm": self.tpm_out(), "count": self.count_out()}
+        outputs = {
+            "tpm_matrix": self.tpm_matrix_out(),
+            "count_matrix": self.count_matrix_out(),
+        }
+        if self.write_csv:
+            outputs.update({"tpm": self.tpm_out(), "count": self.count_out()})
+        return outputs
+
+    def _aggregator(self):
+        """
+        Transcript to gene operator, None when the inputs are summed by gene
+        :return: GeneAggregator or None
+        """
+        if self.tree_merge:
+            return None
+        return load_annotation(self.input()["annotation"].path).aggregator()
+
+    def _load_raw(self):
+        tpm_raw = self.input()["raw_counts"]["tpm_matrix"].load()
+        count_raw = self.input()["raw_counts"]["count_matrix"].load()
+        if not tpm_raw.rows.equals(count_raw.rows):
+            raise ValueError("Count and tpm matrices list different transcripts")
+        return tpm_raw, count_raw
 
     def run(self):
-        # Read annotations and raw transcript tables
-        with self.input()["annotation"].open("r") as file:
-            anno = pd.read_table(file)
-        with self.input()["raw_counts"]["tpm"].open("r") as file:
-            tpm_raw = pd.read_csv(file)
-        with self.input()["raw_counts"]["count"].open("r") as file:
-            count_raw = pd.read_csv(file)
-        # Map transcripts to gene names, sum by gene
-        tpm_clean = merge_annotation(anno, tpm_raw)
-        count_clean = merge_annotation(anno, count_raw)
+        if self.block_size > 0:
+            return self._run_blocks()
+        tpm_raw, count_raw = self._load_raw()
+        if self.tree_merge:
+            # summed by gene per sample already
+            genes, tpm_clean, count_clean = (
+                tpm_raw.rows,
+                np.asarray(tpm_raw.values),
+                np.asarray(count_raw.values),
+            )
+        else:
+            # Map transcripts to gene names using the cached annotation index,
+            # sum tpms and counts by gene in one pass
+            genes, (tpm_clean, count_clean) = self._aggregator().collapse(
+                tpm_raw.rows, tpm_raw.values, count_raw.values
+            )
         # use avg tpm from all samples > 0.5 as cutoff
         # drop non-expressing genes
         keep = tpm_clean.mean(axis=1) > 0.5
+        genes = genes[keep]
         tpm_clean = tpm_clean[keep]
         count_clean = count_clean[keep]
+        samples = list(tpm_raw.columns)
+        # write matrix stores
+        self.output()["count_matrix"].write(count_clean, genes, samples, "gene_name")
+        self.output()["tpm_matrix"].write(tpm_clean, genes, samples, "gene_name")
+        if not self.write_csv:
+            return
         # write csvs
         with self.output()["count"].temporary_path() as out:
-            count_clean.to_csv(out, index=False)
+            matrix_frame(genes, count_clean, samples, "gene_name").to_csv(
+                out, index=False
+            )
         with self.output()["tpm"].temporary_path() as out:
-            tpm_clean.to_csv(out, index=False)
+            matrix_frame(genes, tpm_clean, samples, "gene_name").to_csv(
+                out, index=False
+            )
+
+    def _run_blocks(self):
+        """
+        Clean the matrices block_size samples at a time, in two passes over
+        the memory mapped inputs: the first sums tpms by gene to find the
+        expressed genes, the second sums both matrices by gene and writes
+        the expressed rows into memory mapped outputs
+        The csv files are then written from the outputs a block of rows at
+        a time
+        """
+        tpm_raw, count_raw = self._load_raw()
+        aggregator = self._aggregator()
+        samples = list(tpm_raw.columns)
+        blocks = sample_blocks(len(samples), self.block_size)
+
+        def collapse(block, *matrices):
+            values = [np.asarray(m.values[:, block]) for m in matrices]
+            if aggregator is None:
+                return tpm_raw.rows, values
+            return aggregator.collapse(tpm_raw.rows, *values)
+
+        # use avg tpm from all samples > 0.5 as cutoff
+        total = 0
+        for block in blocks:
+            genes, (tpm,) = collapse(block, tpm_raw)
+            total = total + tpm.sum(axis=1, dtype=np.float64)
+        keep = total / max(len(samples), 1) > 0.5
+        # drop non-expressing genes, writing one block of samples at a time
+        dtype = tpm_raw.values.dtype
+        with self.output()["count_matrix"].temporary_path() as count_path:
+            with self.output()["tpm_matrix"].temporary_path() as tpm_path:
+                count = create_matrix(
+                    count_path, genes[keep], samples, dtype, "gene_name"
+                )
+                tpm = create_matrix(tpm_path, genes[keep], samples, dtype, "gene_name")
+                for block in blocks:
+                    _, (tpm_block, count_block) = collapse(block, tpm_raw, count_raw)
+                    tpm[:, block] = tpm_block[keep]
+                    count[:, block] = count_block[keep]
+                for matrix in [count, tpm]:
+                    if isinstance(matrix, np.memmap):
+                        matrix.flush()
+                del count, tpm
+        if not self.write_csv:
+            return
+        # write csvs
+        for key in ["count", "tpm"]:
+            store = self.output()[key + "_matrix"].load()
+            block_rows = max(1, len(genes) * self.block_size // max(len(samples), 1))
+            with self.output()[key].temporary_path() as out:
+                store.to_csv(out, block_rows)
+
+
+def sample_blocks(n_samples, block_size):
+    """
+    Split the sample columns into consecutive blocks
+    :param n_samples: int
+    :param block_size: int, samples per block
+    :return: list of slices
+    """
+    # an empty cohort still gets one, empty, block
+    return [
+        slice(start, min(start + block_size, n_samples))
+        for start in range(0, max(n_samples, 1), block_size)
+    ]
@@ -0,0 +1,350 @@
+import json
+import logging
+import os
+import resource
+import tempfile
+import threading
+import time
+import pandas as pd
+from luigi import Event, Task
+
+logger = logging.getLogger("luigi-interface")
+
+SUMMARY_COLUMNS = [
+    "task",
+    "family",
+    "status",
+    "wall_s",
+    "cpu_s",
+    "peak_rss_mb",
+    "read_mb",
+    "written_mb",
+    "critical",
+]
+MB = 1 << 20
+# seconds between samples of the memory of a task's child processes
+SAMPLE_INTERVAL = 0.2
+
+
+def io_counters():
+    """
+    Bytes read and written by this process and its finished children
+    :return: tuple of ints, (0, 0) where /proc is not available
+    """
+    try:
+        with open("/proc/self/io") as file:
+            fields = dict(line.split(":") for line in file)
+    except OSError:
+        return 0, 0
+    return int(fields["rchar"]), int(fields["wchar"])
+
+
+def peak_rss():
+    """
+    Peak resident memory of this process or of its largest finished child,
+    since the process started
+    :return: int, bytes
+    """
+    usage = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # linux reports kilobytes
+    return usage * 1024
+
+
+def status_bytes(field, pid="self"):
+    """
+    A memory field of a process's /proc status, eg VmRSS or VmHWM
+    :param field: str, field name
+    :param pid: int or "self"
+    :return: int, bytes, 0 where the process or /proc is gone
+    """
+    try:
+        with open("/proc/{}/status".format(pid)) as file:
+            for line in file:
+                if line.startswith(field + ":"):
+                    # linux reports kilobytes
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def child_pids(pid):
+    """
+    Processes started by a process, directly or not
+    :param pid: int
+    :return: list of pids, empty where /proc does not list children
+    """
+    children = []
+    try:
+        threads = os.listdir("/proc/{}/task".format(pid))
+    except OSError:
+        return children
+    for thread in threads:
+        try:
+            with open("/proc/{}/task/{}/children".format(pid, thread)) as file:
+                children.extend(int(x) for x in file.read().split())
+        except OSError:
+            continue
+    return children + [x for child in children for x in child_pids(child)]
+
+
+def reset_peak_rss():
+    """
+    Reset this process's high-water mark of resident memory to its current
+    size, through /proc/self/clear_refs
+    :return: bool, False where linux does not allow it
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        return False
+    return True
+
+
+class PeakMemory:
+    """
+    Peak resident memory of this process and its children while a task runs
+
+    This process's high-water mark is reset when the task starts and read
+    when it ends. Its children, eg salmon, are sampled every interval
+    seconds while they run, and the peak of the ones waited for is taken
+    from getrusage when it grew during the task. Where /proc does not allow
+    the reset, the process's peak since it started is reported instead.
+
+    Example::
+
+        memory = PeakMemory().start()
+        task.run()
+        memory.stop()
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.children = 0
+        # peak of the tasks run inside this one, which reset the mark
+        self.nested = 0
+        self._stop = threading.Event()
+
+    def start(self):
+        self._reset = reset_peak_rss()
+        self._reaped = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        pid = os.getpid()
+        while True:
+            rss = sum(status_bytes("VmRSS", x) for x in child_pids(pid))
+            self.children = max(self.children, rss)
+            if self._stop.wait(self.interval):
+                return
+
+    def stop(self):
+        """
+        :return: int, bytes, the larger of this process's and its children's peak
+        """
+        self._stop.set()
+        self._thread.join()
+        own = status_bytes("VmHWM") if self._reset else 0
+        if not own:
+            own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        reaped = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        if reaped > self._reaped:
+            self.children = max(self.children, reaped * 1024)
+        return max(own, self.children, self.nested)
+
+
+def snapshot():
+    """
+    Clock, cpu and io counters of this process, children included
+    :return: dict
+    """
+    times = os.times()
+    read, written = io_counters()
+    return {
+        "wall": time.time(),
+        "cpu": times.user + times.system + times.children_user + times.children_system,
+        "read": read,
+        "written": written,
+    }
+
+
+class TaskProfiler:
+    """
+    Record wall time, cpu time, peak memory and io of every task run while
+    installed, through luigi's task events
+
+    Luigi runs tasks in forked worker processes when there are several
+    workers, so each finished task is appended to a spool file rather than
+    kept in memory. Peak memory is each task's own, measured by PeakMemory.
+
+    Example::
+
+        with TaskProfiler() as profiler:
+            build(tasks, workers=4)
+        profiler.write("trace.json")
+    """
+
+    def __init__(self):
+        fd, self.spool = tempfile.mkstemp(prefix="luigi-profile-", suffix=".jsonl")
+        os.close(fd)
+        self._started = {}
+        self._callbacks = {
+            Event.START: self._start,
+            Event.SUCCESS: self._success,
+            Event.FAILURE: self._failure,
+        }
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc):
+        self.uninstall()
+
+    def install(self):
+        for event, callback in self._callbacks.items():
+            Task.event_handler(event)(callback)
+
+    def uninstall(self):
+        for event, callback in self._callbacks.items():
+            Task._event_callbacks.get(Task, {}).get(event, set()).discard(callback)
+
+    def _start(self, task):
+        self._started[task.task_id] = snapshot(), PeakMemory().start()
+
+    def _success(self, task):
+        self._finish(task, "DONE")
+
+    def _failure(self, task, exception):
+        self._finish(task, "FAILED")
+
+    def _finish(self, task, status):
+        started = self._started.pop(task.task_id, None)
+        if started is None:
+            return
+        start, memory = started
+        end = snapshot()
+        peak = memory.stop()
+        # tasks run inside another, eg the samples of a batch
+        for _, outer in self._started.values():
+            outer.nested = max(outer.nested, peak)
+        record = {
+            "task": task.task_id,
+            "family": task.task_family,
+            "status": status,
+            "pid": os.getpid(),
+            "start": start["wall"],
+            "wall": end["wall"] - start["wall"],
+            "cpu": end["cpu"] - start["cpu"],
+            "peak_rss": peak,
+            "read": end["read"] - start["read"],
+            "written": end["written"] - start["written"],
+            "deps": [dep.task_id for dep in task.deps()],
+        }
+        with open(self.spool, "a") as file:
+            file.write(json.dumps(record) + "\n")
+
+    def records(self):
+        """
+        Tasks finished so far, in the order they finished
+        :return: list of dict
+        """
+        with open(self.spool) as file:
+            return [json.loads(line) for line in file]
+
+    def trace(self):
+        """
+        Chrome trace-event document of the run, one lane per worker process,
+        to open in chrome://tracing or ui.perfetto.dev
+        :return: dict
+        """
+        records = self.records()
+        origin = min((r["start"] for r in records), default=0)
+        events = [
+            {
+                "name": r["family"],
+                "cat": r["status"],
+                "ph": "X",
+                "ts": round((r["start"] - origin) * 1e6),
+                "dur": round(r["wall"] * 1e6),
+                "pid": 0,
+                "tid": r["pid"],
+                "args": {
+                    "task": r["task"],
+                    "cpu_s": r["cpu"],
+                    "peak_rss_mb": r["peak_rss"] / MB,
+                    "read_mb": r["read"] / MB,
+                    "written_mb": r["written"] / MB,
+                },
+            }
+            for r in records
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def summary(self):
+        """
+        One row per task, slowest first, flagging the tasks on the critical
+        path of the run
+        :return: pandas dataframe
+        """
+        records = self.records()
+        critical = set(critical_path(records))
+        table = pd.DataFrame(
+            [
+                [
+                    r["task"],
+                    r["family"],
+                    r["status"],
+                    r["wall"],
+                    r["cpu"],
+                    r["peak_rss"] / MB,
+                    r["read"] / MB,
+                    r["written"] / MB,
+                    r["task"] in critical,
+                ]
+                for r in records
+            ],
+            columns=SUMMARY_COLUMNS,
+        )
+        return table.sort_values("wall_s", ascending=False, ignore_index=True)
+
+    def write(self, path):
+        """
+        Write the chrome trace to path and the summary table next to it,
+        with a .tsv extension, then remove the spool file
+        :param path: path of the trace json
+        :return: summary dataframe
+        """
+        with open(path, "w") as file:
+            json.dump(self.trace(), file)
+        table = self.summary()
+        table.to_csv(os.path.splitext(path)[0] + ".tsv", sep="\t", index=False)
+        logger.info("Task profile:\n%s", table.drop(columns="task").to_string())
+        os.remove(self.spool)
+        return table
+
+
+def critical_path(records):
+    """
+    Chain of dependent tasks with the longest total wall time
+    Tasks that were complete before the run are not part of it
+    :param records: task records from TaskProfiler.records
+    :return: list of task ids, first to last
+    """
+    by_id = {r["task"]: r for r in records}
+    longest = {}
+
+    def chain(task):
+        if task not in longest:
+            deps = [chain(d) for d in by_id[task]["deps"] if d in by_id]
+            best = max(deps, key=lambda c: c[0], default=(0, []))
+            longest[task] = (best[0] + by_id[task]["wall"], best[1] + [task])
+        return longest[task]
+
+    return max((chain(t) for t in by_id), key=lambda c: c[0], default=(0, []))[1]
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from luigi import Event, Task
+from luigi.configuration import get_config
+from luigi.task import flatten
+from .manifest import cached_file_digest, file_digest, file_stat
+
+logger = logging.getLogger("luigi-interface")
+
+# provenance stores, keyed by process id so forked workers open their own
+_stores = {}
+# source digests, keyed by package folder
+_code_digests = {}
+
+
+class ProvenanceStore:
+    """
+    SQLite record of the signature each task was last completed with, and
+    of the content digest of each file it read, keyed by mtime and size so
+    an unchanged file is not hashed again
+
+    Example::
+
+        store = ProvenanceStore("data/provenance.sqlite")
+        store.digest("data/human/GRCh38.gencode.v27.transcripts.annot")
+        store.record(task.task_id, task.task_family, task.signature())
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # forked workers write concurrently, wait for each other's locks
+        self.connection = sqlite3.connect(path, timeout=60)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS signatures ("
+                "task_id TEXT PRIMARY KEY, family TEXT, signature TEXT, recorded REAL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                "path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, digest TEXT)"
+            )
+        self._digests = {}
+
+    def digest(self, path):
+        """
+        Content digest of a file, hashed again only when its mtime or size
+        changed since it was last hashed
+        Empty files, like success flags, have no content to tell them apart
+        and are fingerprinted by their mtime instead
+        :param path: path of the file
+        :return: str, "missing" if it does not exist
+        """
+        try:
+            stat = file_stat(path)
+        except FileNotFoundError:
+            return "missing"
+        if not stat["size"]:
+            return "empty:{}".format(stat["mtime"])
+        path = os.path.abspath(path)
+        key = (path, stat["mtime"], stat["size"])
+        if key not in self._digests:
+            row = self.connection.execute(
+                "SELECT digest FROM digests WHERE path = ? AND mtime = ? AND size = ?",
+                key,
+            ).fetchone()
+            if row is None:
+                row = (file_digest(path),)
+                with self.connection:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)",
+                        key + row,
+                    )
+            self._digests[key] = row[0]
+        return self._digests[key]
+
+    def signature(self, task_id):
+        """
+        Signature a task was last completed with
+        :param task_id: str
+        :return: str or None if never recorded
+        """
+        row = self.connection.execute(
+            "SELECT signature FROM signatures WHERE task_id = ?", (task_id,)
+        ).fetchone()
+        return row and row[0]
+
+    def record(self, task_id, family, signature):
+        """
+        Record the signature a task just completed with
+        :param task_id: str
+        :param family: str, task family
+        :param signature: str
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO signatures VALUES (?, ?, ?, ?)",
+                (task_id, family, signature, time.time()),
+            )
+
+
+def provenance_store():
+    """
+    The provenance store of this process
+    Set by the ``db`` entry of the ``[provenance]`` config section, without
+    which completeness is only the existence of outputs
+    :return: ProvenanceStore or None
+    """
+    path = get_config().get("provenance", "db", "")
+    if not path:
+        return None
+    pid = os.getpid()
+    if pid not in _stores or _stores[pid].path != path:
+        _stores.clear()
+        _stores[pid] = ProvenanceStore(path)
+    return _stores[pid]
+
+
+def code_digest(root=os.path.dirname(os.path.abspath(__file__))):
+    """
+    Digest of the source of every module of the package, so editing any
+    code a task runs, wherever it lives in the package, reruns it
+    Computed once per process, as the source does not change during a run
+    :param root: folder of the package
+    :return: str
+    """
+    if root not in _code_digests:
+        digest = hashlib.sha1()
+        paths = sorted(
+            os.path.join(folder, name)
+            for folder, _, names in os.walk(root)
+            for name in names
+            if name.endswith(".py")
+        )
+        for path in paths:
+            digest.update(os.path.relpath(path, root).encode("utf-8") + b"\0")
+            digest.update(cached_file_digest(path).encode("utf-8") + b"\0")
+        _code_digests[root] = digest.hexdigest()
+    return _code_digests[root]
+
+
+class Provenance:
+    """
+    Mixin making a task complete only when its outputs exist and were made
+    from the same parameters, input file contents and code as now
+
+    The signature hashes the significant parameters, the digests of every
+    input file and the source of the whole package. Tasks upstream of a
+    changed file keep their signature, so only the part of the graph that
+    depends on the change reruns; an input rewritten with the same content
+    reruns nothing. A task is also out of date while a provenance task it
+    requires is, since that one's rerun changes its inputs.
+
+    Example::
+
+        class CleanCounts(Provenance, Task):
+            ...
+
+    with, in ``luigi.cfg``::
+
+        [provenance]
+        db = data/provenance.sqlite
+    """
+
+    def provenance_inputs(self):
+        """
+        Files whose content the outputs depend on, by default every input
+        :return: list of paths
+        """
+        return [t.path for t in flatten(self.input()) if hasattr(t, "path")]
+
+    def signature(self):
+        """
+        :return: str, digest of parameters, inputs and code
+        """
+        store = provenance_store()
+        parts = {
+            "family": self.task_family,
+            "params": self.to_str_params(only_significant=True),
+            "inputs": {p: store.digest(p) for p in self.provenance_inputs()},
+            "code": code_digest(),
+        }
+        return hashlib.sha1(
+            json.dumps(parts, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def complete(self):
+        if not super().complete():
+            return False
+        store = provenance_store()
+        if store is None:
+            return True
+        # a step upstream that reruns changes this one's inputs after it
+        # was checked, so it is out of date as soon as one upstream is
+        upstream = [x for x in flatten(self.requires()) if isinstance(x, Provenance)]
+        if not all(x.complete() for x in upstream):
+            return False
+        if store.signature(self.task_id) == self.signature():
+            return True
+        logger.info("%s is out of date, its inputs or code changed", self.task_id)
+        return False
+
+
+@Task.event_handler(Event.SUCCESS)
+def _record(task):
+    if isinstance(task, Provenance):
+        store = provenance_store()
+        if store is not None:
+            store.record(task.task_id, task.task_family, task.signature())
@@ -1,14 +1,31 @@
-from luigi import ExternalTask, Parameter
+from luigi import ExternalTask, Parameter, Task, ListParameter, FloatParameter
+import logging
 import os
+import shutil
+import time
+from luigi.configuration import get_config
 from luigi.local_target import LocalTarget
+from .luigi.target import AtomicDirectoryTarget, ScannedLocalTarget
 from luigi.contrib.external_program import ExternalProgramTask
 from luigi.util import inherits
 from pathlib import Path
 from .index import Salmon, SalmonIndex
-from .luigi.task import Requires, Requirement
+from .index_cache import locked, lock_path, mark_used
+from .luigi.task import Requires, Requirement, CachedParams, core_resources
+from .luigi.task import run_nested
+from .luigi.executor import Submittable, executor_backend
+from .luigi.scan import directory_index
+from .cost import cost_model, record_runtime
 
+logger = logging.getLogger("luigi-interface")
 
-class FastqInput(ExternalTask):
+# staged samples record the scratch space they reserved in this file
+RESERVED = ".reserved"
+# salmon's output and errors, in the sample's logs folder next to its own log
+PROGRAM_LOG = "salmon_output.log"
+
+
+class FastqInput(CachedParams, ExternalTask):
     """
     Make sure sample sequence files exists
     """
@@ -28,23 +45,122 @@ class FastqInput(ExternalTask):
         :return: path
         """
         return os.path.join(
-                    str(self.fastq_root),
-                    str(self.file_id) + reads + str(self.fastq_suffix),
-                )
+            str(self.fastq_root),
+            str(self.file_id) + reads + str(self.fastq_suffix),
+        )
 
     def output(self):
         return {
-            "R1": LocalTarget(self._get_fastq_path(str(self.fastq_r1))),
-            "R2": LocalTarget(self._get_fastq_path(str(self.fastq_r2)))
+            "R1": ScannedLocalTarget(self._get_fastq_path(str(self.fastq_r1))),
+            "R2": ScannedLocalTarget(self._get_fastq_path(str(self.fastq_r2))),
         }
 
+    def size(self):
+        """
+        Size of the sample's sequence files, 0 for those not there yet
+        Read from the directory index, which lists the fastq folder with
+        its sizes once for all samples
+        :return: int, bytes
+        """
+        index = directory_index()
+        return sum(index.size(target.path) for target in self.output().values())
+
 
-@inherits(FastqInput, SalmonIndex)
-class SalmonQuant(ExternalProgramTask):
+@inherits(FastqInput)
+class StageFastq(CachedParams, Task):
+    """
+    Copy a sample's sequence files to local scratch ahead of quantification
+    Copies reserve their size in scratch_dir; samples that would exceed
+    scratch_budget_gb are linked to the shared files instead of copied,
+    rather than holding a worker until staged samples are removed
+    SalmonQuant removes the staged sample once it succeeds
+    Output the staged R1 and R2 files
+    """
+
+    # parameters
+    scratch_dir = Parameter(default="", significant=False)
+    scratch_budget_gb = FloatParameter(default=0, significant=False)
+    # requirements
+    requires = Requires()
+    fastq = Requirement(FastqInput)
+
+    @property
+    def resources(self):
+        # the [resources] staging entry sets how many copies run at once;
+        # luigi would run one at a time if it is not set, so then none is claimed
+        if not get_config().getint("resources", "staging", 0):
+            return {}
+        return {"staging": 1}
+
+    @property
+    def stage_dir(self):
+        return os.path.join(str(self.scratch_dir), str(self.file_id))
+
+    def output(self):
+        return {
+            reads: LocalTarget(
+                os.path.join(self.stage_dir, os.path.basename(target.path))
+            )
+            for reads, target in self.input()["fastq"].items()
+        }
+
+    def _reserve(self, size):
+        """
+        Reserve scratch space for the sample
+        :param size: int, bytes to copy
+        :return: bool, False if the budget has no room for the sample
+        """
+        budget = int(self.scratch_budget_gb * 1024**3)
+        with locked(os.path.join(str(self.scratch_dir), ".lock")):
+            if budget and scratch_usage(str(self.scratch_dir)) + size > budget:
+                return False
+            os.makedirs(self.stage_dir, exist_ok=True)
+            with open(os.path.join(self.stage_dir, RESERVED), "w") as file:
+                file.write(str(size))
+            return True
+
+    def run(self):
+        sources = {k: t.path for k, t in self.input()["fastq"].items()}
+        if self._reserve(sum(os.path.getsize(p) for p in sources.values())):
+            for reads, target in self.output().items():
+                with target.temporary_path() as tmp:
+                    shutil.copyfile(sources[reads], tmp)
+            return
+        logger.warning(
+            "No scratch space for %s, reading it from shared storage", self.file_id
+        )
+        for reads, target in self.output().items():
+            with target.temporary_path() as tmp:
+                os.symlink(os.path.abspath(sources[reads]), tmp)
+
+
+def scratch_usage(scratch_dir):
+    """
+    Scratch space reserved by the samples staged so far
+    :param scratch_dir: path of the scratch folder
+    :return: int, bytes
+    """
+    usage = 0
+    for name in os.listdir(scratch_dir):
+        try:
+            with open(os.path.join(scratch_dir, name, RESERVED)) as file:
+                usage += int(file.read() or 0)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    return usage
+
+
+@inherits(StageFastq, SalmonIndex)
+class SalmonQuant(CachedParams, Submittable, ExternalProgramTask):
     """
     Run the sample sequence quantification using Salmon
+    Locally or as a batch job, depending on the executor backend
+    With scratch_dir, read the sample from its local scratch copy and
+    remove the copy once done
     Outputs logs containing mapping stats and transcript counts/tpms
     Use require descriptors for composition
+    Its priority is its predicted runtime, so the longest samples start
+    first, and each local run is added to the runtime history
     """
 
     # constant
@@ -53,18 +169,58 @@ class SalmonQuant(ExternalProgramTask):
     flag = "__SUCCESS"
 
     # requirements
-    requires = Requires()
+    static_requires = Requires()
     fastq = Requirement(FastqInput)
     salmon = Requirement(Salmon)
     index = Requirement(SalmonIndex)
 
+    def requires(self):
+        requirements = self.static_requires()
+        if self.scratch_dir:
+            requirements["fastq"] = self.clone(StageFastq)
+        return requirements
+
+    @property
+    def resources(self):
+        return core_resources(self.n_threads)
+
+    def job_cores(self):
+        return self.n_threads
+
+    def predicted_seconds(self):
+        """
+        Runtime predicted from the size of the sample's fastq files,
+        whether or not it is already quantified
+        :return: float
+        """
+        return cost_model().predict(self.clone(FastqInput).size(), self.n_threads)
+
+    @property
+    def priority(self):
+        # the scheduler starts the highest priority first, longest job first
+        # keeps a large sample from starting last and stretching the run
+        if not hasattr(self, "_priority"):
+            self._priority = self.predicted_seconds()
+        return self._priority
+
+    # folder salmon writes to while running, renamed to the output folder
+    _write_dir = None
+
+    def program_log(self):
+        # written while salmon runs, for python -m RNA_seq.monitor to follow
+        if self._write_dir is None:
+            return None
+        return os.path.join(self._write_dir, "logs", PROGRAM_LOG)
+
     def output(self):
         """
-        The output is a folder, named by file_id.
+        The output is a folder, named by file_id, written atomically.
         Use flag file to mark complete
         :return: success flag file
         """
-        return LocalTarget(os.path.join(self.output_root, str(self.file_id), self.flag))
+        return ScannedLocalTarget(
+            os.path.join(self.output_root, str(self.file_id), self.flag)
+        )
 
     def program_args(self):
         return [
@@ -81,10 +237,125 @@ class SalmonQuant(ExternalProgramTask):
             "-2",
             self.input()["fastq"]["R2"].path,
             "-o",
-            os.path.dirname(self.output().path),
+            self._write_dir or os.path.dirname(self.output().path),
         ]
 
     def run(self):
-        super().run()
-        # mark complete
-        Path(self.output().path).touch()
+        index_dir = os.path.dirname(self.input()["index"].path)
+        # salmon writes a temporary folder, which becomes the output once
+        # complete, so a killed run leaves no partial output
+        out_dir = AtomicDirectoryTarget(os.path.dirname(self.output().path))
+        with out_dir.temporary_path() as self._write_dir:
+            try:
+                start = time.time()
+                if not self.index_cache:
+                    super().run()
+                else:
+                    # a shared lock keeps the cached index from being evicted
+                    with locked(lock_path(index_dir), shared=True):
+                        mark_used(index_dir)
+                        super().run()
+                # batch jobs also wait in the queue, which says nothing of salmon
+                if executor_backend() == "local":
+                    record_runtime(
+                        self.file_id,
+                        sum(
+                            os.path.getsize(target.path)
+                            for target in self.input()["fastq"].values()
+                        ),
+                        self.n_threads,
+                        time.time() - start,
+                    )
+                # mark complete
+                Path(self._write_dir, self.flag).touch()
+            finally:
+                self._write_dir = None
+        if self.scratch_dir:
+            # free the scratch space for the next samples
+            shutil.rmtree(os.path.dirname(self.input()["fastq"]["R1"].path))
+
+
+def warm_page_cache(folder):
+    """
+    Ask the kernel to read a folder's files into the page cache ahead of use
+    :param folder: path of the folder, eg a salmon index
+    """
+    for root, _, names in os.walk(folder):
+        for name in names:
+            fd = os.open(os.path.join(root, name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+
+@inherits(SalmonIndex)
+class SalmonQuantBatch(CachedParams, Task):
+    """
+    Quantify a batch of samples one after another under one task
+    Salmon reloads the index for every sample, so the index is pulled into
+    the page cache once up front and stays hot for the whole batch
+    Outputs the same per-sample folders and flags as SalmonQuant
+    With scratch_dir, each sample is staged just before it is quantified,
+    so the batch holds one sample in scratch at a time
+    Each sample fires its own task events, so it is profiled and recorded
+    as soon as it is done; a failed sample does not stop the others, and
+    fails the batch once they are done
+    Its priority is the predicted runtime of its samples
+    """
+
+    # parameters
+    file_ids = ListParameter()
+    fastq_r1 = Parameter()
+    fastq_r2 = Parameter()
+    fastq_suffix = Parameter()
+    scratch_dir = Parameter(default="", significant=False)
+    scratch_budget_gb = FloatParameter(default=0, significant=False)
+
+    def _sample_tasks(self):
+        return [self.clone(SalmonQuant, file_id=x) for x in self.file_ids]
+
+    @property
+    def resources(self):
+        return core_resources(self.n_threads)
+
+    def predicted_seconds(self):
+        """
+        Runtime predicted for the whole batch
+        :return: float
+        """
+        return sum(task.predicted_seconds() for task in self._sample_tasks())
+
+    @property
+    def priority(self):
+        if not hasattr(self, "_priority"):
+            self._priority = self.predicted_seconds()
+        return self._priority
+
+    def requires(self):
+        return {
+            "salmon": self.clone(Salmon),
+            "index": self.clone(SalmonIndex),
+            "fastq": {x: self.clone(FastqInput, file_id=x) for x in self.file_ids},
+        }
+
+    def output(self):
+        return {task.file_id: task.output() for task in self._sample_tasks()}
+
+    def run(self):
+        # batch jobs run elsewhere, with their own page cache
+        if hasattr(os, "posix_fadvise") and executor_backend() == "local":
+            warm_page_cache(os.path.dirname(self.input()["index"].path))
+        failed = None
+        for task in self._sample_tasks():
+            if task.complete():
+                continue
+            try:
+                if self.scratch_dir and not task.requires()["fastq"].complete():
+                    run_nested(task.requires()["fastq"])
+                run_nested(task)
+            except Exception as ex:
+                logger.error("Quantification of %s failed: %s", task.file_id, ex)
+                failed = failed or ex
+        if failed is not None:
+            raise failed
@@ -0,0 +1,231 @@
+import json
+import struct
+import numpy as np
+import pandas as pd
+from luigi import format
+from .luigi.target import SuffixPreservingLocalTarget
+from .matrix import matrix_frame
+
+# file layout: magic, header length, json header, padding, column-major values
+MAGIC = b"RNACMAT1"
+ALIGNMENT = 64
+
+
+def _read_header(path):
+    """
+    Read the header of a matrix store file
+    :param path: path of the store
+    :return: tuple of header dict and offset of the values
+    """
+    with open(path, "rb") as file:
+        magic = file.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError("{} is not a matrix store".format(path))
+        (size,) = struct.unpack("<Q", file.read(8))
+        header = json.loads(file.read(size).decode("utf-8"))
+    return header, _data_offset(size)
+
+
+def _data_offset(header_size):
+    """
+    Offset of the values, aligned so the memory map starts on a boundary
+    :param header_size: int, bytes of json header
+    :return: int
+    """
+    offset = len(MAGIC) + 8 + header_size
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def create_matrix(path, rows, columns, dtype=np.float64, row_name="transcript_ID"):
+    """
+    Create a matrix store and return it memory mapped for writing
+    Columns can then be filled one block at a time
+    :param path: path of the store to create
+    :param rows: row names, eg transcript IDs or gene names
+    :param columns: column names, eg sample IDs
+    :param dtype: numpy dtype of the values
+    :param row_name: str, name of the row index
+    :return: writable numpy memmap of shape (rows, columns)
+    """
+    rows = [str(x) for x in rows]
+    columns = [str(x) for x in columns]
+    dtype = np.dtype(dtype)
+    header = json.dumps(
+        {
+            "dtype": dtype.str,
+            "shape": [len(rows), len(columns)],
+            "row_name": row_name,
+            "rows": rows,
+            "columns": columns,
+        }
+    ).encode("utf-8")
+    offset = _data_offset(len(header))
+    with open(path, "wb") as file:
+        file.write(MAGIC)
+        file.write(struct.pack("<Q", len(header)))
+        file.write(header)
+        file.write(b"\0" * (offset - file.tell()))
+        file.truncate(offset + dtype.itemsize * len(rows) * len(columns))
+    if not rows or not columns:
+        return np.empty((len(rows), len(columns)), dtype=dtype)
+    return np.memmap(
+        path,
+        dtype=dtype,
+        mode="r+",
+        offset=offset,
+        shape=(len(rows), len(columns)),
+        order="F",
+    )
+
+
+def write_matrix(path, values, rows, columns, row_name="transcript_ID"):
+    """
+    Write a feature x sample array as a matrix store
+    :param path: path of the store
+    :param values: 2-d numpy array
+    :param rows: row names
+    :param columns: column names
+    :param row_name: str, name of the row index
+    """
+    out = create_matrix(path, rows, columns, values.dtype, row_name)
+    out[:] = values
+    if isinstance(out, np.memmap):
+        out.flush()
+    del out
+
+
+class MatrixStore:
+    """
+    Read-only, memory mapped view of a matrix store
+
+    Values are stored column by column, so fetching one sample reads one
+    contiguous block and fetching one gene touches one value per sample.
+
+    Example::
+
+        store = MatrixStore("data/summary/CleanCounts_tpm.cmat")
+        store.row("GAPDH")
+        store.column("sample01")
+    """
+
+    def __init__(self, path):
+        self.path = path
+        header, offset = _read_header(path)
+        self.row_name = header["row_name"]
+        self.rows = pd.Index(header["rows"], name=self.row_name)
+        self.columns = pd.Index(header["columns"])
+        shape = tuple(header["shape"])
+        if 0 in shape:
+            self.values = np.empty(shape, dtype=header["dtype"])
+        else:
+            self.values = np.memmap(
+                path,
+                dtype=header["dtype"],
+                mode="r",
+                offset=offset,
+                shape=shape,
+                order="F",
+            )
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def row(self, name):
+        """
+        Values of one gene or transcript across all samples
+        :param name: str, row name
+        :return: pandas series indexed by sample
+        """
+        return pd.Series(
+            np.array(self.values[self.rows.get_loc(name), :]),
+            index=self.columns,
+            name=name,
+        )
+
+    def column(self, name):
+        """
+        Values of one sample across all genes or transcripts
+        :param name: str, column name
+        :return: pandas series indexed by row name
+        """
+        return pd.Series(
+            np.array(self.values[:, self.columns.get_loc(name)]),
+            index=self.rows,
+            name=name,
+        )
+
+    def select(self, rows=None, columns=None):
+        """
+        Load a block of the matrix
+        :param rows: list of row names, all rows if None
+        :param columns: list of column names, all columns if None
+        :return: pandas dataframe indexed by row name
+        """
+        row_idx = slice(None) if rows is None else self.rows.get_indexer(rows)
+        col_idx = slice(None) if columns is None else self.columns.get_indexer(columns)
+        for idx, names in [(row_idx, rows), (col_idx, columns)]:
+            if names is not None and (idx < 0).any():
+                missing = [n for n, i in zip(names, idx) if i < 0]
+                raise KeyError("Not in matrix store: {}".format(missing))
+        values = self.values[row_idx, :][:, col_idx]
+        return pd.DataFrame(
+            np.array(values),
+            index=self.rows[row_idx],
+            columns=self.columns[col_idx],
+        )
+
+    def to_frame(self):
+        """
+        Load the whole matrix as a table with a leading name column,
+        the same layout as the csv outputs
+        :return: pandas dataframe
+        """
+        return matrix_frame(
+            self.rows, np.array(self.values), list(self.columns), self.row_name
+        )
+
+    def to_csv(self, path, block_rows=10000):
+        """
+        Write the matrix as a csv file in the layout of to_frame, a block of
+        rows at a time so the whole matrix is never loaded
+        :param path: path of the csv file
+        :param block_rows: int, rows loaded at once
+        """
+        with open(path, "w", newline="") as file:
+            for start in range(0, max(len(self.rows), 1), block_rows):
+                stop = start + block_rows
+                matrix_frame(
+                    self.rows[start:stop],
+                    np.array(self.values[start:stop]),
+                    list(self.columns),
+                    self.row_name,
+                ).to_csv(file, index=False, header=start == 0)
+
+
+class MatrixTarget(SuffixPreservingLocalTarget):
+    """
+    Atomic local target holding a matrix store
+    """
+
+    def __init__(self, path=None, **kwargs):
+        kwargs.setdefault("format", format.Nop)
+        super().__init__(path, **kwargs)
+
+    def write(self, values, rows, columns, row_name="transcript_ID"):
+        """
+        Atomically write a feature x sample array
+        :param values: 2-d numpy array
+        :param rows: row names
+        :param columns: column names
+        :param row_name: str, name of the row index
+        """
+        with self.temporary_path() as tmp:
+            write_matrix(tmp, values, rows, columns, row_name)
+
+    def load(self):
+        """
+        Memory map the matrix store
+        :return: MatrixStore
+        """
+        return MatrixStore(self.path)
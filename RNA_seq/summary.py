@@ -1,19 +1,99 @@
-from luigi import Parameter, Task
+from luigi import Parameter, Task, IntParameter, BoolParameter, FloatParameter
 import os
-from luigi.contrib.external_program import ExternalProgramTask
+import re
+import hashlib
+import json
+import logging
+import pandas as pd
+import numpy as np
+from luigi.event import Event
+from luigi.task import flatten
 from luigi.util import inherits
-from .quant import SalmonQuant
+from .quant import SalmonQuant, SalmonQuantBatch
 from .luigi.target import SuffixPreservingLocalTarget
-import pandas as pd
-from .luigi.task import TargetOutput
+from .luigi.task import TargetOutput, core_resources
 from .index import SalmonIndex
+from .matrix import build_quant_matrix, matrix_frame
+from .store import MatrixStore, MatrixTarget
+from .manifest import SampleManifest, file_stat
+from .mapping import SUMMARY_COLUMNS, sample_source, summarize_rows
+from .provenance import Provenance
+
+logger = logging.getLogger("luigi-interface")
+
+# output names, tagged with the sample set in incremental mode
+COHORT_PATTERN = "{task.__class__.__name__}{task.cohort_tag}"
+
+
+class Incremental:
+    """
+    Mixin for tasks summarizing the whole cohort
+    In incremental mode the output names carry a digest of the sample IDs,
+    so appending samples to the ID file makes the outputs out of date.
+    The outputs are also out of date when an incremental task they are made
+    from is, or was rebuilt after them, eg once a sample is quantified again.
+    The outputs of other sample sets are removed once the task succeeds.
+    """
+
+    incremental = BoolParameter(default=False)
+
+    @property
+    def cohort_tag(self):
+        if not self.incremental:
+            return ""
+        return "_" + ids_digest(get_file_ids(str(self.ID_path)))
+
+    def complete(self):
+        if not super().complete():
+            return False
+        if not self.incremental:
+            return True
+        upstream = [x for x in flatten(self.requires()) if isinstance(x, Incremental)]
+        if not all(x.complete() for x in upstream):
+            return False
+        built = min(os.path.getmtime(x.path) for x in flatten(self.output()))
+        return all(
+            os.path.getmtime(x.path) <= built
+            for task in upstream
+            for x in flatten(task.output())
+        )
+
+    def remove_superseded(self):
+        """
+        Remove the outputs written for other sample sets
+        :return: list of removed paths
+        """
+        removed = []
+        tag = self.cohort_tag
+        for target in flatten(self.output()):
+            folder, name = os.path.split(target.path)
+            prefix, ext = name.split(tag, 1)
+            pattern = re.compile(
+                re.escape(prefix) + "_[0-9a-f]{10}" + re.escape(ext) + "$"
+            )
+            for other in os.listdir(folder or "."):
+                path = os.path.join(folder, other)
+                if other != name and pattern.match(other) and os.path.isfile(path):
+                    os.remove(path)
+                    removed.append(path)
+        return removed
+
+
+@Task.event_handler(Event.SUCCESS)
+def _remove_superseded(task):
+    if isinstance(task, Incremental) and task.incremental:
+        for path in task.remove_superseded():
+            logger.info("Removed %s, superseded by a new sample set", path)
 
 
 @inherits(SalmonIndex)
-class SummarizeMapping(ExternalProgramTask):
+class SummarizeMapping(Provenance, Incremental, Task):
     """
-    Find mapped reads and rates from sample quantification logs
-    Use a perl script
+    Find mapped reads and rates from sample quantification outputs
+    Read salmon's meta_info.json, falling back to the quant log,
+    for n_workers samples at a time
+    In incremental mode only new or changed samples are read, the rows of
+    the others are reused from the previous run
     Require all sample quantification
     Output a table text file containing the mapping stats for all samples
     Use targetoutput descriptor for composition
@@ -21,104 +101,420 @@ class SummarizeMapping(ExternalProgramTask):
 
     # constant
     output_root = os.path.join("data", "summary")
-    perl_script = os.path.join("data", "scripts", "get_salmon_summary.pl")
     input_root = SalmonQuant.output_root
     # parameters
     ID_path = Parameter()
     fastq_r1 = Parameter()
     fastq_r2 = Parameter()
     fastq_suffix = Parameter()
+    # how the work is spread does not change the summaries, so a run with
+    # other cores, threads or batches finds them complete
+    n_workers = IntParameter(default=1, significant=False)
+    batch_size = IntParameter(default=0, significant=False)
+    n_threads = IntParameter(significant=False)
+    scratch_dir = Parameter(default="", significant=False)
+    scratch_budget_gb = FloatParameter(default=0, significant=False)
 
     out_file = TargetOutput(
-        root_dir=output_root, target_class=SuffixPreservingLocalTarget
+        file_pattern=COHORT_PATTERN,
+        root_dir=output_root,
+        target_class=SuffixPreservingLocalTarget,
     )
 
+    @property
+    def resources(self):
+        return core_resources(self.n_workers)
+
     def output(self):
         return self.out_file()
 
     # requirements
     def requires(self):
-        ids = get_file_ids(str(self.ID_path))
-        return {x: self.clone(SalmonQuant, file_id=x) for x in ids}
-
-    def program_args(self):
-        return [
-            "perl",
-            self.perl_script,
-            self.ID_path,
-            self.input_root,
-            self.temp_output_path,
-        ]
+        return require_quant(self)
+
+    def complete(self):
+        if not super().complete():
+            return False
+        if not self.incremental:
+            return True
+        # a sample quantified again under the same sample set
+        sample_dirs = self._get_sample_dirs()
+        return not manifest_changed(
+            self._cache_paths()["manifest"],
+            {x: sample_source(sample_dirs[x]) for x in sample_dirs},
+        )
+
+    def _get_sample_dirs(self):
+        """
+        Get the quantification output folder of each sample, in ID order
+        :return: dict of file id to path
+        """
+        flags = quant_flags(self.input())
+        return {
+            x: os.path.dirname(flags[x].path) for x in get_file_ids(str(self.ID_path))
+        }
 
     def run(self):
-        with self.output().temporary_path() as self.temp_output_path:
-            super().run()
+        sample_dirs = self._get_sample_dirs()
+        if self.incremental:
+            rows = self._update_cache(sample_dirs)
+        else:
+            rows = summarize_rows(sample_dirs, n_workers=self.n_workers)
+        table = pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+        with self.output().temporary_path() as out:
+            table.to_csv(out, sep="\t", index=False)
+
+    def _cache_paths(self):
+        """
+        Get the paths of the per-sample manifest and cached rows,
+        which keep the same names whatever the sample set
+        :return: dict of paths
+        """
+        root = os.path.join(self.output_root, self.__class__.__name__ + "_cache")
+        return {
+            "manifest": os.path.join(root, "manifest.json"),
+            "rows": os.path.join(root, "rows.json"),
+        }
+
+    def _update_cache(self, sample_dirs):
+        """
+        Read only new or changed samples, reuse the cached rows of the
+        others and drop samples no longer in the ID file
+        :param sample_dirs: dict of file id to quantification output folder
+        :return: list of row dicts, in ID order
+        """
+        cache = self._cache_paths()
+        os.makedirs(os.path.dirname(cache["manifest"]), exist_ok=True)
+        manifest = SampleManifest.load(cache["manifest"])
+        cached = {}
+        if os.path.exists(cache["rows"]) and os.path.exists(cache["manifest"]):
+            with open(cache["rows"], "r") as file:
+                cached = json.load(file)
+        sources = {x: sample_source(path) for x, path in sample_dirs.items()}
+        stale = [
+            x
+            for x in sample_dirs
+            if x not in cached
+            or not os.path.exists(sources[x])
+            or manifest.changed(x, sources[x])
+        ]
+        fresh = summarize_rows(
+            {x: sample_dirs[x] for x in stale}, n_workers=self.n_workers
+        )
+        cached.update(zip(stale, fresh))
+        rows = [cached[x] for x in sample_dirs]
+        logger.info("Incremental summary: %d of %d samples read", len(stale), len(rows))
+
+        for x in stale:
+            manifest.record(x, sources[x])
+        manifest.retain(sample_dirs)
+        with SuffixPreservingLocalTarget(cache["rows"]).open("w") as file:
+            json.dump(dict(zip(sample_dirs, rows)), file, indent=1)
+        manifest.save()
+        return rows
 
 
 @inherits(SummarizeMapping)
-class SummarizeCounts(Task):
+class SummarizeCounts(Provenance, Incremental, Task):
     """
     Find transcript counts and tpms from sample quantification tables
+    Parse the tables across n_workers processes into preallocated arrays
+    In incremental mode only new or changed samples are parsed and merged
+    with the matrices cached from the previous run
     Require all sample quantification
-    Output two csv files containing the transcript counts and tpms for all samples
+    Output two matrix stores and, unless write_csv is off, two csv files
+    containing the transcript counts and tpms for all samples
     Use targetoutput descriptor for composition
     """
 
     # constant
     output_root = SummarizeMapping.output_root
     input_root = SalmonQuant.output_root
+    # parameters
+    float32 = BoolParameter(default=False)
+    write_csv = BoolParameter(default=True)
 
     # outputs
     count_out = TargetOutput(
-        root_dir=output_root, ext="_count.csv", target_class=SuffixPreservingLocalTarget
+        file_pattern=COHORT_PATTERN,
+        root_dir=output_root,
+        ext="_count.csv",
+        target_class=SuffixPreservingLocalTarget,
     )
     tpm_out = TargetOutput(
-        root_dir=output_root, ext="_tpm.csv", target_class=SuffixPreservingLocalTarget
+        file_pattern=COHORT_PATTERN,
+        root_dir=output_root,
+        ext="_tpm.csv",
+        target_class=SuffixPreservingLocalTarget,
+    )
+    count_matrix_out = TargetOutput(
+        file_pattern=COHORT_PATTERN,
+        root_dir=output_root,
+        ext="_count.cmat",
+        target_class=MatrixTarget,
     )
+    tpm_matrix_out = TargetOutput(
+        file_pattern=COHORT_PATTERN,
+        root_dir=output_root,
+        ext="_tpm.cmat",
+        target_class=MatrixTarget,
+    )
+
+    @property
+    def resources(self):
+        return core_resources(self.n_workers)
 
     def output(self):
-        return {"count": self.count_out(), "tpm": self.tpm_out()}
+        outputs = {
+            "count_matrix": self.count_matrix_out(),
+            "tpm_matrix": self.tpm_matrix_out(),
+        }
+        if self.write_csv:
+            outputs.update({"count": self.count_out(), "tpm": self.tpm_out()})
+        return outputs
 
     # requirements
     def requires(self):
-        ids = get_file_ids(str(self.ID_path))
-        return {x: self.clone(SalmonQuant, file_id=x) for x in ids}
+        return require_quant(self)
+
+    def complete(self):
+        if not super().complete():
+            return False
+        if not self.incremental:
+            return True
+        # a sample quantified again under the same sample set
+        flags = quant_flags(self.input())
+        return not manifest_changed(
+            self._cache_paths()["manifest"],
+            {
+                x: self._get_sample_quant(flags[x])
+                for x in get_file_ids(str(self.ID_path))
+            },
+        )
 
-    def _get_sample_quant(self, x):
+    def _get_sample_quant(self, flag):
         """
         Get the path for each sample's count tables to read
-        :param x: str, file_id
+        :param flag: the sample's quantification success flag target
         :return: path
         """
-        return os.path.join(os.path.dirname(self.input()[x].path), "quant.sf")
+        return os.path.join(os.path.dirname(flag.path), "quant.sf")
 
     def run(self):
         # Read in all file ids
         ids = get_file_ids(str(self.ID_path))
-        # Get the framework from the first table
-        with open(self._get_sample_quant(ids[0]), "r") as file:
-            df = pd.read_table(file)
-
-        counts = df[["Name", "NumReads"]].rename(
-            columns={"Name": "transcript_ID", "NumReads": ids[0]}
-        )
-        tpm = df[["Name", "TPM"]].rename(
-            columns={"Name": "transcript_ID", "TPM": ids[0]}
-        )
-        # loop through the rest of the files
-        for x in ids[1:]:
-            with open(self._get_sample_quant(x)) as file:
-                df = pd.read_table(file)
-            counts[x] = df["NumReads"]
-            tpm[x] = df["TPM"]
+        flags = quant_flags(self.input())
+        paths = [self._get_sample_quant(flags[x]) for x in ids]
+        dtype = np.float32 if self.float32 else np.float64
+        if self.incremental:
+            transcripts, counts, tpm = self._update_cache(ids, paths, dtype)
+        else:
+            # Parse all tables straight into transcript x sample arrays
+            transcripts, counts, tpm = build_quant_matrix(
+                paths, n_workers=self.n_workers, dtype=dtype
+            )
+        # write matrix stores
+        self.output()["count_matrix"].write(counts, transcripts, ids)
+        self.output()["tpm_matrix"].write(tpm, transcripts, ids)
+        if not self.write_csv:
+            return
         # write csv files
         with self.output()["count"].temporary_path() as count_out:
-            counts.to_csv(count_out, index=False)
+            matrix_frame(transcripts, counts, ids).to_csv(count_out, index=False)
         with self.output()["tpm"].temporary_path() as tpm_out:
-            tpm.to_csv(tpm_out, index=False)
+            matrix_frame(transcripts, tpm, ids).to_csv(tpm_out, index=False)
+
+    def _cache_paths(self):
+        """
+        Get the paths of the per-sample manifest and cached matrices,
+        which keep the same names whatever the sample set
+        :return: dict of paths
+        """
+        root = os.path.join(self.output_root, self.__class__.__name__ + "_cache")
+        return {
+            "manifest": os.path.join(root, "manifest.json"),
+            "count": os.path.join(root, "count.cmat"),
+            "tpm": os.path.join(root, "tpm.cmat"),
+        }
+
+    def _load_cache(self, cache, dtype):
+        """
+        Open the matrices cached by the previous incremental run
+        :param cache: dict of cache paths
+        :param dtype: numpy dtype the matrices must have
+        :return: tuple of count and tpm MatrixStore, or None if unusable
+        """
+        if not all(os.path.exists(cache[k]) for k in ["manifest", "count", "tpm"]):
+            return None
+        stores = MatrixStore(cache["count"]), MatrixStore(cache["tpm"])
+        if any(store.values.dtype != dtype for store in stores):
+            return None
+        return stores
+
+    def _update_cache(self, ids, paths, dtype):
+        """
+        Parse only new or changed samples, reuse the cached columns of the
+        others and drop samples no longer in the ID file
+        :param ids: list of file ids
+        :param paths: list of quant.sf paths
+        :param dtype: numpy dtype of the arrays
+        :return: tuple of transcript index, counts array and tpm array
+        """
+        cache = self._cache_paths()
+        os.makedirs(os.path.dirname(cache["manifest"]), exist_ok=True)
+        manifest = SampleManifest.load(cache["manifest"])
+        cached = self._load_cache(cache, dtype)
+        stale = [
+            (x, path)
+            for x, path in zip(ids, paths)
+            if cached is None or x not in cached[0].columns or manifest.changed(x, path)
+        ]
+        if stale:
+            transcripts, new_counts, new_tpm = build_quant_matrix(
+                [path for _, path in stale], n_workers=self.n_workers, dtype=dtype
+            )
+            if cached is not None and not transcripts.equals(cached[0].rows):
+                # a new transcriptome invalidates every cached column
+                cached = None
+                stale = list(zip(ids, paths))
+                transcripts, new_counts, new_tpm = build_quant_matrix(
+                    paths, n_workers=self.n_workers, dtype=dtype
+                )
+        else:
+            transcripts = cached[0].rows
+        fresh = {x: i for i, (x, _) in enumerate(stale)}
+
+        counts = np.empty((len(transcripts), len(ids)), dtype=dtype, order="F")
+        tpm = np.empty_like(counts)
+        for i, x in enumerate(ids):
+            if x in fresh:
+                counts[:, i] = new_counts[:, fresh[x]]
+                tpm[:, i] = new_tpm[:, fresh[x]]
+            else:
+                counts[:, i] = cached[0].values[:, cached[0].columns.get_loc(x)]
+                tpm[:, i] = cached[1].values[:, cached[1].columns.get_loc(x)]
+        cached = None
+        logger.info(
+            "Incremental summary: %d of %d samples parsed", len(fresh), len(ids)
+        )
+
+        for x, path in stale:
+            manifest.record(x, path)
+        manifest.retain(ids)
+        MatrixTarget(cache["count"]).write(counts, transcripts, ids)
+        MatrixTarget(cache["tpm"]).write(tpm, transcripts, ids)
+        manifest.save()
+        return transcripts, counts, tpm
+
+
+def require_quant(task):
+    """
+    Quantification of every sample in the ID file, one task per sample or,
+    with batch_size, one task per batch of samples
+    Cloned once per task for as long as the ID file does not change
+    :param task: task with ID_path and batch_size parameters
+    :return: dict of requirements
+    """
+    ids = get_file_ids(str(task.ID_path))
+    cached = task.__dict__.get("_quant_requirements")
+    if cached and cached[0] is ids:
+        return cached[1]
+    if not task.batch_size:
+        requirements = {x: task.clone(SalmonQuant, file_id=x) for x in ids}
+    else:
+        size = task.batch_size
+        requirements = {
+            "__batch_{}".format(i // size): task.clone(
+                SalmonQuantBatch, file_ids=ids[i : i + size]
+            )
+            for i in range(0, len(ids), size)
+        }
+    task._quant_requirements = (ids, requirements)
+    return requirements
+
+
+def require_sample_quant(task, file_id):
+    """
+    Quantification of one sample: its own task or, with batch_size, the
+    batch it is quantified in, the same task require_quant gives
+    :param task: task with ID_path and batch_size parameters
+    :param file_id: str, sample ID
+    :return: SalmonQuant or SalmonQuantBatch
+    """
+    if not task.batch_size:
+        return task.clone(SalmonQuant, file_id=file_id)
+    ids = get_file_ids(str(task.ID_path))
+    size = task.batch_size
+    start = size * (_positions(ids)[file_id] // size)
+    return task.clone(SalmonQuantBatch, file_ids=ids[start : start + size])
+
+
+# position of each ID in the last ID list looked up
+_position_cache = {}
+
+
+def _positions(ids):
+    if _position_cache.get("ids") is not ids:
+        _position_cache.update(ids=ids, positions={x: i for i, x in enumerate(ids)})
+    return _position_cache["positions"]
+
+
+def manifest_changed(manifest_path, paths):
+    """
+    Whether any sample's file differs from the one recorded in a manifest
+    :param manifest_path: path of the manifest json
+    :param paths: dict of file id to the path of the sample's file
+    :return: bool, True if a file is missing too
+    """
+    manifest = SampleManifest.load(manifest_path)
+    try:
+        return any(manifest.changed(x, path) for x, path in paths.items())
+    except FileNotFoundError:
+        return True
+
+
+def quant_flags(inputs):
+    """
+    Success flag of each sample, whether quantified alone or in batches
+    :param inputs: task.input() of a task requiring require_quant
+    :return: dict of file id to flag target
+    """
+    flags = {}
+    for key, value in inputs.items():
+        if isinstance(value, dict):
+            flags.update(value)
+        else:
+            flags[key] = value
+    return flags
+
+
+def ids_digest(ids):
+    """
+    Short digest identifying a set of sample IDs
+    :param ids: list of file ids
+    :return: str
+    """
+    return hashlib.sha1("\n".join(ids).encode("utf-8")).hexdigest()[:10]
+
+
+# parsed ID files, keyed by path, mtime and size
+_file_ids = {}
 
 
 def get_file_ids(id_text_file):
-    with open(id_text_file, "r") as file:
-        ids = file.read().splitlines()
-    return ids
+    """
+    Sample IDs listed in a file, one per line
+    The file is read again only when its mtime or size changes
+    :param id_text_file: path of the ID file
+    :return: tuple of file ids
+    """
+    stat = file_stat(id_text_file)
+    key = (os.path.abspath(id_text_file), stat["mtime"], stat["size"])
+    if key not in _file_ids:
+        with open(id_text_file, "r") as file:
+            ids = tuple(file.read().splitlines())
+        # keep only the latest version of each file
+        for stale in [k for k in _file_ids if k[0] == key[0]]:
+            del _file_ids[stale]
+        _file_ids[key] = ids
+    return _file_ids[key]
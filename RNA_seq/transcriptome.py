@@ -0,0 +1,197 @@
+import gzip
+import queue
+import re
+import threading
+from luigi import ExternalTask, Parameter, Task, LocalTarget, format
+from .luigi.target import SuffixPreservingLocalTarget
+
+# header fields kept in the annotation, by position in a GENCODE header
+ANNOTATION_FIELDS = [
+    ("transcript_ID", 0),
+    ("gene_ID", 1),
+    ("transcript_name", 4),
+    ("gene_name", 5),
+    ("transcript_length", 6),
+    ("transcript_type", 7),
+]
+HEADER = re.compile(rb"^>.*$", re.MULTILINE)
+CHUNK_SIZE = 1 << 24
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE, prefetch=4):
+    """
+    Yield decompressed chunks of a plain or gzipped file
+    A background thread reads and decompresses ahead while the caller
+    parses, zlib releases the GIL so the two overlap
+    :param path: path of the file, gzipped if it ends with .gz
+    :param chunk_size: int, bytes per chunk
+    :param prefetch: int, number of chunks read ahead
+    :return: generator of bytes
+    """
+    chunks = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def reader():
+        opener = gzip.open if str(path).endswith(".gz") else open
+        try:
+            with opener(path, "rb") as file:
+                while not stop.is_set():
+                    chunk = file.read(chunk_size)
+                    _put(chunk)
+                    if not chunk:
+                        return
+        except Exception as e:
+            _put(e)
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        stop.set()
+        thread.join()
+
+
+def annotation_line(header):
+    """
+    Turn a GENCODE fasta header into an annotation row
+    :param header: bytes, header line without the leading >
+    :return: bytes, tab separated annotation line
+    """
+    fields = header.split(b"|")
+    if len(fields) < 8:
+        raise ValueError(
+            "Not a GENCODE transcript header: >{}".format(header.decode("utf-8"))
+        )
+    return b"\t".join(fields[i] for _, i in ANNOTATION_FIELDS) + b"\n"
+
+
+def format_transcriptome(
+    gencode_path, fasta_file, annotation_file, chunk_size=CHUNK_SIZE
+):
+    """
+    Stream a GENCODE transcript fasta, writing a copy with headers cut to
+    the transcript ID plus an annotation table, in one pass and constant memory
+    :param gencode_path: path of the GENCODE fasta, optionally gzipped
+    :param fasta_file: binary file object for the formatted fasta
+    :param annotation_file: binary file object for the annotation table
+    :param chunk_size: int, bytes decompressed at a time
+    """
+    annotation_file.write(
+        "\t".join(name for name, _ in ANNOTATION_FIELDS).encode("utf-8") + b"\n"
+    )
+    rest = b""
+    for chunk in read_chunks(gencode_path, chunk_size):
+        block = rest + chunk
+        end = block.rfind(b"\n") + 1
+        rest = block[end:]
+        _format_block(block[:end], fasta_file, annotation_file)
+    if rest:
+        _format_block(rest + b"\n", fasta_file, annotation_file)
+
+
+def _format_block(block, fasta_file, annotation_file):
+    """
+    Format a block of whole lines, copying sequence lines as they are
+    :param block: bytes ending with a newline
+    :param fasta_file: binary file object for the formatted fasta
+    :param annotation_file: binary file object for the annotation table
+    """
+    start = 0
+    for match in HEADER.finditer(block):
+        fasta_file.write(block[start : match.start()])
+        header = match.group()[1:].rstrip(b"\r")
+        fasta_file.write(b">" + header.split(b"|", 1)[0])
+        annotation_file.write(annotation_line(header))
+        start = match.end()
+    fasta_file.write(block[start:])
+
+
+class GencodeFASTA(ExternalTask):
+    """
+    Make sure the GENCODE transcript fasta (.fa or .fa.gz) exists
+    """
+
+    gencode_path = Parameter()
+
+    def output(self):
+        return LocalTarget(str(self.gencode_path), format=format.Nop)
+
+
+class FormatTranscriptome(Task):
+    """
+    Format a GENCODE transcript fasta for salmon
+    Output the fasta with transcript IDs as headers and the annotation
+    table mapping transcript IDs to genes, both written atomically
+    """
+
+    gencode_path = Parameter()
+    transcriptome = Parameter()
+    annotation_path = Parameter()
+
+    def requires(self):
+        return self.clone(GencodeFASTA)
+
+    def output(self):
+        return {
+            "fasta": SuffixPreservingLocalTarget(
+                str(self.transcriptome), format=format.Nop
+            ),
+            "annotation": SuffixPreservingLocalTarget(
+                str(self.annotation_path), format=format.Nop
+            ),
+        }
+
+    def run(self):
+        with self.output()["fasta"].open("w") as fasta_file:
+            with self.output()["annotation"].open("w") as annotation_file:
+                format_transcriptome(self.input().path, fasta_file, annotation_file)
+
+
+class FormattedInput(Task):
+    """
+    Base for the formatted transcriptome and annotation inputs
+    Existing files are used as they are; when missing they are formatted
+    from gencode_path if it is given
+    """
+
+    transcriptome = Parameter()
+    annotation_path = Parameter()
+    gencode_path = Parameter(default="")
+
+    def requires(self):
+        if self.gencode_path:
+            return self.clone(FormatTranscriptome)
+        return []
+
+    def run(self):
+        # formatted by the requirement, otherwise there is nothing to run
+        if not self.output().exists():
+            raise FileNotFoundError(
+                "{} does not exist, pass gencode_path to format it from a "
+                "GENCODE release".format(self.output().path)
+            )
+
+
+class AnnotationFile(FormattedInput):
+    """
+    Make sure annotation file containing transcript ID mapping to gene name exists
+    Format it from the GENCODE release in gencode_path if given
+    """
+
+    def output(self):
+        return LocalTarget(str(self.annotation_path))
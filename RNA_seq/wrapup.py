@@ -1,10 +1,12 @@
 import luigi
 from .preprocess import MapFigure, CleanCounts
+from .normalize import NormalizeCounts
 from luigi.util import inherits
 
 
-@inherits(CleanCounts)
+@inherits(NormalizeCounts)
 class AllReports(luigi.WrapperTask):
     def requires(self):
         yield self.clone(CleanCounts)
         yield self.clone(MapFigure)
+        yield self.clone(NormalizeCounts)
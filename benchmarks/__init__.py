@@ -0,0 +1,8 @@
+"""
+Benchmarks of the post-quantification stages on synthetic cohorts
+
+Run from the repository root::
+
+    python -m benchmarks run --transcripts 250000 --samples 100 --out base.json
+    python -m benchmarks compare base.json new.json
+"""
@@ -0,0 +1,72 @@
+import argparse
+import logging
+import os
+from tempfile import TemporaryDirectory
+from .suite import compare, load_results, over_budget, run_suite, write_results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="benchmark the post-quant stages")
+    run.add_argument("--transcripts", type=int, default=250000)
+    run.add_argument("--samples", type=int, default=10)
+    run.add_argument(
+        "--genes", type=int, default=0, help="default: a third of the transcripts"
+    )
+    run.add_argument("--repeat", type=int, default=3, help="runs per stage")
+    run.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="processes writing data"
+    )
+    run.add_argument(
+        "--workdir",
+        default="",
+        help="folder for the synthetic cohort, kept and reused between runs "
+        "(default: a temporary folder)",
+    )
+    run.add_argument("--out", required=True, help="json file of the results")
+
+    diff = commands.add_parser("compare", help="compare two result files")
+    diff.add_argument("base")
+    diff.add_argument("new")
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.command == "compare":
+        table = compare(load_results(args.base), load_results(args.new))
+        print(table.to_string(index=False, float_format="{:.3f}".format, na_rep="n/a"))
+        return
+
+    def run(root):
+        results = run_suite(
+            os.path.abspath(root),
+            args.transcripts,
+            args.samples,
+            args.genes,
+            repeat=args.repeat,
+            n_workers=args.workers,
+        )
+        write_results(results, args.out)
+        over = over_budget(results)
+        if over:
+            raise SystemExit(
+                "\n".join(
+                    "{} took {:.1f} s, over its budget of {:.1f} s".format(*x)
+                    for x in over
+                )
+            )
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        run(args.workdir)
+    else:
+        with TemporaryDirectory() as tmp:
+            run(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from RNA_seq.quant import SalmonQuant
+from RNA_seq.transcriptome import ANNOTATION_FIELDS
+
+TRANSCRIPT_TYPES = ["protein_coding", "lncRNA", "retained_intron", "miRNA"]
+
+# annotation shared by the processes writing samples
+_annotation = None
+
+
+def synthetic_annotation(n_transcripts, n_genes, seed=0):
+    """
+    GENCODE-like annotation, genes owning a skewed number of transcripts
+    :param n_transcripts: int
+    :param n_genes: int, at most n_transcripts
+    :param seed: int
+    :return: pandas dataframe with the ANNOTATION_FIELDS columns
+    """
+    rng = np.random.default_rng(seed)
+    # every gene has one transcript, the rest go mostly to a few genes
+    extra = rng.zipf(1.8, n_transcripts - n_genes) % n_genes
+    genes = np.sort(np.concatenate([np.arange(n_genes), extra]))
+    number = np.arange(n_transcripts)
+    return pd.DataFrame(
+        {
+            "transcript_ID": pd.Series(number).map("ENST{:011d}.1".format),
+            "gene_ID": pd.Series(genes).map("ENSG{:011d}.1".format),
+            "transcript_name": pd.Series(number).map("TX{}-201".format),
+            "gene_name": pd.Series(genes).map("GENE{}".format),
+            "transcript_length": rng.integers(200, 10000, n_transcripts),
+            "transcript_type": rng.choice(TRANSCRIPT_TYPES, n_transcripts),
+        },
+        columns=[name for name, _ in ANNOTATION_FIELDS],
+    )
+
+
+def synthetic_quant(annotation, seed):
+    """
+    Salmon quant.sf table of one sample, lognormal expression with many
+    transcripts unexpressed
+    :param annotation: dataframe from synthetic_annotation
+    :param seed: int
+    :return: pandas dataframe
+    """
+    rng = np.random.default_rng(seed)
+    length = annotation["transcript_length"].to_numpy()
+    effective = np.maximum(length - 180, 20).astype(np.float64)
+    expression = rng.lognormal(0, 2.5, len(length))
+    expression[rng.random(len(length)) < 0.4] = 0
+    reads = rng.poisson(expression * effective / effective.mean() * 20)
+    rate = reads / effective
+    tpm = rate / rate.sum() * 1e6 if rate.sum() else rate
+    return pd.DataFrame(
+        {
+            "Name": annotation["transcript_ID"],
+            "Length": length,
+            "EffectiveLength": effective,
+            "TPM": tpm,
+            "NumReads": reads.astype(np.float64),
+        }
+    )
+
+
+def write_sample(sample_dir, annotation, seed):
+    """
+    Write one sample's salmon quant folder: quant.sf, the quant log,
+    meta_info.json for every other sample and the success flag
+    :param sample_dir: path of the sample folder
+    :param annotation: dataframe from synthetic_annotation
+    :param seed: int
+    """
+    quant = synthetic_quant(annotation, seed)
+    os.makedirs(os.path.join(sample_dir, "logs"), exist_ok=True)
+    quant.to_csv(
+        os.path.join(sample_dir, "quant.sf"), sep="\t", index=False, float_format="%g"
+    )
+    total = int(quant["NumReads"].sum() * 1.25)
+    mapped = int(quant["NumReads"].sum())
+    rate = 100.0 * mapped / total if total else 0.0
+    with open(os.path.join(sample_dir, "logs", "salmon_quant.log"), "w") as file:
+        file.write(
+            "[jointLog] [info] Mapping rate = {:.4f}%\n"
+            "Observed {} total fragments ({} in most recent round)\n"
+            "[jointLog] [info] Counted {} total reads\n".format(
+                rate, total, total, mapped
+            )
+        )
+    if seed % 2:
+        os.makedirs(os.path.join(sample_dir, "aux_info"), exist_ok=True)
+        meta = {
+            "salmon_version": "1.10.0",
+            "num_processed": total,
+            "num_mapped": mapped,
+            "percent_mapped": rate,
+            "library_types": ["IU"],
+        }
+        with open(os.path.join(sample_dir, "aux_info", "meta_info.json"), "w") as file:
+            json.dump(meta, file)
+    Path(os.path.join(sample_dir, SalmonQuant.flag)).touch()
+
+
+def _set_annotation(annotation):
+    global _annotation
+    _annotation = annotation
+
+
+def _write_shared(sample_dir, seed):
+    write_sample(sample_dir, _annotation, seed)
+
+
+def write_cohort(root, n_transcripts, n_samples, n_genes=0, n_workers=1, seed=0):
+    """
+    Lay out a synthetic cohort the way the pipeline expects it below root:
+    data/output/<sample>/ quant folders, the annotation and the ID file
+    :param root: path of the working folder
+    :param n_transcripts: int
+    :param n_samples: int
+    :param n_genes: int, default a third of the transcripts
+    :param n_workers: int, number of processes writing samples
+    :param seed: int
+    :return: dict of the ID file and annotation paths
+    """
+    annotation = synthetic_annotation(
+        n_transcripts, n_genes or max(1, n_transcripts // 3), seed
+    )
+    annotation_path = os.path.join(root, "annotation.tsv")
+    annotation.to_csv(annotation_path, sep="\t", index=False)
+    ids = ["sample_{:05d}".format(i) for i in range(n_samples)]
+    id_path = os.path.join(root, "ids.txt")
+    Path(id_path).write_text("\n".join(ids) + "\n")
+
+    sample_dirs = [os.path.join(root, SalmonQuant.output_root, x) for x in ids]
+    seeds = [seed + 1 + i for i in range(n_samples)]
+    if n_workers > 1:
+        # the annotation is sent to each process once, not once per sample
+        with ProcessPoolExecutor(
+            n_workers, initializer=_set_annotation, initargs=(annotation,)
+        ) as pool:
+            chunksize = max(1, n_samples // (4 * n_workers))
+            list(pool.map(_write_shared, sample_dirs, seeds, chunksize=chunksize))
+    else:
+        for sample_dir, sample_seed in zip(sample_dirs, seeds):
+            write_sample(sample_dir, annotation, sample_seed)
+    return {"ID_path": id_path, "annotation_path": annotation_path}
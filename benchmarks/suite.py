@@ -0,0 +1,293 @@
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from RNA_seq.annotation import CACHE_SUFFIX, load_annotation
+from RNA_seq.preprocess import CleanCounts, MapFigure
+from RNA_seq.profile import MB, peak_rss, snapshot
+from RNA_seq.summary import SummarizeCounts, SummarizeMapping
+from .cohort import write_cohort
+
+logger = logging.getLogger("luigi-interface")
+
+# startup, then post-quant stages in dependency order, each run in a fresh
+# process
+STAGES = [
+    "import_cli",
+    "import_quant",
+    "SummarizeCounts",
+    "SummarizeMapping",
+    "annotation_index",
+    "CleanCounts",
+    "MapFigure",
+]
+TASKS = {
+    "SummarizeCounts": SummarizeCounts,
+    "SummarizeMapping": SummarizeMapping,
+    "CleanCounts": CleanCounts,
+    "MapFigure": MapFigure,
+}
+# modules a fresh interpreter imports at startup: the command line, and the
+# quantification tasks forked or spawned workers run
+IMPORTS = {
+    "import_cli": "RNA_seq.cli",
+    "import_quant": "RNA_seq.quant",
+}
+# modules only the steps that need them may import
+HEAVY_MODULES = ["seaborn", "matplotlib", "scipy", "setuptools_scm"]
+COHORT_FILE = "cohort.json"
+# time budgets of stages, seconds fixed plus seconds per sample: rendering
+# one page per samples_per_page keeps MapFigure linear in the cohort size
+BUDGETS = {"MapFigure": (10.0, 0.02)}
+
+
+def task_params(cohort):
+    """
+    Parameters of the post-quant tasks for a synthetic cohort, the salmon
+    ones are placeholders since quantification is never run
+    :param cohort: dict from write_cohort
+    :return: dict
+    """
+    return dict(
+        ID_path=cohort["ID_path"],
+        annotation_path=cohort["annotation_path"],
+        transcriptome="transcripts.fa",
+        salmon_path="salmon",
+        index_path="index",
+        n_threads=1,
+        fastq_r1="_1",
+        fastq_r2="_2",
+        fastq_suffix=".fastq.gz",
+    )
+
+
+def run_stage(stage, root, params):
+    """
+    Run one stage in the current process and measure it
+    :param stage: str, one of STAGES
+    :param root: path of the cohort folder
+    :param params: dict of task parameters
+    :return: dict of wall_s, cpu_s and peak_rss_mb
+    """
+    os.chdir(root)
+    start = snapshot()
+    if stage in IMPORTS:
+        import_module(IMPORTS[stage])
+    elif stage == "annotation_index":
+        # parse the annotation from scratch, as on its first use
+        path = params["annotation_path"]
+        for cache in glob.glob(glob.escape(path) + CACHE_SUFFIX.format("*")):
+            os.remove(cache)
+        load_annotation(path)
+    else:
+        TASKS[stage](**params).run()
+    end = snapshot()
+    return {
+        "wall_s": end["wall"] - start["wall"],
+        "cpu_s": end["cpu"] - start["cpu"],
+        "peak_rss_mb": peak_rss() / MB,
+    }
+
+
+def import_module(module, heavy=HEAVY_MODULES):
+    """
+    Import a module in a new interpreter, as the command line and spawned
+    workers do, since this process already imported it
+    :param module: str, eg RNA_seq.cli
+    :param heavy: list of modules to look for
+    :return: list of the heavy modules it imported
+    """
+    code = "import sys, {}; print(' '.join(m for m in {!r} if m in sys.modules))"
+    result = subprocess.run(
+        [sys.executable, "-c", code.format(module, list(heavy))],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return result.stdout.decode("utf-8").split()
+
+
+def prepare_cohort(root, n_transcripts, n_samples, n_genes=0, n_workers=1, seed=0):
+    """
+    Write a synthetic cohort below root, reusing one already there if it was
+    written with the same settings
+    :param root: path of the cohort folder
+    :param n_transcripts: int
+    :param n_samples: int
+    :param n_genes: int, default a third of the transcripts
+    :param n_workers: int, processes writing the cohort
+    :param seed: int
+    :return: tuple of cohort paths and settings dicts
+    """
+    settings = dict(
+        transcripts=n_transcripts, samples=n_samples, genes=n_genes, seed=seed
+    )
+    record = os.path.join(root, COHORT_FILE)
+    if os.path.exists(record):
+        with open(record) as file:
+            saved = json.load(file)
+        if saved["settings"] == settings:
+            return saved["cohort"], settings
+    start = time.time()
+    cohort = write_cohort(root, n_transcripts, n_samples, n_genes, n_workers, seed)
+    logger.info("Wrote synthetic cohort in %.1f s", time.time() - start)
+    with open(record, "w") as file:
+        json.dump({"settings": settings, "cohort": cohort}, file)
+    return cohort, settings
+
+
+def run_suite(root, n_transcripts, n_samples, n_genes=0, repeat=3, n_workers=1):
+    """
+    Time and memory-profile every post-quant stage on a synthetic cohort
+    Each run of a stage happens in a fresh process, so its peak memory is
+    its own
+    :param root: path of the cohort folder
+    :param n_transcripts: int
+    :param n_samples: int
+    :param n_genes: int, default a third of the transcripts
+    :param repeat: int, runs per stage
+    :param n_workers: int, processes writing the cohort
+    :return: dict of results, see write_results
+    """
+    cohort, settings = prepare_cohort(
+        root, n_transcripts, n_samples, n_genes, n_workers
+    )
+    params = task_params(cohort)
+    context = multiprocessing.get_context("spawn")
+    stages = {}
+    for stage in STAGES:
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                runs.append(pool.submit(run_stage, stage, root, params).result())
+        stages[stage] = {key: [r[key] for r in runs] for key in runs[0]}
+        stages[stage]["best_wall_s"] = min(stages[stage]["wall_s"])
+        logger.info(
+            "%s: best of %d %.3f s", stage, repeat, stages[stage]["best_wall_s"]
+        )
+        if stage in BUDGETS:
+            stages[stage]["budget_s"] = budget_s(stage, n_samples)
+    return {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "cpus": os.cpu_count(),
+        },
+        "cohort": settings,
+        "repeat": repeat,
+        "stages": stages,
+    }
+
+
+def budget_s(stage, n_samples):
+    """
+    Time budget of a stage for a cohort
+    :param stage: str, one of BUDGETS
+    :param n_samples: int
+    :return: float, seconds
+    """
+    fixed, per_sample = BUDGETS[stage]
+    return fixed + per_sample * n_samples
+
+
+def over_budget(results):
+    """
+    Stages whose best wall time exceeds their budget
+    :param results: dict of results
+    :return: list of (stage, best_wall_s, budget_s)
+    """
+    return [
+        (stage, values["best_wall_s"], values["budget_s"])
+        for stage, values in results["stages"].items()
+        if "budget_s" in values and values["best_wall_s"] > values["budget_s"]
+    ]
+
+
+def git_commit():
+    """
+    Commit of the working tree the suite runs from, if it is a git repository
+    :return: str or None
+    """
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.decode("utf-8").strip()
+
+
+def write_results(results, path):
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def ratio(new, base):
+    """
+    :return: float, new / base, NaN if base is 0
+    """
+    return new / base if base else float("nan")
+
+
+def compare(base, new):
+    """
+    Compare two result files stage by stage, ratios above 1 are slower or
+    larger in new, and NaN where the base measured 0, as sub-millisecond
+    stages can on coarse clocks
+    :param base: dict of results
+    :param new: dict of results
+    :return: pandas dataframe
+    """
+    if base["cohort"] != new["cohort"]:
+        raise ValueError(
+            "Results are for different cohorts: {} and {}".format(
+                base["cohort"], new["cohort"]
+            )
+        )
+    rows = []
+    for stage in [s for s in base["stages"] if s in new["stages"]]:
+        old, now = base["stages"][stage], new["stages"][stage]
+        old_rss, new_rss = max(old["peak_rss_mb"]), max(now["peak_rss_mb"])
+        rows.append(
+            [
+                stage,
+                old["best_wall_s"],
+                now["best_wall_s"],
+                ratio(now["best_wall_s"], old["best_wall_s"]),
+                old_rss,
+                new_rss,
+                ratio(new_rss, old_rss),
+            ]
+        )
+    return pd.DataFrame(
+        rows,
+        columns=[
+            "stage",
+            "base_wall_s",
+            "new_wall_s",
+            "wall_ratio",
+            "base_rss_mb",
+            "new_rss_mb",
+            "rss_ratio",
+        ],
+    )
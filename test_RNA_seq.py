@@ -1,15 +1,59 @@
 from unittest import TestCase
 import os
 from pathlib import Path
-from RNA_seq.quant import SalmonQuant
-from RNA_seq.summary import SummarizeCounts, SummarizeMapping
+from RNA_seq.quant import SalmonQuant, SalmonQuantBatch, StageFastq, scratch_usage
+from RNA_seq.summary import SummarizeCounts, SummarizeMapping, get_file_ids
 from RNA_seq.preprocess import CleanCounts, AnnotationFile, MapFigure
 from RNA_seq.luigi.task import Requirement, Requires, TargetOutput
-from RNA_seq.luigi.target import SuffixPreservingLocalTarget
+from RNA_seq.luigi.task import CachedParams, requirement_names
+from RNA_seq.luigi.scan import DirectoryIndex, directory_index
+from RNA_seq.luigi.executor import SlurmExecutor
+from luigi.contrib.external_program import ExternalProgramRunError
+from RNA_seq.luigi.target import SuffixPreservingLocalTarget, AtomicDirectoryTarget
 from RNA_seq.wrapup import AllReports
-from luigi import build, format
+from RNA_seq.matrix import build_quant_matrix
+from RNA_seq.store import MatrixStore, MatrixTarget, write_matrix
+from RNA_seq.manifest import SampleManifest
+from RNA_seq.mapping import summarize_mapping, summarize_sample
+from RNA_seq.mapping import MappingSummaryError
+from RNA_seq.aggregate import GeneAggregator
+from RNA_seq.preprocess import merge_annotation, page_layout, render_figure
+from RNA_seq.annotation import load_annotation
+from RNA_seq.transcriptome import FormatTranscriptome, format_transcriptome
+from RNA_seq.index import TranscriptomeFASTA, SalmonIndex
+from RNA_seq.cli import get_parser, plan_cores, configure_executor, main
+from RNA_seq.cost import CostModel, longest_first, makespan, record_runtime
+from luigi.configuration import get_config
+from RNA_seq.index_cache import evict, mark_used, locked, lock_path
+from RNA_seq.profile import MB, TaskProfiler, critical_path
+from benchmarks.cohort import write_cohort
+from benchmarks.suite import compare, task_params, import_module, HEAVY_MODULES
+from benchmarks.suite import budget_s, over_budget
+from RNA_seq.genes import MergeGeneCounts, SampleGeneCounts, merge_groups
+import RNA_seq.provenance
+from RNA_seq.provenance import ProvenanceStore, code_digest
+from RNA_seq.normalize import NormalizeCounts, MATRICES, cpm, library_sizes
+from RNA_seq.normalize import log_cpm, tmm_factors
+from RNA_seq.monitor import LogTail, QuantMonitor
+from RNA_seq.quant import PROGRAM_LOG
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import time
+import gzip
+import io
+import glob
+import json
+import re
+from luigi import build, format, Event, Task, Parameter, IntParameter
+from luigi import BoolParameter, LocalTarget
+from luigi.util import inherits
 from tempfile import TemporaryDirectory
+from contextlib import redirect_stdout
 import pandas as pd
+import numpy as np
 
 
 class TaskTests(TestCase):
@@ -80,6 +124,12 @@ class TaskTests(TestCase):
                     ext="_tpm.csv",
                     target_class=SuffixPreservingLocalTarget,
                 )
+                count_matrix_out = TargetOutput(
+                    root_dir=output_root, ext="_count.cmat", target_class=MatrixTarget
+                )
+                tpm_matrix_out = TargetOutput(
+                    root_dir=output_root, ext="_tpm.cmat", target_class=MatrixTarget
+                )
 
             class DummySum(SummarizeMapping):
                 output_root = tmp
@@ -119,6 +169,12 @@ class TaskTests(TestCase):
                     ext="_count.csv",
                     root_dir=output_root,
                 )
+                tpm_matrix_out = TargetOutput(
+                    target_class=MatrixTarget, ext="_tpm.cmat", root_dir=output_root
+                )
+                count_matrix_out = TargetOutput(
+                    target_class=MatrixTarget, ext="_count.cmat", root_dir=output_root
+                )
 
             class DummyAll(AllReports):
                 def requires(self):
@@ -151,3 +207,1714 @@ class TaskTests(TestCase):
             self.assertEqual(
                 pd.read_csv(os.path.join(tmp, "DummyClean_tpm.csv")).iloc[1, 1], 80
             )
+            store = MatrixStore(os.path.join(tmp, "DummyClean_count.cmat"))
+            self.assertEqual(store.row("gene_1").tolist(), [150, 150])
+
+
+class MatrixTests(TestCase):
+    def test_build_quant_matrix(self):
+        expr = {
+            "Name": ["transcript_1", "transcript_2", "transcript_3"],
+            "Length": [500, 200, 600],
+            "NumReads": [50.0, 100.0, 200.0],
+            "TPM": [20.0, 40.0, 80.0],
+        }
+        first = pd.DataFrame(data=expr)
+        # second sample lists the transcripts in a different order
+        second = first.iloc[[2, 0, 1]]
+        with TemporaryDirectory() as tmp:
+            paths = []
+            for i, df in enumerate([first, second, first]):
+                path = os.path.join(tmp, "quant_{}.sf".format(i))
+                df.to_csv(path, index=False, sep="\t")
+                paths.append(path)
+            for n_workers in [1, 2]:
+                index, counts, tpm = build_quant_matrix(
+                    paths, n_workers=n_workers, dtype=np.float32
+                )
+                self.assertEqual(list(index), expr["Name"])
+                self.assertEqual(counts.dtype, np.float32)
+                self.assertEqual(counts.shape, (3, 3))
+                self.assertEqual(counts[:, 1].tolist(), expr["NumReads"])
+                self.assertEqual(tpm[:, 2].tolist(), expr["TPM"])
+
+            # a sample with different transcripts can not be aligned
+            first.iloc[:2].to_csv(paths[1], index=False, sep="\t")
+            with self.assertRaises(ValueError):
+                build_quant_matrix(paths)
+
+
+class StoreTests(TestCase):
+    def test_matrix_store(self):
+        values = np.arange(12, dtype=np.float32).reshape(4, 3)
+        genes = ["gene_1", "gene_2", "gene_3", "gene_4"]
+        samples = ["sample_1", "sample_2", "sample_3"]
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "tpm.cmat")
+            MatrixTarget(path).write(values, genes, samples, "gene_name")
+            store = MatrixTarget(path).load()
+            self.assertEqual(store.shape, (4, 3))
+            self.assertEqual(store.values.dtype, np.float32)
+            self.assertEqual(store.row("gene_2").tolist(), [3, 4, 5])
+            self.assertEqual(store.column("sample_3").tolist(), [2, 5, 8, 11])
+            block = store.select(rows=["gene_4", "gene_1"], columns=["sample_2"])
+            self.assertEqual(block["sample_2"].tolist(), [10, 1])
+            with self.assertRaises(KeyError):
+                store.select(columns=["sample_9"])
+            frame = store.to_frame()
+            self.assertEqual(list(frame.columns), ["gene_name"] + samples)
+            self.assertEqual(frame["gene_name"].tolist(), genes)
+
+            not_store = os.path.join(tmp, "tpm.csv")
+            Path(not_store).write_text("gene_name,sample_1\n")
+            with self.assertRaises(ValueError):
+                MatrixStore(not_store)
+
+            empty = os.path.join(tmp, "empty.cmat")
+            write_matrix(empty, np.empty((0, 3)), [], samples)
+            self.assertEqual(MatrixStore(empty).shape, (0, 3))
+
+
+class IncrementalTests(TestCase):
+    def test_incremental_counts(self):
+        expr = {
+            "Name": ["transcript_1", "transcript_2", "transcript_3"],
+            "NumReads": [50.0, 100.0, 200.0],
+            "TPM": [20.0, 40.0, 80.0],
+        }
+        dummy_quant = pd.DataFrame(data=expr)
+        with TemporaryDirectory() as tmp:
+
+            def write_sample(name, scale=1):
+                sample_dir = os.path.join(tmp, name)
+                os.makedirs(sample_dir, exist_ok=True)
+                df = dummy_quant.copy()
+                df["NumReads"] *= scale
+                df.to_csv(os.path.join(sample_dir, "quant.sf"), index=False, sep="\t")
+                Path(os.path.join(sample_dir, SalmonQuant.flag)).touch()
+
+            id_path = os.path.join(tmp, "id.txt")
+
+            def write_ids(ids):
+                with open(id_path, "w") as file:
+                    file.write("\n".join(ids) + "\n")
+
+            class DummyQuant(SalmonQuant):
+                output_root = tmp
+
+            class DummyCount(SummarizeCounts):
+                output_root = tmp
+
+                def requires(self):
+                    with open(str(self.ID_path), "r") as id_file:
+                        ids = id_file.read().splitlines()
+                    return {x: self.clone(DummyQuant, file_id=x) for x in ids}
+
+                count_out = TargetOutput(
+                    file_pattern="{task.__class__.__name__}{task.cohort_tag}",
+                    root_dir=output_root,
+                    ext="_count.csv",
+                    target_class=SuffixPreservingLocalTarget,
+                )
+                tpm_out = TargetOutput(
+                    file_pattern="{task.__class__.__name__}{task.cohort_tag}",
+                    root_dir=output_root,
+                    ext="_tpm.csv",
+                    target_class=SuffixPreservingLocalTarget,
+                )
+                count_matrix_out = TargetOutput(
+                    file_pattern="{task.__class__.__name__}{task.cohort_tag}",
+                    root_dir=output_root,
+                    ext="_count.cmat",
+                    target_class=MatrixTarget,
+                )
+                tpm_matrix_out = TargetOutput(
+                    file_pattern="{task.__class__.__name__}{task.cohort_tag}",
+                    root_dir=output_root,
+                    ext="_tpm.cmat",
+                    target_class=MatrixTarget,
+                )
+
+            def counts_task():
+                return DummyCount(
+                    ID_path=id_path,
+                    annotation_path="fake",
+                    transcriptome="fake",
+                    salmon_path="fake",
+                    index_path="fake",
+                    fastq_r1="fake",
+                    fastq_r2="fake",
+                    fastq_suffix="fake",
+                    n_threads=5,
+                    incremental=True,
+                )
+
+            def run_counts():
+                task = counts_task()
+                self.assertTrue(build([task], local_scheduler=True, log_level="INFO"))
+                return task.output()["count_matrix"].load()
+
+            write_sample("sample_1")
+            write_sample("sample_2", scale=2)
+            write_ids(["sample_1", "sample_2"])
+            first = run_counts()
+            self.assertEqual(first.column("sample_2").tolist(), [100, 200, 400])
+
+            # same size and mtime: the cached column is reused without parsing
+            quant_1 = os.path.join(tmp, "sample_1", "quant.sf")
+            stat = os.stat(quant_1)
+            with open(quant_1, "r+") as file:
+                text = file.read()
+                file.seek(0)
+                file.write(text.replace("50.0", "60.0"))
+            os.utime(quant_1, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+            # append a sample, change one and drop one
+            write_sample("sample_3", scale=3)
+            write_sample("sample_2", scale=4)
+            write_ids(["sample_1", "sample_2", "sample_3"])
+            second = run_counts()
+            self.assertNotEqual(first.path, second.path)
+            self.assertEqual(second.row("transcript_1").tolist(), [50, 200, 150])
+
+            write_ids(["sample_3", "sample_1"])
+            third = run_counts()
+            self.assertEqual(list(third.columns), ["sample_3", "sample_1"])
+            manifest = SampleManifest.load(
+                os.path.join(tmp, "DummyCount_cache", "manifest.json")
+            )
+            self.assertEqual(sorted(manifest.samples), ["sample_1", "sample_3"])
+            # the outputs of the earlier sample sets are removed
+            self.assertFalse(os.path.exists(first.path))
+            self.assertFalse(os.path.exists(second.path))
+            self.assertTrue(os.path.exists(third.path))
+
+            # a sample quantified again under the same IDs rebuilds the matrix
+            self.assertTrue(counts_task().complete())
+            write_sample("sample_1", scale=5)
+            self.assertFalse(counts_task().complete())
+            fourth = run_counts()
+            self.assertEqual(fourth.path, third.path)
+            self.assertEqual(fourth.column("sample_1").tolist(), [250, 500, 1000])
+
+    def test_incremental_mapping(self):
+        with TemporaryDirectory() as tmp:
+
+            def write_sample(name, processed, mapped):
+                sample_dir = os.path.join(tmp, name)
+                os.makedirs(os.path.join(sample_dir, "aux_info"), exist_ok=True)
+                os.makedirs(os.path.join(sample_dir, "logs"), exist_ok=True)
+                meta = os.path.join(sample_dir, "aux_info", "meta_info.json")
+                with open(meta, "w") as f:
+                    json.dump(
+                        {
+                            "num_processed": processed,
+                            "num_mapped": mapped,
+                            "percent_mapped": 100.0 * mapped / processed,
+                        },
+                        f,
+                    )
+                log = os.path.join(sample_dir, "logs", "salmon_quant.log")
+                with open(log, "w") as f:
+                    f.write("Counted {} total reads\n".format(mapped))
+                Path(os.path.join(sample_dir, SalmonQuant.flag)).touch()
+
+            id_path = os.path.join(tmp, "id.txt")
+
+            def write_ids(ids):
+                with open(id_path, "w") as file:
+                    file.write("\n".join(ids) + "\n")
+
+            class DummyQuant(SalmonQuant):
+                output_root = tmp
+
+            class DummyMap(SummarizeMapping):
+                output_root = tmp
+                out_file = TargetOutput(
+                    file_pattern="{task.__class__.__name__}{task.cohort_tag}",
+                    root_dir=output_root,
+                    target_class=SuffixPreservingLocalTarget,
+                )
+
+                def requires(self):
+                    with open(str(self.ID_path), "r") as id_file:
+                        ids = id_file.read().splitlines()
+                    return {x: self.clone(DummyQuant, file_id=x) for x in ids}
+
+            def map_task():
+                return DummyMap(
+                    ID_path=id_path,
+                    annotation_path="fake",
+                    transcriptome="fake",
+                    salmon_path="fake",
+                    index_path="fake",
+                    fastq_r1="fake",
+                    fastq_r2="fake",
+                    fastq_suffix="fake",
+                    n_threads=5,
+                    incremental=True,
+                )
+
+            def run_map():
+                task = map_task()
+                self.assertTrue(build([task], local_scheduler=True, log_level="INFO"))
+                return pd.read_table(task.output().path)
+
+            write_sample("sample_1", 100, 80)
+            write_sample("sample_2", 200, 100)
+            write_ids(["sample_1", "sample_2"])
+            first = run_map()
+            self.assertEqual(list(first.Mapped_Reads), [80, 100])
+
+            # the log is untouched: the cached row is reused without reading
+            meta = os.path.join(tmp, "sample_1", "aux_info", "meta_info.json")
+            with open(meta, "w") as f:
+                json.dump({"num_processed": 1}, f)
+
+            # append a sample and quantify one again
+            write_sample("sample_3", 300, 150)
+            write_sample("sample_2", 400, 200)
+            write_ids(["sample_1", "sample_2", "sample_3"])
+            second = run_map()
+            self.assertEqual(list(second.Total_Reads), [100, 400, 300])
+            self.assertEqual(list(second.Mapped_Reads), [80, 200, 150])
+
+            # a sample quantified again under the same IDs is read again
+            self.assertTrue(map_task().complete())
+            write_sample("sample_3", 500, 250)
+            self.assertFalse(map_task().complete())
+            write_ids(["sample_3", "sample_1"])
+            third = run_map()
+            self.assertEqual(list(third.Sample), ["sample_3", "sample_1"])
+            self.assertEqual(list(third.Total_Reads), [500, 100])
+            manifest = SampleManifest.load(
+                os.path.join(tmp, "DummyMap_cache", "manifest.json")
+            )
+            self.assertEqual(sorted(manifest.samples), ["sample_1", "sample_3"])
+
+
+class MappingTests(TestCase):
+    def test_summarize_mapping(self):
+        log = (
+            "[2019-11-26 16:03:37.145] [jointLog] [info] Mapping rate = 82.5000%\n"
+            "Observed 2000 total fragments (2000 in most recent round)\n"
+            "[2019-11-26 16:03:37.145] [jointLog] [info] Counted 1650 total reads\n"
+        )
+        with TemporaryDirectory() as tmp:
+            # newer salmon: structured outputs
+            json_dir = os.path.join(tmp, "sample_1")
+            os.makedirs(os.path.join(json_dir, "aux_info"))
+            with open(os.path.join(json_dir, "aux_info", "meta_info.json"), "w") as f:
+                json.dump(
+                    {
+                        "num_processed": 1000,
+                        "num_mapped": 690,
+                        "percent_mapped": 69.0,
+                        "library_types": ["IU"],
+                        "salmon_version": "1.0.0",
+                    },
+                    f,
+                )
+            with open(os.path.join(json_dir, "lib_format_counts.json"), "w") as f:
+                json.dump({"compatible_fragment_ratio": 0.99}, f)
+            # the reads salmon counted, which differ from num_mapped
+            os.makedirs(os.path.join(json_dir, "logs"))
+            with open(os.path.join(json_dir, "logs", "salmon_quant.log"), "w") as f:
+                f.write("[jointLog] [info] Counted 672 total reads\n")
+            # older salmon: log only
+            log_dir = os.path.join(tmp, "sample_2")
+            os.makedirs(os.path.join(log_dir, "logs"))
+            with open(os.path.join(log_dir, "logs", "salmon_quant.log"), "w") as f:
+                f.write(log)
+
+            dirs = {"sample_1": json_dir, "sample_2": log_dir}
+            table = summarize_mapping(dirs, n_workers=2)
+            self.assertEqual(list(table.Sample), ["sample_1", "sample_2"])
+            self.assertEqual(list(table.Total_Reads), [1000, 2000])
+            self.assertEqual(list(table.Mapped_Reads), [672, 1650])
+            self.assertEqual(list(table.Mapped_Rate), [69.0, 82.5])
+            self.assertEqual(list(table.Source), ["meta_info", "log"])
+            self.assertEqual(table.Library_Type[0], "IU")
+            # without the log line, meta_info's mapped fragments are used
+            os.remove(os.path.join(json_dir, "logs", "salmon_quant.log"))
+            self.assertEqual(
+                summarize_sample("sample_1", json_dir)["Mapped_Reads"], 690
+            )
+
+            # partial log and missing outputs are both reported
+            with open(os.path.join(log_dir, "logs", "salmon_quant.log"), "w") as f:
+                f.write(log.splitlines()[0])
+            dirs["sample_3"] = os.path.join(tmp, "sample_3")
+            with self.assertRaises(MappingSummaryError) as error:
+                summarize_mapping(dirs)
+            self.assertEqual(len(error.exception.errors), 2)
+            self.assertIn("Total_Reads", error.exception.errors[0])
+            self.assertTrue(error.exception.errors[1].startswith("sample_3"))
+
+
+class AggregateTests(TestCase):
+    def test_gene_aggregator(self):
+        rng = np.random.RandomState(0)
+        anno = pd.DataFrame(
+            {
+                "transcript_ID": ["t{}".format(i) for i in range(200)],
+                "gene_name": ["g{}".format(i) for i in rng.randint(0, 60, 200)],
+            }
+        )
+        # table misses some annotated transcripts and has unannotated ones
+        transcripts = ["t{}".format(i) for i in rng.permutation(250)[:180]]
+        tpm = rng.rand(180, 4)
+        counts = rng.rand(180, 4).astype(np.float32)
+        samples = ["s1", "s2", "s3", "s4"]
+
+        genes, (tpm_sum, count_sum) = GeneAggregator.from_annotation(anno).collapse(
+            transcripts, tpm, counts
+        )
+        for values, summed in [(tpm, tpm_sum), (counts, count_sum)]:
+            table = pd.DataFrame(values, columns=samples)
+            table.insert(0, "transcript_ID", transcripts)
+            expected = (
+                pd.merge(anno, table, on="transcript_ID")
+                .groupby("gene_name")[samples]
+                .sum()
+            )
+            self.assertEqual(list(genes), list(expected.index))
+            self.assertEqual(summed.dtype, values.dtype)
+            np.testing.assert_allclose(summed, expected.to_numpy(), rtol=1e-5)
+
+        table = pd.DataFrame(tpm, columns=samples)
+        table.insert(0, "transcript_ID", transcripts)
+        merged = merge_annotation(anno, table)
+        self.assertEqual(list(merged.columns), ["gene_name"] + samples)
+        np.testing.assert_allclose(merged[samples].to_numpy(), tpm_sum)
+
+        with self.assertRaises(ValueError):
+            GeneAggregator.from_names(["t1", "t1"], ["g1", "g2"])
+
+
+class AnnotationTests(TestCase):
+    def test_unannotated_transcripts(self):
+        anno = pd.DataFrame(
+            {"transcript_ID": ["t1", "t2", "t3"], "gene_name": ["gA", None, "gB"]}
+        )
+        values = np.array([[1.0], [2.0], [4.0]])
+        # summed as merging with the annotation and grouping by gene
+        expected = anno.assign(value=values[:, 0]).groupby("gene_name")["value"].sum()
+        genes, (summed,) = GeneAggregator.from_annotation(anno).collapse(
+            ["t1", "t2", "t3"], values
+        )
+        self.assertEqual(list(genes), list(expected.index))
+        self.assertEqual(summed[:, 0].tolist(), expected.tolist())
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "annotation.file")
+            anno.to_csv(path, index=False, sep="\t")
+            index = load_annotation(path)
+            self.assertEqual(list(index.categories("gene_name")), ["gA", "gB"])
+            self.assertEqual(list(index.column("gene_name")), ["gA", None, "gB"])
+            genes, (summed,) = index.aggregator().collapse(["t1", "t2", "t3"], values)
+            self.assertEqual(list(genes), ["gA", "gB"])
+            self.assertEqual(summed[:, 0].tolist(), [1, 4])
+
+    def test_load_annotation(self):
+        anno = pd.DataFrame(
+            {
+                "transcript_ID": ["transcript_1", "transcript_2", "transcript_3"],
+                "gene_ID": ["id_2", "id_2", "id_1"],
+                "transcript_name": ["name_1", "name_2", "name_3"],
+                "gene_name": ["gene_2", "gene_2", "gene_1"],
+                "transcript_length": [500, 200, 600],
+                "transcript_type": ["protein_coding", "lncRNA", "protein_coding"],
+            }
+        )
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "annotation.file")
+            anno.to_csv(path, index=False, sep="\t")
+            index = load_annotation(path)
+            caches = glob.glob(path + ".idx-*.npz")
+            self.assertEqual(len(caches), 1)
+            for loaded in [index, load_annotation(path)]:
+                self.assertEqual(list(loaded.transcripts), list(anno.transcript_ID))
+                self.assertEqual(
+                    list(loaded.categories("gene_name")), ["gene_1", "gene_2"]
+                )
+                self.assertEqual(list(loaded.codes("gene_name")), [1, 1, 0])
+                self.assertEqual(list(loaded.column("gene_ID")), list(anno.gene_ID))
+                self.assertEqual(list(loaded.transcript_length), [500, 200, 600])
+            genes, (summed,) = index.aggregator().collapse(
+                ["transcript_3", "transcript_1", "transcript_2"],
+                np.array([[1.0], [2.0], [3.0]]),
+            )
+            self.assertEqual(list(genes), ["gene_1", "gene_2"])
+            self.assertEqual(summed[:, 0].tolist(), [1, 5])
+
+            # a changed annotation gets a new cache and the old one is removed
+            anno["gene_name"] = ["gene_3", "gene_2", "gene_1"]
+            anno.to_csv(path, index=False, sep="\t")
+            self.assertEqual(
+                list(load_annotation(path).column("gene_name")), list(anno.gene_name)
+            )
+            new_caches = glob.glob(path + ".idx-*.npz")
+            self.assertEqual(len(new_caches), 1)
+            self.assertNotEqual(caches, new_caches)
+
+
+class TranscriptomeTests(TestCase):
+    headers = [
+        ">ENST01.1|ENSG01.1|OTTHUMG01|OTTHUMT01|GENE1-201|GENE1|8|lncRNA|",
+        ">ENST02.1|ENSG02.1|-|-|GENE2-201|GENE2|12|protein_coding|",
+    ]
+    sequences = [["ACGT", "ACGT"], ["ACGTACGT", "ACGT"]]
+
+    def write_gencode(self, path):
+        lines = []
+        for header, seq in zip(self.headers, self.sequences):
+            lines += [header] + seq
+        text = "\n".join(lines) + "\n"
+        # two gzip members, as produced by concatenating archives
+        half = len(text) // 2
+        with open(path, "wb") as file:
+            file.write(gzip.compress(text[:half].encode("utf-8")))
+            file.write(gzip.compress(text[half:].encode("utf-8")))
+
+    def test_format_transcriptome(self):
+        with TemporaryDirectory() as tmp:
+            gencode = os.path.join(tmp, "gencode.fa.gz")
+            self.write_gencode(gencode)
+            fasta, annotation = io.BytesIO(), io.BytesIO()
+            # tiny chunks put chunk boundaries inside headers and sequences
+            format_transcriptome(gencode, fasta, annotation, chunk_size=7)
+            self.assertEqual(
+                fasta.getvalue().decode("utf-8").splitlines(),
+                [">ENST01.1", "ACGT", "ACGT", ">ENST02.1", "ACGTACGT", "ACGT"],
+            )
+            anno = pd.read_table(io.BytesIO(annotation.getvalue()))
+            self.assertEqual(list(anno.transcript_ID), ["ENST01.1", "ENST02.1"])
+            self.assertEqual(list(anno.gene_name), ["GENE1", "GENE2"])
+            self.assertEqual(list(anno.transcript_length), [8, 12])
+            self.assertEqual(list(anno.transcript_type), ["lncRNA", "protein_coding"])
+
+            bad = os.path.join(tmp, "bad.fa")
+            Path(bad).write_text(">ENST01.1 no fields\nACGT\n")
+            with self.assertRaises(ValueError):
+                format_transcriptome(bad, io.BytesIO(), io.BytesIO())
+
+    def test_format_task(self):
+        with TemporaryDirectory() as tmp:
+            gencode = os.path.join(tmp, "gencode.fa.gz")
+            self.write_gencode(gencode)
+            params = dict(
+                transcriptome=os.path.join(tmp, "human", "formatted.fa"),
+                annotation_path=os.path.join(tmp, "human", "transcripts.annot"),
+            )
+            # without a GENCODE release a missing transcriptome fails
+            self.assertFalse(
+                build([TranscriptomeFASTA(**params)], local_scheduler=True)
+            )
+            task = TranscriptomeFASTA(gencode_path=gencode, **params)
+            self.assertTrue(build([task], local_scheduler=True))
+            self.assertTrue(task.complete())
+            self.assertTrue(os.path.exists(params["annotation_path"]))
+            self.assertTrue(
+                FormatTranscriptome(gencode_path=gencode, **params).complete()
+            )
+
+
+class SchedulingTests(TestCase):
+    def test_plan_cores(self):
+        self.assertEqual(plan_cores(96, 4), 24)
+        self.assertEqual(plan_cores(8, 16), 1)
+        self.assertEqual(plan_cores(96, 4, threads=8), 8)
+        self.assertEqual(plan_cores(16, 1, threads=32), 16)
+        with self.assertRaises(ValueError):
+            plan_cores(0, 1)
+        args = get_parser().parse_args(
+            ["--id", "ids.txt", "--cores", "96", "--workers", "4", "--index", "idx"]
+        )
+        self.assertEqual((args.cores, args.workers, args.index), (96, 4, "idx"))
+
+    def test_core_resources(self):
+        params = dict(
+            transcriptome="fake",
+            annotation_path="fake",
+            salmon_path="fake",
+            index_path="fake",
+            n_threads=24,
+        )
+        config = get_config()
+        self.assertEqual(SalmonIndex(**params).resources, {})
+        if not config.has_section("resources"):
+            config.add_section("resources")
+        config.set("resources", "cores", "96")
+        try:
+            self.assertEqual(SalmonIndex(**params).resources, {"cores": 24})
+            index = SalmonIndex(index_threads=200, **params)
+            self.assertEqual(index.resources, {"cores": 96})
+            self.assertEqual(index.program_args()[3], 200)
+        finally:
+            config.remove_option("resources", "cores")
+
+
+FAKE_SALMON = """#!/bin/sh
+# stand-in for salmon: logs each call and writes a dummy index or quant
+echo "$@" >> "$(dirname "$0")/calls.txt"
+if [ "$1" = "--version" ]; then
+    echo "salmon 0.0.0"
+    exit 0
+fi
+command="$1"
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-i" ] && [ "$command" = "index" ]; then
+        mkdir -p "$2" && echo index > "$2/index.bin"
+    fi
+    if [ "$1" = "-o" ]; then
+        mkdir -p "$2/aux_info"
+        printf "Name\tLength\tEffectiveLength\tTPM\tNumReads\n" > "$2/quant.sf"
+        printf "ENST01.1\t4\t4\t1.0\t2.0\n" >> "$2/quant.sf"
+    fi
+    shift
+done
+"""
+
+
+def write_fake_salmon(folder):
+    path = os.path.join(folder, "salmon")
+    Path(path).write_text(FAKE_SALMON)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+class IndexCacheTests(TestCase):
+    def test_shared_index(self):
+        with TemporaryDirectory() as tmp:
+            salmon = write_fake_salmon(tmp)
+            fasta = os.path.join(tmp, "transcripts.fa")
+            Path(fasta).write_text(">ENST01.1\nACGT\n")
+            cache = os.path.join(tmp, "cache")
+            params = dict(
+                transcriptome=fasta,
+                annotation_path="fake",
+                salmon_path=salmon,
+                n_threads=1,
+                index_cache=cache,
+            )
+
+            def index_builds():
+                with open(os.path.join(tmp, "calls.txt")) as file:
+                    return sum(line.startswith("index") for line in file)
+
+            # two projects with their own index_path share one build
+            first = SalmonIndex(index_path="project_1", **params)
+            second = SalmonIndex(index_path="project_2", **params)
+            self.assertTrue(build([first], local_scheduler=True))
+            self.assertTrue(second.complete())
+            self.assertEqual(first.output().path, second.output().path)
+            self.assertEqual(index_builds(), 1)
+
+            # other options or transcriptome give another index
+            self.assertNotEqual(
+                SalmonIndex(index_path="project_1", kmer=25, **params).output().path,
+                first.output().path,
+            )
+            Path(fasta).write_text(">ENST02.1\nACGT\n")
+            changed = SalmonIndex(index_path="project_1", **params)
+            self.assertFalse(changed.complete())
+
+    def test_evict(self):
+        with TemporaryDirectory() as tmp:
+            for i, name in enumerate(["old", "used", "new"]):
+                os.makedirs(os.path.join(tmp, name))
+                Path(os.path.join(tmp, name, "index.bin")).write_bytes(b"0" * 100)
+                mark_used(os.path.join(tmp, name))
+                past = time.time() - 100 + i
+                os.utime(os.path.join(tmp, name, ".last_used"), (past, past))
+            self.assertEqual(evict(tmp, 0), [])
+            # the least recently used index in use is skipped, then the next goes
+            with locked(lock_path(os.path.join(tmp, "old")), shared=True):
+                removed = evict(tmp, 150, keep=["new"])
+            self.assertEqual(removed, [os.path.join(tmp, "used")])
+            self.assertEqual(evict(tmp, 150), [os.path.join(tmp, "old")])
+
+
+class BatchTests(TestCase):
+    def test_batched_quant(self):
+        cwd = os.getcwd()
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                salmon = write_fake_salmon(tmp)
+                fasta = os.path.join(tmp, "transcripts.fa")
+                Path(fasta).write_text(">ENST01.1\nACGT\n")
+                os.makedirs(os.path.join("data", "fastq"))
+                ids = ["s1", "s2", "s3"]
+                for x in ids:
+                    for reads in ["_1", "_2"]:
+                        Path("data", "fastq", x + reads + ".fastq.gz").touch()
+                Path("ids.txt").write_text("\n".join(ids) + "\n")
+                task = SummarizeCounts(
+                    ID_path="ids.txt",
+                    transcriptome=fasta,
+                    annotation_path="fake",
+                    salmon_path=salmon,
+                    index_path=os.path.join(tmp, "index"),
+                    n_threads=1,
+                    fastq_r1="_1",
+                    fastq_r2="_2",
+                    fastq_suffix=".fastq.gz",
+                    batch_size=2,
+                )
+                batches = list(task.requires().values())
+                self.assertEqual([b.file_ids for b in batches], [("s1", "s2"), ("s3",)])
+                self.assertTrue(all(isinstance(b, SalmonQuantBatch) for b in batches))
+                finished = []
+
+                @SalmonQuant.event_handler(Event.SUCCESS)
+                def record(quant):
+                    finished.append(quant.file_id)
+
+                try:
+                    self.assertTrue(build([task], local_scheduler=True))
+                finally:
+                    Task._event_callbacks[SalmonQuant][Event.SUCCESS].discard(record)
+                # each sample of a batch reports its own success
+                self.assertEqual(finished, ids)
+
+                with open(os.path.join(tmp, "calls.txt")) as file:
+                    commands = [line.split()[0] for line in file]
+                self.assertEqual(commands.count("index"), 1)
+                self.assertEqual(commands.count("quant"), 3)
+                # batches write the same sample outputs as single quantification
+                single = task.clone(SalmonQuant, file_id="s3")
+                self.assertTrue(single.complete())
+                counts = MatrixStore(task.output()["count_matrix"].path)
+                self.assertEqual(list(counts.columns), ids)
+            finally:
+                os.chdir(cwd)
+
+    def test_failed_sample(self):
+        cwd = os.getcwd()
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                salmon = write_fake_salmon(tmp)
+                # salmon fails on the first sample of the batch
+                Path(salmon).write_text(
+                    FAKE_SALMON.replace(
+                        "command=",
+                        'case "$*" in *s1_1*) exit 1;; esac\ncommand=',
+                    )
+                )
+                fasta = os.path.join(tmp, "transcripts.fa")
+                Path(fasta).write_text(">ENST01.1\nACGT\n")
+                os.makedirs(os.path.join("data", "fastq"))
+                for x in ["s1", "s2"]:
+                    for reads in ["_1", "_2"]:
+                        Path("data", "fastq", x + reads + ".fastq.gz").touch()
+                batch = SalmonQuantBatch(
+                    file_ids=["s1", "s2"],
+                    transcriptome=fasta,
+                    annotation_path="fake",
+                    salmon_path=salmon,
+                    index_path=os.path.join(tmp, "index"),
+                    n_threads=1,
+                    fastq_r1="_1",
+                    fastq_r2="_2",
+                    fastq_suffix=".fastq.gz",
+                )
+                events = []
+
+                @SalmonQuant.event_handler(Event.SUCCESS)
+                def success(quant):
+                    events.append(("success", quant.file_id))
+
+                @SalmonQuant.event_handler(Event.FAILURE)
+                def failure(quant, exception):
+                    events.append(("failure", quant.file_id))
+
+                try:
+                    self.assertFalse(build([batch], local_scheduler=True))
+                finally:
+                    callbacks = Task._event_callbacks[SalmonQuant]
+                    callbacks[Event.SUCCESS].discard(success)
+                    callbacks[Event.FAILURE].discard(failure)
+                # the failure is reported and the rest of the batch still runs
+                self.assertEqual(events, [("failure", "s1"), ("success", "s2")])
+                self.assertTrue(batch.clone(SalmonQuant, file_id="s2").complete())
+            finally:
+                os.chdir(cwd)
+
+
+class ProfileTests(TestCase):
+    def test_profile_run(self):
+        with TemporaryDirectory() as tmp:
+            salmon = write_fake_salmon(tmp)
+            fasta = os.path.join(tmp, "transcripts.fa")
+            Path(fasta).write_text(">ENST01.1\nACGT\n")
+            tasks = [
+                SalmonIndex(
+                    index_path=os.path.join(tmp, "index_{}".format(k)),
+                    kmer=k,
+                    transcriptome=fasta,
+                    annotation_path="fake",
+                    salmon_path=salmon,
+                    n_threads=1,
+                )
+                for k in [25, 31]
+            ]
+            # forked workers report through the spool file
+            with TaskProfiler() as profiler:
+                self.assertTrue(build(tasks, workers=2, local_scheduler=True))
+            trace_path = os.path.join(tmp, "trace.json")
+            table = profiler.write(trace_path)
+
+            with open(trace_path) as file:
+                events = json.load(file)["traceEvents"]
+            self.assertEqual(len(events), 2)
+            for event in events:
+                self.assertEqual(event["name"], "SalmonIndex")
+                self.assertEqual(event["ph"], "X")
+                self.assertGreater(event["dur"], 0)
+            summary = pd.read_table(os.path.join(tmp, "trace.tsv"))
+            self.assertEqual(sorted(summary["task"]), sorted(t.task_id for t in tasks))
+            self.assertTrue((table["status"] == "DONE").all())
+            self.assertEqual(table["critical"].sum(), 1)
+            self.assertFalse(os.path.exists(profiler.spool))
+        # handlers are removed once the profiler exits
+        self.assertNotIn(profiler._start, Task._event_callbacks[Task][Event.START])
+
+    def test_peak_memory_per_task(self):
+        with TemporaryDirectory() as tmp:
+
+            class Allocate(Task):
+                name = Parameter()
+                mb = IntParameter(default=0)
+                child = BoolParameter(default=False)
+                after = Parameter(default="")
+
+                def requires(self):
+                    if self.after:
+                        return Allocate(name=self.after, mb=300, child=self.child)
+                    return []
+
+                def output(self):
+                    return LocalTarget(os.path.join(tmp, self.name))
+
+                def run(self):
+                    code = "b = bytearray({} << 20); b[::4096] = b'x' * len(b[::4096])"
+                    if self.child:
+                        subprocess.check_call(
+                            [sys.executable, "-c", code.format(self.mb)]
+                        )
+                    else:
+                        exec(code.format(self.mb))
+                    Path(self.output().path).touch()
+
+            # the small tasks run after the large ones, in the same process
+            tasks = {
+                "small": Allocate(name="small", after="big"),
+                "small_2": Allocate(name="small_2", after="salmon", child=True),
+            }
+            tasks["big"], tasks["salmon"] = [t.requires() for t in tasks.values()]
+            with TaskProfiler() as profiler:
+                self.assertTrue(build(list(tasks.values()), local_scheduler=True))
+            peaks = {r["task"]: r["peak_rss"] / MB for r in profiler.records()}
+            os.remove(profiler.spool)
+        peaks = {name: peaks[task.task_id] for name, task in tasks.items()}
+        self.assertGreater(peaks["big"], 300)
+        self.assertGreater(peaks["salmon"], 300)
+        self.assertLess(peaks["small"], peaks["big"] - 200)
+        # nor does a large child process
+        self.assertLess(abs(peaks["small_2"] - peaks["small"]), 100)
+
+    def test_critical_path(self):
+        def record(task, wall, deps=()):
+            return {"task": task, "wall": wall, "deps": list(deps)}
+
+        records = [
+            record("index", 10),
+            record("quant_1", 5, ["index"]),
+            record("quant_2", 8, ["index"]),
+            # formatted before the run, so not recorded
+            record("counts", 1, ["quant_1", "quant_2", "fasta"]),
+            record("figure", 12),
+        ]
+        self.assertEqual(critical_path(records), ["index", "quant_2", "counts"])
+        self.assertEqual(critical_path([]), [])
+
+
+class BenchmarkTests(TestCase):
+    def test_synthetic_cohort(self):
+        with TemporaryDirectory() as tmp:
+            cohort = write_cohort(tmp, n_transcripts=300, n_samples=4, n_genes=50)
+            ids = get_file_ids(cohort["ID_path"])
+            sample_dirs = {
+                x: os.path.join(tmp, SalmonQuant.output_root, x) for x in ids
+            }
+            # the pipeline's own readers accept the synthetic outputs
+            transcripts, counts, tpm = build_quant_matrix(
+                [os.path.join(d, "quant.sf") for d in sample_dirs.values()]
+            )
+            self.assertEqual(counts.shape, (300, 4))
+            np.testing.assert_allclose(tpm.sum(axis=0), 1e6, rtol=1e-3)
+            table = summarize_mapping(sample_dirs)
+            self.assertEqual(set(table["Source"]), {"log", "meta_info"})
+            anno = load_annotation(cohort["annotation_path"])
+            self.assertEqual(len(anno.categories("gene_name")), 50)
+
+    def test_compare(self):
+        def results(wall, rss):
+            stage = {"best_wall_s": wall, "peak_rss_mb": [rss]}
+            return {"cohort": {"samples": 10}, "stages": {"CleanCounts": stage}}
+
+        table = compare(results(2.0, 100), results(1.0, 150))
+        self.assertEqual(table["wall_ratio"].tolist(), [0.5])
+        self.assertEqual(table["rss_ratio"].tolist(), [1.5])
+        # a stage too fast for the clock has no ratio
+        table = compare(results(0.0, 100), results(0.001, 150))
+        self.assertTrue(np.isnan(table["wall_ratio"][0]))
+        other = results(1.0, 100)
+        other["cohort"] = {"samples": 20}
+        with self.assertRaises(ValueError):
+            compare(results(1.0, 100), other)
+
+    def test_budget(self):
+        results = {
+            "stages": {
+                "MapFigure": {
+                    "best_wall_s": 20.0,
+                    "budget_s": budget_s("MapFigure", 1000),
+                },
+                "CleanCounts": {"best_wall_s": 100.0},
+            }
+        }
+        self.assertEqual(over_budget(results), [])
+        results["stages"]["MapFigure"]["budget_s"] = budget_s("MapFigure", 10)
+        self.assertEqual(over_budget(results)[0][0], "MapFigure")
+
+    def test_startup_imports(self):
+        # the plotting stack and the git version lookup wait until used
+        self.assertEqual(import_module("RNA_seq.cli"), [])
+        # salmon workers need no analysis stack at all
+        heavy = HEAVY_MODULES + ["pandas", "numpy"]
+        self.assertEqual(import_module("RNA_seq.quant", heavy), [])
+
+
+class FigureTests(TestCase):
+    def test_paginated_figure(self):
+        def pages(path):
+            with open(path, "rb") as file:
+                return len(re.findall(rb"/Type /Page\b", file.read()))
+
+        df = pd.DataFrame(
+            {
+                "Sample": ["sample_{}".format(i) for i in range(12)],
+                "Mapped_Rate": np.linspace(50, 90, 12),
+            }
+        )
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "rate.pdf")
+            # an overview page, then 5 samples per page
+            render_figure(path, "Mapped_Rate", df, per_page=5)
+            self.assertEqual(pages(path), 4)
+            render_figure(path, "Mapped_Rate", df.head(5), per_page=5)
+            self.assertEqual(pages(path), 1)
+
+        # the margins fit the longest label, wherever its page is
+        df.loc[11, "Sample"] = "sample_with_a_much_longer_name_11"
+        chunks = [df.iloc[i : i + 5] for i in range(0, 12, 5)]
+        first, _ = page_layout("Mapped_Rate", chunks[:1])
+        layout, fitted = page_layout("Mapped_Rate", chunks)
+        self.assertGreater(layout["bottom"], first["bottom"])
+        self.assertIn(2, fitted)
+
+
+class GraphTests(TestCase):
+    def test_requirements(self):
+        class Base(Task):
+            requires = Requires()
+            quant = Requirement(SalmonQuant, file_id="sample_1")
+
+        class Child(Base):
+            summary = Requirement(SummarizeMapping)
+
+        class Override(Child):
+            quant = None
+
+        # inherited requirements are found along the MRO
+        self.assertEqual(requirement_names(Child), ("quant", "summary"))
+        self.assertEqual(requirement_names(Override), ("summary",))
+
+        params = dict(
+            ID_path="ids.txt",
+            transcriptome="t.fa",
+            annotation_path="a.tsv",
+            salmon_path="salmon",
+            index_path="index",
+            n_threads=1,
+            fastq_r1="_1",
+            fastq_r2="_2",
+            fastq_suffix=".fastq.gz",
+        )
+
+        @inherits(SummarizeMapping)
+        class Wrapper(Child):
+            pass
+
+        task = Wrapper(**params)
+        # each requirement is cloned once per task
+        self.assertIs(task.quant, task.quant)
+        self.assertEqual(task.requires()["quant"].file_id, "sample_1")
+        self.assertIs(task.requires()["summary"], task.summary)
+
+    def test_cached_params(self):
+        class PerSample(CachedParams, Task):
+            file_id = Parameter()
+
+        @inherits(PerSample)
+        class Child(CachedParams, Task):
+            n = IntParameter(default=1)
+
+        self.assertEqual([name for name, _ in Child.get_params()], ["file_id", "n"])
+        self.assertEqual(Child.get_params(), Child.get_params())
+        self.assertEqual(Child(file_id="a").clone(PerSample).file_id, "a")
+
+    def test_file_ids(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ids.txt")
+            Path(path).write_text("a\nb\n")
+            ids = get_file_ids(path)
+            self.assertEqual(ids, ("a", "b"))
+            # parsed once while the file is unchanged
+            self.assertIs(get_file_ids(path), ids)
+            Path(path).write_text("a\nb\nc\n")
+            self.assertEqual(get_file_ids(path), ("a", "b", "c"))
+
+
+class ScanTests(TestCase):
+    def test_directory_index(self):
+        with TemporaryDirectory() as tmp:
+            for sample in ["s1", "s2"]:
+                os.makedirs(os.path.join(tmp, sample))
+            Path(tmp, "s1", "__SUCCESS").touch()
+            index = DirectoryIndex()
+            index.scan_tree(tmp)
+            self.assertTrue(index.exists(os.path.join(tmp, "s1", "__SUCCESS")))
+            self.assertFalse(index.exists(os.path.join(tmp, "s2", "__SUCCESS")))
+            self.assertTrue(index.exists(os.path.join(tmp, "s2")))
+            # answered from the listing of tmp, without listing s3
+            self.assertFalse(index.exists(os.path.join(tmp, "s3", "__SUCCESS")))
+            self.assertNotIn(os.path.join(tmp, "s3"), index._entries)
+
+            # the index is a snapshot until refreshed
+            os.makedirs(os.path.join(tmp, "s3"))
+            Path(tmp, "s3", "__SUCCESS").touch()
+            self.assertFalse(index.exists(os.path.join(tmp, "s3", "__SUCCESS")))
+            index.refresh(os.path.join(tmp, "s3", "__SUCCESS"))
+            self.assertTrue(index.exists(os.path.join(tmp, "s3", "__SUCCESS")))
+
+            # sizes come from one listing of the folder
+            Path(tmp, "s1", "R1.fastq").write_bytes(b"@" * 10)
+            self.assertEqual(index.size(os.path.join(tmp, "s1", "R1.fastq")), 10)
+            self.assertEqual(index.size(os.path.join(tmp, "s1", "R2.fastq")), 0)
+            Path(tmp, "s1", "R2.fastq").write_bytes(b"@" * 5)
+            self.assertEqual(index.size(os.path.join(tmp, "s1", "R2.fastq")), 0)
+            index.refresh(os.path.join(tmp, "s1", "R2.fastq"))
+            self.assertEqual(index.size(os.path.join(tmp, "s1", "R2.fastq")), 5)
+
+    def test_bulk_complete(self):
+        config = get_config()
+        if not config.has_section("scan"):
+            config.add_section("scan")
+        config.set("scan", "bulk_complete", "true")
+        try:
+            with TemporaryDirectory() as tmp:
+                salmon = write_fake_salmon(tmp)
+                fasta = os.path.join(tmp, "transcripts.fa")
+                Path(fasta).write_text(">ENST01.1\nACGT\n")
+                task = SalmonIndex(
+                    index_path=os.path.join(tmp, "index"),
+                    transcriptome=fasta,
+                    annotation_path="fake",
+                    salmon_path=salmon,
+                    n_threads=1,
+                )
+                directory_index().scan_tree(tmp)
+                self.assertFalse(task.complete())
+                # finished tasks refresh the index
+                self.assertTrue(build([task], local_scheduler=True))
+                self.assertTrue(task.complete())
+        finally:
+            config.remove_option("scan", "bulk_complete")
+
+
+class TreeMergeTests(TestCase):
+    def test_merge_groups(self):
+        ids = ["s{}".format(i) for i in range(40)]
+        self.assertIsNone(merge_groups(ids[:4], 4))
+        groups = merge_groups(ids, 4)
+        self.assertEqual([len(g) for g in groups], [16, 16, 8])
+        # appending samples only changes the last group
+        self.assertEqual(merge_groups(ids + ["s40"], 4)[:2], groups[:2])
+
+    def test_tree_merge(self):
+        cwd = os.getcwd()
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                cohort = write_cohort(".", n_transcripts=60, n_samples=10)
+                params = task_params(cohort)
+                serial = CleanCounts(write_csv=False, **params)
+                self.assertTrue(build([serial], local_scheduler=True))
+                expected = serial.output()["count_matrix"].load().to_frame()
+                os.remove(serial.output()["count_matrix"].path)
+
+                tree = CleanCounts(write_csv=False, tree_merge=True, **params)
+                self.assertEqual(
+                    type(tree.requires()["raw_counts"]).__name__, "MergeGeneCounts"
+                )
+                self.assertTrue(build([tree], local_scheduler=True))
+                merged = tree.output()["count_matrix"].load().to_frame()
+                pd.testing.assert_frame_equal(merged, expected)
+
+                # merging in levels of 3 gives the same matrix as in one go
+                flat, nested = tree.requires()["raw_counts"], tree.clone(
+                    MergeGeneCounts, fan_in=3
+                )
+                self.assertTrue(build([nested], local_scheduler=True))
+                self.assertIsInstance(nested.requires()[0], MergeGeneCounts)
+                for key in ["count_matrix", "tpm_matrix"]:
+                    pd.testing.assert_frame_equal(
+                        nested.output()[key].load().to_frame(),
+                        flat.output()[key].load().to_frame(),
+                    )
+                sample = SampleGeneCounts(file_id="sample_00003", **params)
+                self.assertEqual(
+                    sample.output().load().columns.tolist(), ["count", "tpm"]
+                )
+                # kept out of the quant folder, which a new quant replaces
+                self.assertTrue(sample.output().path.startswith("data/genes/"))
+                self.assertTrue(sample.complete())
+                # a changed annotation sums the samples again
+                with open(params["annotation_path"], "a") as file:
+                    file.write("\n")
+                self.assertFalse(sample.complete())
+            finally:
+                os.chdir(cwd)
+
+
+class BlockCleanTests(TestCase):
+    def test_block_clean(self):
+        cwd = os.getcwd()
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                cohort = write_cohort(".", n_transcripts=90, n_samples=7)
+                params = task_params(cohort)
+                for tree_merge in [False, True]:
+                    whole = CleanCounts(tree_merge=tree_merge, **params)
+                    self.assertTrue(build([whole], local_scheduler=True))
+                    expected = {
+                        key: whole.output()[key].open("r").read()
+                        for key in ["count", "tpm"]
+                    }
+                    for target in whole.output().values():
+                        os.remove(target.path)
+
+                    # 3 samples at a time, the last block is shorter
+                    blocks = CleanCounts(tree_merge=tree_merge, block_size=3, **params)
+                    self.assertTrue(build([blocks], local_scheduler=True))
+                    for key in ["count", "tpm"]:
+                        self.assertEqual(
+                            blocks.output()[key].open("r").read(), expected[key]
+                        )
+                    store = blocks.output()["tpm_matrix"].load()
+                    self.assertEqual(store.row_name, "gene_name")
+                    self.assertEqual(store.shape[1], 7)
+                    for target in blocks.output().values():
+                        os.remove(target.path)
+            finally:
+                os.chdir(cwd)
+
+
+FAKE_SBATCH = """#!/bin/sh
+# stand-in for sbatch: runs the job script in the background
+dir="$(dirname "$0")"
+echo "$@" >> "$dir/sbatch_calls.txt"
+id=$(wc -l < "$dir/sbatch_calls.txt" | tr -d " ")
+for arg in "$@"; do
+    case "$arg" in
+        --output=*) log="${arg#--output=}" ;;
+    esac
+    script="$arg"
+done
+(sh "$script" > "$log" 2>&1; touch "$dir/job_$id.done") &
+echo "$id;cluster"
+"""
+
+FAKE_SQUEUE = """#!/bin/sh
+# stand-in for squeue -h -j <id> -o %T
+if [ -e "$(dirname "$0")/job_$3.done" ]; then
+    echo "slurm_load_jobs error: Invalid job id specified" >&2
+    exit 1
+fi
+echo RUNNING
+"""
+
+
+class ExecutorTests(TestCase):
+    def write_shims(self, folder):
+        for name, text in [("sbatch", FAKE_SBATCH), ("squeue", FAKE_SQUEUE)]:
+            path = os.path.join(folder, name)
+            Path(path).write_text(text)
+            os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        return SlurmExecutor(
+            job_dir=os.path.join(folder, "jobs"),
+            poll_interval=0.05,
+            sbatch=os.path.join(folder, "sbatch"),
+            squeue=os.path.join(folder, "squeue"),
+        )
+
+    def test_slurm_executor(self):
+        with TemporaryDirectory() as tmp:
+            executor = self.write_shims(tmp)
+            executor.run(["sh", "-c", "echo hello"], "ok", "ok", cores=4, mem_gb=2)
+            with open(os.path.join(tmp, "sbatch_calls.txt")) as file:
+                call = file.read().split()
+            self.assertIn("--cpus-per-task=4", call)
+            self.assertIn("--mem=2048M", call)
+            with open(executor.job_paths("ok")["log"]) as file:
+                self.assertEqual(file.read(), "hello\n")
+            with self.assertRaises(ExternalProgramRunError) as failed:
+                executor.run(["sh", "-c", "exit 3"], "fail", "fail")
+            self.assertIn("return code=3", str(failed.exception))
+
+    def test_slurm_quant(self):
+        cwd = os.getcwd()
+        config = get_config()
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                shims = self.write_shims(tmp)
+                configure_executor(
+                    get_parser().parse_args(
+                        [
+                            "--id",
+                            "ids.txt",
+                            "--executor",
+                            "slurm",
+                            "--quant-mem-gb",
+                            "4",
+                        ]
+                    )
+                )
+                for key in ["sbatch", "squeue", "job_dir", "poll_interval"]:
+                    config.set("executor", key, str(getattr(shims, key)))
+                salmon = write_fake_salmon(tmp)
+                fasta = os.path.join(tmp, "transcripts.fa")
+                Path(fasta).write_text(">ENST01.1\nACGT\n")
+                os.makedirs(os.path.join("data", "fastq"))
+                ids = ["s1", "s2"]
+                for x in ids:
+                    for reads in ["_1", "_2"]:
+                        Path("data", "fastq", x + reads + ".fastq.gz").touch()
+                Path("ids.txt").write_text("\n".join(ids) + "\n")
+                task = SummarizeCounts(
+                    ID_path="ids.txt",
+                    transcriptome=fasta,
+                    annotation_path="fake",
+                    salmon_path=salmon,
+                    index_path=os.path.join(tmp, "index"),
+                    n_threads=3,
+                    fastq_r1="_1",
+                    fastq_r2="_2",
+                    fastq_suffix=".fastq.gz",
+                )
+                self.assertTrue(build([task], local_scheduler=True, workers=2))
+
+                # the index and each sample were submitted as jobs
+                with open(os.path.join(tmp, "sbatch_calls.txt")) as file:
+                    calls = [line.split() for line in file]
+                names = sorted(c[1] for c in calls)
+                self.assertEqual(
+                    names, ["--job-name=SalmonIndex"] + ["--job-name=SalmonQuant"] * 2
+                )
+                quant = [c for c in calls if c[1] == "--job-name=SalmonQuant"][0]
+                self.assertIn("--cpus-per-task=3", quant)
+                self.assertIn("--mem=4096M", quant)
+                counts = MatrixStore(task.output()["count_matrix"].path)
+                self.assertEqual(list(counts.columns), ids)
+            finally:
+                config.remove_section("executor")
+                os.chdir(cwd)
+
+
+class StagingTests(TestCase):
+    def test_staged_quant(self):
+        cwd = os.getcwd()
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                salmon = write_fake_salmon(tmp)
+                fasta = os.path.join(tmp, "transcripts.fa")
+                Path(fasta).write_text(">ENST01.1\nACGT\n")
+                os.makedirs(os.path.join("data", "fastq"))
+                ids = ["s1", "s2", "s3"]
+                for x in ids:
+                    for reads in ["_1", "_2"]:
+                        Path("data", "fastq", x + reads + ".fastq.gz").write_bytes(
+                            b"@" * 100
+                        )
+                Path("ids.txt").write_text("\n".join(ids) + "\n")
+                scratch = os.path.join(tmp, "scratch")
+                task = SummarizeCounts(
+                    ID_path="ids.txt",
+                    transcriptome=fasta,
+                    annotation_path="fake",
+                    salmon_path=salmon,
+                    index_path=os.path.join(tmp, "index"),
+                    n_threads=1,
+                    fastq_r1="_1",
+                    fastq_r2="_2",
+                    fastq_suffix=".fastq.gz",
+                    scratch_dir=scratch,
+                    batch_size=2,
+                )
+                stage = task.clone(StageFastq, file_id="s1")
+                self.assertEqual(
+                    stage.output()["R1"].path,
+                    os.path.join(scratch, "s1", "s1_1.fastq.gz"),
+                )
+                # batches stage their samples one at a time as they run
+                batch = task.requires()["__batch_0"]
+                for fastq in batch.requires()["fastq"].values():
+                    self.assertNotIsInstance(fastq, StageFastq)
+                # copies are only limited once a staging budget is set
+                self.assertEqual(stage.resources, {})
+                config = get_config()
+                if not config.has_section("resources"):
+                    config.add_section("resources")
+                config.set("resources", "staging", "2")
+                try:
+                    self.assertEqual(stage.resources, {"staging": 1})
+                finally:
+                    config.remove_option("resources", "staging")
+                self.assertTrue(build([task], local_scheduler=True, workers=2))
+
+                # salmon read the scratch copies, which are gone once quantified
+                with open(os.path.join(tmp, "calls.txt")) as file:
+                    quants = [line.split() for line in file if line.startswith("quant")]
+                self.assertEqual(len(quants), 3)
+                for call in quants:
+                    r1 = call[call.index("-1") + 1]
+                    self.assertTrue(r1.startswith(scratch))
+                self.assertEqual(os.listdir(scratch), [".lock"])
+                self.assertEqual(scratch_usage(scratch), 0)
+            finally:
+                os.chdir(cwd)
+
+    def test_scratch_budget(self):
+        cwd = os.getcwd()
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                os.makedirs(os.path.join("data", "fastq"))
+                for reads in ["_1", "_2"]:
+                    Path("data", "fastq", "s1" + reads + ".fastq.gz").write_bytes(
+                        b"@" * 600
+                    )
+                params = dict(
+                    file_id="s1",
+                    fastq_r1="_1",
+                    fastq_r2="_2",
+                    fastq_suffix=".fastq.gz",
+                    scratch_dir="scratch",
+                )
+                # a sample larger than the budget is linked, not copied
+                small = StageFastq(scratch_budget_gb=1000 / 1024**3, **params)
+                small.run()
+                for target in small.output().values():
+                    self.assertTrue(os.path.islink(target.path))
+                self.assertEqual(scratch_usage("scratch"), 0)
+                shutil.rmtree(small.stage_dir)
+
+                large = StageFastq(scratch_budget_gb=2000 / 1024**3, **params)
+                large.run()
+                for target in large.output().values():
+                    self.assertFalse(os.path.islink(target.path))
+                    self.assertEqual(os.path.getsize(target.path), 600)
+                self.assertEqual(scratch_usage("scratch"), 1200)
+
+                # a full budget links the next sample right away
+                for reads in ["_1", "_2"]:
+                    Path("data", "fastq", "s2" + reads + ".fastq.gz").write_bytes(
+                        b"@" * 600
+                    )
+                params["file_id"] = "s2"
+                full = StageFastq(scratch_budget_gb=2000 / 1024**3, **params)
+                full.run()
+                for target in full.output().values():
+                    self.assertTrue(os.path.islink(target.path))
+                self.assertEqual(scratch_usage("scratch"), 1200)
+            finally:
+                os.chdir(cwd)
+
+
+class AtomicDirectoryTests(TestCase):
+    def test_atomic_directory(self):
+        with TemporaryDirectory() as tmp:
+            target = AtomicDirectoryTarget(os.path.join(tmp, "sample01"))
+            # a failed write leaves neither the target nor its temporary
+            with self.assertRaises(RuntimeError):
+                with target.temporary_path() as out:
+                    Path(out, "quant.sf").write_text("partial")
+                    raise RuntimeError("killed")
+            self.assertEqual(os.listdir(tmp), [])
+
+            # temporaries of dead writers are removed, partial targets replaced
+            dead = subprocess.Popen(["true"])
+            dead.wait()
+            stale = os.path.join(
+                tmp, ".sample01.tmp-{}-{}".format(socket.gethostname(), dead.pid)
+            )
+            os.makedirs(stale)
+            os.makedirs(target.path)
+            Path(target.path, "quant.sf").write_text("partial")
+            with target.temporary_path() as out:
+                self.assertTrue(os.path.isdir(out))
+                self.assertFalse(os.path.exists(stale))
+                Path(out, "quant.sf").write_text("complete")
+            self.assertEqual(os.listdir(tmp), ["sample01"])
+            self.assertEqual(Path(target.path, "quant.sf").read_text(), "complete")
+
+    def test_failed_salmon(self):
+        cwd = os.getcwd()
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                salmon = write_fake_salmon(tmp)
+                # salmon killed after writing part of its output
+                text = FAKE_SALMON.replace(
+                    "shift\ndone\n",
+                    'shift\ndone\n[ -e "$(dirname "$0")/crash" ] && exit 1\nexit 0\n',
+                )
+                Path(salmon).write_text(text)
+                Path(tmp, "crash").touch()
+                fasta = os.path.join(tmp, "transcripts.fa")
+                Path(fasta).write_text(">ENST01.1\nACGT\n")
+                os.makedirs(os.path.join("data", "fastq"))
+                for reads in ["_1", "_2"]:
+                    Path("data", "fastq", "s1" + reads + ".fastq.gz").touch()
+                task = SalmonQuant(
+                    file_id="s1",
+                    transcriptome=fasta,
+                    annotation_path="fake",
+                    salmon_path=salmon,
+                    index_path=os.path.join(tmp, "index"),
+                    n_threads=1,
+                    fastq_r1="_1",
+                    fastq_r2="_2",
+                    fastq_suffix=".fastq.gz",
+                )
+                # the failed index build leaves no index or temporary folder
+                self.assertFalse(build([task], local_scheduler=True))
+                self.assertEqual([x for x in os.listdir(tmp) if "index" in x], [])
+
+                os.remove(os.path.join(tmp, "crash"))
+                self.assertTrue(build([task], local_scheduler=True))
+                self.assertEqual(os.listdir(SalmonQuant.output_root), ["s1"])
+                self.assertEqual(
+                    sorted(os.listdir(os.path.dirname(task.output().path))),
+                    ["__SUCCESS", "aux_info", "logs", "quant.sf"],
+                )
+            finally:
+                os.chdir(cwd)
+
+
+class ProvenanceTests(TestCase):
+    def test_digest(self):
+        with TemporaryDirectory() as tmp:
+            store = ProvenanceStore(os.path.join(tmp, "provenance.sqlite"))
+            path = os.path.join(tmp, "annotation.tsv")
+            Path(path).write_text("a")
+            first = store.digest(path)
+            # a new store reuses the recorded digest while mtime and size hold
+            again = ProvenanceStore(store.path)
+            self.assertEqual(again.digest(path), first)
+            Path(path).write_text("b")
+            self.assertNotEqual(again.digest(path), first)
+            self.assertEqual(store.digest(os.path.join(tmp, "none")), "missing")
+
+    def test_code_digest(self):
+        with TemporaryDirectory() as tmp:
+            package = os.path.join(tmp, "package")
+            shutil.copytree(
+                os.path.dirname(RNA_seq.provenance.__file__),
+                package,
+                ignore=shutil.ignore_patterns("__pycache__"),
+            )
+            first = code_digest(package)
+            self.assertEqual(first, code_digest())
+            # a helper module outside any task class counts too
+            edited = os.path.join(tmp, "other")
+            shutil.copytree(package, edited)
+            with open(os.path.join(edited, "matrix.py"), "a") as file:
+                file.write("# changed\n")
+            self.assertNotEqual(code_digest(edited), first)
+
+    def test_changed_input(self):
+        cwd = os.getcwd()
+        config = get_config()
+        if not config.has_section("provenance"):
+            config.add_section("provenance")
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            config.set("provenance", "db", os.path.join(tmp, "provenance.sqlite"))
+            try:
+                cohort = write_cohort(".", n_transcripts=60, n_samples=4)
+                params = task_params(cohort)
+                clean = CleanCounts(write_csv=False, **params)
+                counts = clean.requires()["raw_counts"]
+                self.assertTrue(build([clean], local_scheduler=True))
+                self.assertTrue(clean.complete())
+
+                # the same content written again changes nothing
+                annotation = Path(cohort["annotation_path"])
+                text = annotation.read_text()
+                annotation.write_text(text)
+                os.utime(annotation, (time.time() + 10, time.time() + 10))
+                self.assertTrue(clean.complete())
+
+                # a changed annotation reruns the gene tables, not the counts
+                annotation.write_text(text.replace("GENE1\t", "GENE2\t"))
+                self.assertFalse(clean.complete())
+                self.assertTrue(counts.complete())
+                stamp = os.path.getmtime(counts.output()["count_matrix"].path)
+                self.assertTrue(build([clean], local_scheduler=True))
+                self.assertTrue(clean.complete())
+                self.assertEqual(
+                    os.path.getmtime(counts.output()["count_matrix"].path), stamp
+                )
+            finally:
+                config.remove_section("provenance")
+                os.chdir(cwd)
+
+    def test_rerun_downstream(self):
+        cwd = os.getcwd()
+        config = get_config()
+        if not config.has_section("provenance"):
+            config.add_section("provenance")
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            config.set("provenance", "db", os.path.join(tmp, "provenance.sqlite"))
+            try:
+                cohort = write_cohort(".", n_transcripts=60, n_samples=4)
+                params = task_params(cohort)
+                normalize = NormalizeCounts(write_csv=False, **params)
+                self.assertTrue(build([normalize], local_scheduler=True))
+                stamp = os.path.getmtime(normalize.output()["factors"].path)
+
+                # a changed annotation reruns the cleaned counts, so the
+                # normalization made from them is out of date before it runs
+                annotation = Path(cohort["annotation_path"])
+                text = annotation.read_text()
+                annotation.write_text(text.replace("GENE1\t", "GENE2\t"))
+                self.assertFalse(normalize.complete())
+                self.assertTrue(build([normalize], local_scheduler=True, workers=2))
+                self.assertTrue(normalize.complete())
+                self.assertGreater(
+                    os.path.getmtime(normalize.output()["factors"].path), stamp
+                )
+            finally:
+                config.remove_section("provenance")
+                os.chdir(cwd)
+
+    def test_scheduling_params(self):
+        cwd = os.getcwd()
+        config = get_config()
+        if not config.has_section("provenance"):
+            config.add_section("provenance")
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            config.set("provenance", "db", os.path.join(tmp, "provenance.sqlite"))
+            try:
+                cohort = write_cohort(".", n_transcripts=60, n_samples=4)
+                params = task_params(cohort)
+                clean = CleanCounts(**params)
+                mapping = SummarizeMapping(**params)
+                self.assertTrue(build([clean, mapping], local_scheduler=True))
+                # another core count, as from --cores, --workers or --threads
+                params.update(n_threads=8, n_workers=16, batch_size=2)
+                for cls in [SummarizeMapping, SummarizeCounts, CleanCounts]:
+                    self.assertTrue(cls(**params).complete())
+                self.assertEqual(CleanCounts(**params).task_id, clean.task_id)
+            finally:
+                config.remove_section("provenance")
+                os.chdir(cwd)
+
+
+class CostTests(TestCase):
+    def test_fit(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "history.tsv")
+            self.assertEqual(CostModel.load(path).overhead, CostModel().overhead)
+            for i, (size, threads) in enumerate([(1e9, 4), (4e9, 4), (2e9, 8)]):
+                seconds = 20 + 1e-6 * size / threads
+                record_runtime("s{}".format(i), int(size), threads, seconds, path)
+            model = CostModel.load(path)
+            self.assertAlmostEqual(model.overhead, 20, places=3)
+            self.assertAlmostEqual(model.predict(8e9, 16), 520, places=3)
+
+    def test_longest_first(self):
+        durations = [1, 1, 1, 1, 4]
+        self.assertEqual(makespan(durations, 2), 6)
+        self.assertEqual(longest_first(durations, 2), 4)
+        self.assertEqual(makespan([], 2), 0)
+
+    def test_priority(self):
+        cwd = os.getcwd()
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                os.makedirs(os.path.join("data", "fastq"))
+                ids = ["small", "large"]
+                for x, size in zip(ids, [10**6, 10**8]):
+                    for reads in ["_1", "_2"]:
+                        Path("data", "fastq", x + reads + ".fastq.gz").write_bytes(
+                            b"@" * size
+                        )
+                Path("ids.txt").write_text("\n".join(ids) + "\n")
+                params = dict(
+                    transcriptome="transcripts.fa",
+                    annotation_path="annotation",
+                    salmon_path="salmon",
+                    index_path="index",
+                    n_threads=2,
+                    fastq_r1="_1",
+                    fastq_r2="_2",
+                    fastq_suffix=".fastq.gz",
+                )
+                small, large = [SalmonQuant(file_id=x, **params) for x in ids]
+                self.assertGreater(large.priority, small.priority)
+                batch = SalmonQuantBatch(file_ids=ids, **params)
+                self.assertAlmostEqual(batch.priority, small.priority + large.priority)
+
+                out = io.StringIO()
+                with redirect_stdout(out):
+                    args = ["--id", "ids.txt", "--cores", "4", "--workers", "2"]
+                    self.assertTrue(main(args + ["--dry-run"]))
+                lines = out.getvalue().splitlines()
+                self.assertEqual(lines[0], "2 quantifications left, 2 at once")
+                self.assertIn("large", lines[1])
+                self.assertFalse(os.path.exists(os.path.join("data", "output")))
+            finally:
+                os.chdir(cwd)
+
+
+class MonitorTests(TestCase):
+    def test_log_tail(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "salmon.log")
+            log = LogTail(path, chunk=8)
+            self.assertEqual(log.read(), [])
+            Path(path).write_text("processed 1 fragments\rprocessed 2 frag")
+            self.assertEqual(log.read(), ["processed 1 fragments"])
+            with open(path, "a") as file:
+                file.write("ments\nhits: 3\n")
+            self.assertEqual(log.read(), ["processed 2 fragments", "hits: 3"])
+            self.assertEqual(log.read(), [])
+            # a new log starts over
+            Path(path).write_text("new\n")
+            self.assertEqual(log.read(), ["new"])
+
+    def test_monitor(self):
+        with TemporaryDirectory() as tmp:
+            name = ".s1.tmp-{}-{}".format(socket.gethostname(), os.getpid())
+            logs = os.path.join(tmp, name, "logs")
+            os.makedirs(logs)
+            # a dead writer's folder is not a running sample
+            os.makedirs(os.path.join(tmp, ".s2.tmp-{}-999999999".format("host")))
+            Path(logs, "salmon_quant.log").write_text(
+                "[2020-01-01 00:00:00.000] [jointLog] [info] setting maxHashResizeThreads\n"
+            )
+            Path(logs, PROGRAM_LOG).write_text(
+                "\x1b[A\x1b[32mprocessed\x1b[31m 2500000 \x1b[32mfragments\x1b[0m\n"
+            )
+            monitor = QuantMonitor(tmp, stall_seconds=300)
+            start = time.mktime((2020, 1, 1, 0, 0, 0, 0, 0, -1))
+            now = start + 100
+            (progress,) = monitor.poll(now)
+            self.assertEqual(progress.sample, "s1")
+            self.assertEqual(progress.fragments, 2500000)
+            self.assertAlmostEqual(progress.rate(now), 25000)
+            self.assertFalse(progress.stalled(now))
+            self.assertTrue(progress.stalled(now + 301))
+            metrics = monitor.metrics(now)
+            self.assertIn('rnaseq_quant_fragments{sample="s1"} 2500000\n', metrics)
+            self.assertIn("rnaseq_quant_running 1\n", metrics)
+            self.assertNotIn("mapping_rate{", metrics)
+            with open(os.path.join(logs, "salmon_quant.log"), "a") as file:
+                file.write("Mapping rate = 91.5000%\n")
+            monitor.poll(now)
+            self.assertAlmostEqual(progress.mapping_rate, 0.915)
+            self.assertIn("91.5%", monitor.table(now))
+
+            path = os.path.join(tmp, "rnaseq.prom")
+            monitor.write_textfile(path, now)
+            self.assertEqual(Path(path).read_text(), monitor.metrics(now))
+            shutil.rmtree(os.path.join(tmp, name))
+            self.assertEqual(monitor.poll(now), [])
+            self.assertEqual(monitor.finished, 1)
+
+
+class NormalizeTests(TestCase):
+    def test_tmm(self):
+        rng = np.random.default_rng(0)
+        base = rng.integers(10, 1000, size=1000).astype(float)
+        # the second sample has 100 genes at ten times the level
+        counts = np.column_stack([base, base, base])
+        counts[:100, 1] *= 10
+        counts[:, 2] *= 3
+        lib = library_sizes(counts)
+        factors = tmm_factors(counts, lib, counts[:, 0], lib[0])
+        self.assertAlmostEqual(factors[0], 1)
+        self.assertAlmostEqual(factors[2], 1)
+        # scaled libraries level the unchanged genes, raw libraries do not
+        tmm = cpm(counts, lib * factors)
+        np.testing.assert_allclose(tmm[100:, 1], tmm[100:, 0])
+        self.assertFalse(np.allclose(cpm(counts, lib)[100:, 1], tmm[100:, 0]))
+        vst = log_cpm(counts, lib, lib.mean())
+        self.assertTrue(np.isfinite(vst).all())
+        # sparse genes still get a finite, damped value
+        self.assertTrue(np.isfinite(log_cpm(np.zeros((2, 2)), lib[:2], 1)).all())
+
+    def test_normalize_counts(self):
+        cwd = os.getcwd()
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                cohort = write_cohort(".", n_transcripts=90, n_samples=7)
+                params = task_params(cohort)
+                whole = NormalizeCounts(**params)
+                self.assertTrue(build([whole], local_scheduler=True))
+                cpm_store = whole.output()["cpm_matrix"].load()
+                np.testing.assert_allclose(cpm_store.values.sum(axis=0), 1e6)
+                factors = pd.read_table(whole.output()["factors"].path)
+                self.assertEqual(len(factors), 7)
+                self.assertAlmostEqual(np.exp(np.log(factors.norm_factor).mean()), 1)
+                expected = {
+                    key: whole.output()[key].open("r").read() for key in MATRICES
+                }
+                for target in whole.output().values():
+                    os.remove(target.path)
+
+                # 3 samples at a time, in single precision
+                blocks = NormalizeCounts(block_size=3, float32=True, **params)
+                self.assertTrue(build([blocks], local_scheduler=True))
+                for key in MATRICES:
+                    single = blocks.output()[key + "_matrix"].load()
+                    self.assertEqual(single.values.dtype, np.float32)
+                    frame = pd.read_csv(io.StringIO(expected[key]))
+                    np.testing.assert_allclose(
+                        single.values, frame.iloc[:, 1:].to_numpy(), rtol=1e-5
+                    )
+            finally:
+                os.chdir(cwd)